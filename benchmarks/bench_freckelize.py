@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks for the metadata processing phases of freckelize.
+
+Synthetic freckle trees (with '.freckle' files, nested '.<name>.freckle' extra-var files and several
+profiles) and synthetic adapter repos are generated in a temporary folder, and the phases that don't
+involve Ansible are timed directly:
+
+- find_freckelize_adapters
+- scan_local_freckle (the native replacement for the checkout run)
+- read_checkout_metadata
+- prepare_checkout_metadata
+- calculate_profiles_to_run
+- process_folder_vars
+- materialize_vars (merging the var views into the dicts handed to nsbl)
+
+Usage::
+
+    python benchmarks/bench_freckelize.py --sizes 10,1000,10000 --output results.json
+    python benchmarks/bench_freckelize.py --baseline results.json
+
+If a baseline is provided, the benchmark fails if a phase got slower than the baseline by more than the
+tolerance factor. Independent of a baseline, it also fails if the per-folder time of a phase grows by
+more than the scaling factor between the two largest sizes, which indicates non-linear behaviour.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import copy
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import click
+
+DEFAULT_SIZES = "10,100,1000,10000,50000"
+DEFAULT_PROFILES = ["python-dev", "dotfiles", "static-website", "pkgs"]
+DEFAULT_NUM_ADAPTERS = 50
+DEFAULT_TOLERANCE = 1.5
+DEFAULT_MAX_SCALING = 3.0
+# phases that are faster than this (in seconds) are not checked for regressions, too noisy
+MIN_CHECK_DURATION = 0.05
+PHASES = ["find_adapters", "scan", "read_checkout_metadata", "prepare_checkout_metadata",
+          "calculate_profiles_to_run", "process_folder_vars", "materialize_vars"]
+# the number of adapters doesn't depend on the number of folders
+SCALING_PHASES = PHASES[1:]
+
+
+def create_freckle_tree(root, num_folders, profiles=None, fanout=10):
+    """Creates a synthetic freckle repo.
+
+    Every folder contains a '.freckle' file that configures between one and all of the provided profiles,
+    and a nested extra-vars file.
+
+    Args:
+      root (str): the (non-existing) root folder
+      num_folders (int): the number of freckle folders to create (including the root)
+      profiles (list): the profile names to use
+      fanout (int): the maximum number of sub-folders per folder
+    Returns:
+      str: the root folder
+    """
+
+    if profiles is None:
+        profiles = DEFAULT_PROFILES
+
+    os.makedirs(root)
+    folders = [root]
+    parent_index = 0
+    while len(folders) < num_folders:
+        parent = folders[parent_index // fanout]
+        folder = os.path.join(parent, "freckle_{}".format(len(folders)))
+        os.makedirs(folder)
+        folders.append(folder)
+        parent_index = parent_index + 1
+
+    for i, folder in enumerate(folders):
+        lines = []
+        for profile in profiles[:(i % len(profiles)) + 1]:
+            lines.append("- {}:".format(profile))
+            lines.append("    name: folder_{}".format(i))
+            lines.append("    packages:")
+            lines.append("      - pkg_{}".format(i % 7))
+            lines.append("      - pkg_{}".format(i % 11))
+            lines.append("    settings:")
+            lines.append("      level: {}".format(i % 3))
+            lines.append("      enabled: {}".format("true" if i % 2 else "false"))
+        with open(os.path.join(folder, ".freckle"), "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+        extra_folder = os.path.join(folder, "config")
+        os.makedirs(extra_folder)
+        with open(os.path.join(extra_folder, ".settings.freckle"), "w") as f:
+            f.write("theme: dark\nsize: {}\n".format(i))
+        with open(os.path.join(folder, ".flag.freckle"), "w") as f:
+            f.write("")
+        with open(os.path.join(folder, "README.md"), "w") as f:
+            f.write("# folder {}\n".format(i))
+
+    return root
+
+
+def create_adapter_repo(root, num_adapters, profiles=None):
+    """Creates a synthetic adapter repo.
+
+    Adapters are spread over a few nested folders, and include adapters for all of the provided profiles.
+
+    Args:
+      root (str): the (non-existing) root folder
+      num_adapters (int): the number of adapters to create
+      profiles (list): profile names that have to have an adapter
+    Returns:
+      str: the root folder
+    """
+
+    if profiles is None:
+        profiles = DEFAULT_PROFILES
+
+    names = list(profiles)
+    while len(names) < num_adapters:
+        names.append("adapter-{}".format(len(names)))
+
+    for i, name in enumerate(names):
+        folder = os.path.join(root, "group_{}".format(i % 5), name)
+        os.makedirs(folder)
+        with open(os.path.join(folder, "{}.adapter.freckle".format(name)), "w") as f:
+            f.write("doc:\n  help: synthetic adapter {}\n".format(name))
+            f.write("__freckles__:\n  adapter_priority: {}\n  roles:\n    - role-{}\n".format(i * 10, i % 3))
+            f.write("tasks:\n  - name: noop\n    debug:\n      msg: {}\n".format(name))
+
+    return root
+
+
+class BenchmarkConfig(object):
+    """Minimal stand-in for the freckles configuration, only providing what's needed to expand local repos."""
+
+    def __init__(self, trusted_repos, default_freckelize_target):
+
+        self.trusted_repos = trusted_repos
+        self.default_freckelize_target = default_freckelize_target
+
+
+def run_benchmark(base_dir, num_folders, num_adapters=DEFAULT_NUM_ADAPTERS):
+    """Generates the synthetic repos for one size and times all phases.
+
+    Args:
+      base_dir (str): the folder to create the synthetic repos in
+      num_folders (int): the number of freckle folders
+      num_adapters (int): the number of adapters
+    Returns:
+      OrderedDict: the phase name as key, the duration in seconds as value
+    """
+
+    from freckelize.checkout import scan_local_freckle
+    from freckelize.freckelize import Freckelize, FreckleDetails, FreckleRepo
+    from freckelize.layered_vars import materialize_vars
+    from freckelize.timings import PhaseTimings
+    from freckelize.utils import find_freckelize_adapters, ADAPTER_CACHE, METADATA_CONTENT_KEY
+    from freckles.freckles_defaults import DEFAULT_EXCLUDE_DIRS
+
+    freckle_root = create_freckle_tree(os.path.join(base_dir, "freckles_{}".format(num_folders)), num_folders)
+    adapter_root = create_adapter_repo(os.path.join(base_dir, "adapters_{}".format(num_folders)), num_adapters)
+
+    timings = PhaseTimings()
+    config = BenchmarkConfig([adapter_root], os.path.join(base_dir, "target"))
+    repo = FreckleRepo({"url": freckle_root})
+    f = Freckelize(FreckleDetails(repo), config=config, timings=timings)
+
+    ADAPTER_CACHE.clear()
+    with timings.phase("find_adapters"):
+        adapters = find_freckelize_adapters(adapter_root)
+    if len(adapters) != num_adapters:
+        raise Exception("Expected {} adapters, found {}.".format(num_adapters, len(adapters)))
+
+    repo_desc = copy.copy(repo.repo_desc)
+    repo_desc["add_file_list"] = False
+    with timings.phase("scan"):
+        records = list(scan_local_freckle(repo_desc, METADATA_CONTENT_KEY, exclude_dirs=DEFAULT_EXCLUDE_DIRS))
+    if len(records) != num_folders:
+        raise Exception("Expected {} freckle folders, found {}.".format(num_folders, len(records)))
+
+    folders_metadata = list(f.read_checkout_metadata(records))
+    (freckles_metadata, repo_lookup, repo_index) = f.prepare_checkout_metadata(folders_metadata)
+    freckle_profile = f.process_freckle_profile_vars(freckles_metadata.get("freckle"))
+    profiles_map = f.calculate_profiles_to_run(freckles_metadata, repo_lookup, repo_index)
+    f.process_profiles_vars(profiles_map, freckle_profile)
+    with timings.phase("materialize_vars"):
+        materialize_vars(profiles_map)
+        materialize_vars(freckle_profile)
+
+    summary = timings.summary()
+    result = OrderedDict()
+    for phase in PHASES:
+        result[phase] = summary.get(phase, {}).get("total", 0.0)
+
+    return result
+
+
+def check_results(results, baseline=None, tolerance=DEFAULT_TOLERANCE, max_scaling=DEFAULT_MAX_SCALING):
+    """Compares benchmark results against a baseline, and checks how phases scale with the number of folders.
+
+    Args:
+      results (dict): the benchmark results, with the number of folders (as string) as key
+      baseline (dict): (optional) results of an earlier benchmark run
+      tolerance (float): the maximum factor a phase is allowed to be slower than the baseline
+      max_scaling (float): the maximum factor the per-folder time of a phase is allowed to grow between the two largest sizes
+    Returns:
+      list: a list of problem descriptions, empty if there are no regressions
+    """
+
+    problems = []
+
+    if baseline:
+        for size, phases in results.items():
+            for phase, duration in phases.items():
+                old_duration = baseline.get(size, {}).get(phase, None)
+                if old_duration is None or max(duration, old_duration) < MIN_CHECK_DURATION:
+                    continue
+                if duration > old_duration * tolerance:
+                    problems.append("{} folders, phase '{}': {:.3f}s, baseline {:.3f}s".format(size, phase, duration, old_duration))
+
+    sizes = sorted(int(s) for s in results.keys())
+    if len(sizes) >= 2:
+        small, large = sizes[-2], sizes[-1]
+        for phase in SCALING_PHASES:
+            small_duration = results[str(small)][phase]
+            large_duration = results[str(large)][phase]
+            if large_duration < MIN_CHECK_DURATION or small_duration <= 0:
+                continue
+            scaling = (large_duration / large) / (small_duration / small)
+            if scaling > max_scaling:
+                problems.append("phase '{}' scales non-linearly: per-folder time grows {:.1f}x from {} to {} folders".format(phase, scaling, small, large))
+
+    return problems
+
+
+@click.command()
+@click.option("--sizes", help="comma-separated list of freckle folder counts to benchmark", default=DEFAULT_SIZES, show_default=True)
+@click.option("--adapters", help="number of synthetic adapters", type=int, default=DEFAULT_NUM_ADAPTERS, show_default=True)
+@click.option("--output", help="file to write the results to", type=click.Path(dir_okay=False, writable=True), required=False)
+@click.option("--baseline", help="results of an earlier run to compare against", type=click.Path(exists=True, dir_okay=False), required=False)
+@click.option("--tolerance", help="maximum slowdown factor compared to the baseline", type=float, default=DEFAULT_TOLERANCE, show_default=True)
+@click.option("--max-scaling", help="maximum growth factor of the per-folder time between the two largest sizes", type=float, default=DEFAULT_MAX_SCALING, show_default=True)
+@click.option("--keep", help="don't delete the generated repos", is_flag=True, default=False)
+def main(sizes, adapters, output, baseline, tolerance, max_scaling, keep):
+
+    # don't let results from (or to) the user's persistent caches distort the numbers
+    base_dir = tempfile.mkdtemp(prefix="freckelize_bench.")
+    os.environ["FRECKELIZE_CACHE_DIR"] = os.path.join(base_dir, "cache")
+
+    results = OrderedDict()
+    try:
+        for size in [int(s) for s in sizes.split(",") if s.strip()]:
+            click.echo("benchmarking {} folders...".format(size))
+            start = time.time()
+            results[str(size)] = run_benchmark(base_dir, size, num_adapters=adapters)
+            for phase, duration in results[str(size)].items():
+                click.echo("  {}  {:>10.3f}s".format(phase.ljust(max(len(p) for p in PHASES)), duration))
+            click.echo("  (total including tree generation: {:.3f}s)".format(time.time() - start))
+    finally:
+        if keep:
+            click.echo("generated repos kept in: {}".format(base_dir))
+        else:
+            shutil.rmtree(base_dir, ignore_errors=True)
+
+    if output:
+        content = OrderedDict([("python", platform.python_version()), ("platform", platform.platform()), ("results", results)])
+        with open(output, "w") as f:
+            json.dump(content, f, indent=2)
+
+    baseline_results = None
+    if baseline:
+        with open(baseline) as f:
+            baseline_results = json.load(f)["results"]
+
+    problems = check_results(results, baseline_results, tolerance=tolerance, max_scaling=max_scaling)
+    if problems:
+        click.echo()
+        click.secho("Performance regressions:", bold=True)
+        for p in problems:
+            click.echo("  - {}".format(p))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
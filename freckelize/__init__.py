@@ -4,6 +4,8 @@
 
 from __future__ import absolute_import, division, print_function
 
+import sys
+
 import click
 
 __author__ = """Markus Binsteiner"""
@@ -15,3 +17,28 @@ def print_version(ctx, param, value):
         return
     click.echo(__version__)
     ctx.exit()
+
+
+def main(args=None):
+    """Entry point for the 'freckelize' command.
+
+    Answers '--version' without loading the (much heavier) command-line interface, and forwards runs to
+    a running freckelize daemon ('freckelize-daemon') if that is enabled with the 'FRECKELIZE_USE_DAEMON'
+    environment variable.
+    """
+
+    if args is None:
+        args = sys.argv[1:]
+
+    if list(args) == ["--version"]:
+        click.echo(__version__)
+        return 0
+
+    from .daemon import run_in_daemon
+
+    exit_code = run_in_daemon(args)
+    if exit_code is not None:
+        return exit_code
+
+    from .cli import cli
+    return cli(args=args, prog_name="freckelize")
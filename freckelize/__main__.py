@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+
+"""Allows running freckelize with 'python -m freckelize'."""
+
+from __future__ import absolute_import, division, print_function
+
+import sys
+
+from freckelize import main
+
+if __name__ == "__main__":
+    sys.exit(main())  # pragma: no cover
@@ -0,0 +1,618 @@
+# -*- coding: utf-8 -*-
+
+"""Persistent, on-disk caches for freckelize."""
+
+from __future__ import absolute_import, division, print_function
+
+import atexit
+import copy
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+try:
+    from os import scandir
+except (ImportError):
+    from scandir import scandir
+
+log = logging.getLogger("freckles")
+
+FRECKELIZE_CACHE_DIR_ENV_NAME = "FRECKELIZE_CACHE_DIR"
+DEFAULT_FRECKELIZE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".freckles", "cache", "freckelize")
+# increase this if the format of one of the cache files changes
+CACHE_FORMAT_VERSION = 1
+# files that mark a folder as an Ansible role, relative to that folder
+ANSIBLE_ROLE_MARKERS = [os.path.join("tasks", "main.yml"), os.path.join("tasks", "main.yaml"),
+                        os.path.join("meta", "main.yml"), os.path.join("meta", "main.yaml")]
+
+
+def get_cache_dir():
+    """Returns the folder freckelize uses to store it's caches.
+
+    Can be overwritten with the 'FRECKELIZE_CACHE_DIR' environment variable. If that variable is set to an
+    empty string, persistent caching is disabled.
+
+    Returns:
+      str: the path to the cache folder, or None if caching is disabled
+    """
+
+    cache_dir = os.environ.get(FRECKELIZE_CACHE_DIR_ENV_NAME, None)
+    if cache_dir is None:
+        return DEFAULT_FRECKELIZE_CACHE_DIR
+    if not cache_dir:
+        return None
+    return os.path.expanduser(cache_dir)
+
+
+def get_cache_file(name, extension="json"):
+    """Returns the full path to the cache file with the provided name.
+
+    Args:
+      name (str): the name of the cache (file)
+      extension (str): the file extension
+    Returns:
+      str: the path, or None if caching is disabled
+    """
+
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return None
+    return os.path.join(cache_dir, "{}.{}".format(name, extension))
+
+
+def get_json_cache_stamp(name):
+    """Returns a value that changes whenever a json cache file is written.
+
+    Cache files are replaced (not modified) when they are written, so the inode changes as well as the mtime.
+
+    Args:
+      name (str): the name of the cache
+    Returns:
+      tuple: the stamp, or None if the file doesn't exist (or caching is disabled)
+    """
+
+    path = get_cache_file(name)
+    if path is None:
+        return None
+
+    try:
+        stat = os.stat(path)
+    except (OSError):
+        return None
+    return (stat.st_ino, stat.st_mtime)
+
+
+def load_json_cache(name, default=None):
+    """Loads a json cache file.
+
+    A missing or corrupt cache file is not an error, in that case the default value is returned.
+
+    Args:
+      name (str): the name of the cache
+      default (object): the value to return if no (valid) cache exists
+    Returns:
+      object: the cache content
+    """
+
+    path = get_cache_file(name)
+    if path is None or not os.path.exists(path):
+        return default
+
+    try:
+        with open(path) as f:
+            return json.load(f, object_pairs_hook=OrderedDict)
+    except (Exception) as e:
+        log.debug("Could not read cache file '{}', ignoring: {}".format(path, e))
+        return default
+
+
+def save_json_cache(name, data):
+    """Atomically writes a json cache file.
+
+    Failing to write a cache is logged, but otherwise ignored.
+
+    Args:
+      name (str): the name of the cache
+      data (object): the (json-serializable) content
+    """
+
+    path = get_cache_file(name)
+    if path is None:
+        return
+
+    try:
+        cache_dir = os.path.dirname(path)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        fd, temp_path = tempfile.mkstemp(prefix=".{}.".format(os.path.basename(name)), dir=cache_dir)
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.rename(temp_path, path)
+    except (Exception) as e:
+        log.debug("Could not write cache file '{}', ignoring: {}".format(path, e))
+
+
+class MarkerFileIndex(object):
+    """Persistent index of marker files (e.g. '*.adapter.freckle') below a set of root folders.
+
+    For every folder under a root, the folder's mtime, it's (non-excluded) sub-folders and the marker files it
+    contains are recorded. When a root is looked up again, only folders whose mtime changed (which means a
+    direct child was added, removed or renamed) are listed again, everything else is answered from the index.
+
+    The walk follows symlinks, but never visits the same folder twice. It doesn't descend into Ansible
+    roles (folders that contain 'tasks/main.yml' or 'meta/main.yml'), as marker files never live there.
+
+    Args:
+      name (str): the name of the cache file
+      pattern (str): the glob pattern marker files have to match
+      exclude_dirs (list): names of folders to never descend into
+      max_depth (int): the maximum depth (relative to a root) of folders to look into, None for no limit
+      prune_roles (bool): whether to skip the content of Ansible roles
+    """
+
+    def __init__(self, name, pattern, exclude_dirs=None, max_depth=None, prune_roles=True):
+
+        self.name = name
+        self.pattern = pattern
+        if exclude_dirs is None:
+            exclude_dirs = []
+        self.exclude_dirs = exclude_dirs
+        self.max_depth = max_depth
+        self.prune_roles = prune_roles
+        self.index = None
+        self.stamp = None
+        self.lock = threading.RLock()
+
+    def load(self):
+
+        with self.lock:
+            if self.index is not None:
+                return self.index
+
+            self.stamp = get_json_cache_stamp(self.name)
+            index = load_json_cache(self.name, {})
+            if index.get("version", None) != CACHE_FORMAT_VERSION or index.get("pattern", None) != self.pattern \
+                    or index.get("prune_roles", None) != self.prune_roles:
+                index = OrderedDict([("version", CACHE_FORMAT_VERSION), ("pattern", self.pattern),
+                                     ("prune_roles", self.prune_roles), ("roots", OrderedDict())])
+            self.index = index
+
+            return self.index
+
+    def save(self):
+
+        with self.lock:
+            if self.index is not None:
+                save_json_cache(self.name, self.index)
+                self.stamp = get_json_cache_stamp(self.name)
+
+    def reload(self):
+        """Loads the index again if another process wrote it since it was loaded (or saved) by this one.
+
+        Returns:
+          bool: whether the index was loaded again
+        """
+
+        with self.lock:
+            if self.index is None or get_json_cache_stamp(self.name) == self.stamp:
+                return False
+            self.index = None
+            self.load()
+            return True
+
+    def is_role(self, folder, dirs):
+
+        if "tasks" not in dirs and "meta" not in dirs:
+            return False
+        return any(os.path.isfile(os.path.join(folder, m)) for m in ANSIBLE_ROLE_MARKERS)
+
+    def scan_folder(self, folder, mtime):
+        """Lists a single folder.
+
+        Args:
+          folder (str): the folder path
+          mtime (float): the current mtime of the folder
+        Returns:
+          dict: the index entry for this folder, an empty one (without mtime) if the folder can't be listed
+        """
+
+        try:
+            entries = sorted(scandir(folder), key=lambda e: e.name)
+        except (OSError) as e:
+            # no mtime, so the folder is listed again next time
+            log.debug("Can't list folder '{}', ignoring it: {}".format(folder, e))
+            return {"mtime": None, "dirs": [], "markers": []}
+
+        dirs = []
+        markers = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except (OSError):
+                continue
+            if is_dir:
+                if entry.name not in self.exclude_dirs:
+                    dirs.append(entry.name)
+            elif fnmatch.fnmatch(entry.name, self.pattern):
+                markers.append(entry.name)
+
+        if self.prune_roles and self.is_role(folder, dirs):
+            log.debug("Not descending into Ansible role: {}".format(folder))
+            dirs = []
+
+        return {"mtime": mtime, "dirs": dirs, "markers": markers}
+
+    def get_markers(self, root):
+        """Returns the paths of all marker files under a root folder.
+
+        Several roots can be looked up concurrently, only updating the index is serialized.
+
+        Args:
+          root (str): the root folder
+        Returns:
+          list: a list of marker file paths, in walk order
+        """
+
+        index = self.load()
+
+        root = os.path.realpath(root)
+        with self.lock:
+            old_entries = index["roots"].get(root, {})
+
+        new_entries, markers, changed = self.walk(root, old_entries)
+
+        if changed or len(new_entries) != len(old_entries):
+            log.debug("Index '{}' changed for '{}', updating cache.".format(self.name, root))
+            with self.lock:
+                index["roots"][root] = new_entries
+                self.save()
+
+        return markers
+
+    def walk(self, root, old_entries):
+
+        new_entries = OrderedDict()
+        changed = False
+        visited = set()
+
+        markers = []
+        stack = [(root, 0)]
+        while stack:
+            folder, depth = stack.pop()
+            try:
+                stat = os.stat(folder)
+            except (OSError) as e:
+                log.debug("Can't access folder '{}', ignoring: {}".format(folder, e))
+                continue
+
+            if (stat.st_dev, stat.st_ino) in visited:
+                log.debug("Folder already visited (symlink loop?), ignoring: {}".format(folder))
+                continue
+            visited.add((stat.st_dev, stat.st_ino))
+
+            entry = old_entries.get(folder, None)
+            if entry is None or entry["mtime"] != stat.st_mtime:
+                entry = self.scan_folder(folder, stat.st_mtime)
+                changed = True
+
+            new_entries[folder] = entry
+            for m in entry["markers"]:
+                markers.append(os.path.join(folder, m))
+            if self.max_depth is not None and depth >= self.max_depth:
+                continue
+            for d in reversed(entry["dirs"]):
+                stack.append((os.path.join(folder, d), depth + 1))
+
+        return (new_entries, markers, changed)
+
+
+class PersistentLRUCache(object):
+    """A size-bound, least-recently-used cache that is persisted to disk.
+
+    Values need to be json-serializable in order to be persisted, values that are not are only kept
+    in memory. Values are stored and returned as deep copies, so callers are free to modify them.
+
+    Changes are only written to disk by :meth:`flush`, which should be called at the end of a phase that
+    adds values, and is called when the process exits.
+
+    Args:
+      name (str): the name of the cache file
+      max_size (int): the maximum number of items to keep
+    """
+
+    def __init__(self, name, max_size=256):
+
+        self.name = name
+        self.max_size = max_size
+        self.items = None
+        self.persistable = set()
+        self.dirty = False
+        self.stamp = None
+        self.lock = threading.RLock()
+        atexit.register(self.flush)
+
+    def load(self):
+
+        if self.items is not None:
+            return self.items
+
+        self.stamp = get_json_cache_stamp(self.name)
+        cache = load_json_cache(self.name, {})
+        self.items = OrderedDict()
+        if cache.get("version", None) == CACHE_FORMAT_VERSION:
+            for key, value in cache.get("items", []):
+                self.items[key] = value
+                self.persistable.add(key)
+
+        return self.items
+
+    def save(self):
+
+        items = [[key, value] for key, value in self.load().items() if key in self.persistable]
+        save_json_cache(self.name, OrderedDict([("version", CACHE_FORMAT_VERSION), ("items", items)]))
+        self.stamp = get_json_cache_stamp(self.name)
+
+    def reload(self):
+        """Loads the cache again if another process wrote it since it was loaded (or written) by this one.
+
+        Changes that were not written yet are discarded, so this should only be called after :meth:`flush`.
+
+        Returns:
+          bool: whether the cache was loaded again
+        """
+
+        with self.lock:
+            if self.items is None or get_json_cache_stamp(self.name) == self.stamp:
+                return False
+            self.items = None
+            self.persistable = set()
+            self.dirty = False
+            self.load()
+            return True
+
+    def get(self, key, default=None):
+
+        with self.lock:
+            items = self.load()
+            if key not in items:
+                return default
+
+            # mark as most recently used
+            value = items.pop(key)
+            items[key] = value
+            return copy.deepcopy(value)
+
+    def put(self, key, value):
+
+        with self.lock:
+            self._put(key, value)
+
+    def _put(self, key, value):
+
+        items = self.load()
+        items.pop(key, None)
+        items[key] = copy.deepcopy(value)
+
+        try:
+            # make sure we get the exact same thing back when loading the value from disk
+            persistable = json.loads(json.dumps(value), object_pairs_hook=OrderedDict) == value
+        except (TypeError, ValueError):
+            persistable = False
+        if persistable:
+            self.persistable.add(key)
+        else:
+            log.debug("Value for key '{}' can't be serialized, only caching it in memory.".format(key))
+            self.persistable.discard(key)
+
+        while len(items) > self.max_size:
+            old_key, _ = items.popitem(last=False)
+            self.persistable.discard(old_key)
+
+        self.dirty = True
+
+    def flush(self):
+        """Writes the cache to disk, if it changed since it was loaded or last written."""
+
+        with self.lock:
+            if not self.dirty:
+                return
+            self.save()
+            self.dirty = False
+
+
+class JsonFileCache(object):
+    """A cache that stores every (json-serializable) value in it's own file.
+
+    Meant for values that are too large to be rewritten together with all others (see :class:`PersistentLRUCache`).
+    Only the 'max_entries' most recently written values are kept.
+
+    Args:
+      name (str): the name of the cache folder
+      max_entries (int): the maximum number of values to keep
+    """
+
+    def __init__(self, name, max_entries=64):
+
+        self.name = name
+        self.max_entries = max_entries
+
+    def get_name(self, key):
+
+        return os.path.join(self.name, key)
+
+    def get(self, key, default=None):
+
+        value = load_json_cache(self.get_name(key), None)
+        if value is None or value.get("version", None) != CACHE_FORMAT_VERSION:
+            return default
+        return value["value"]
+
+    def put(self, key, value):
+        """Stores a value.
+
+        Returns:
+          bool: whether the value could be stored (it needs to survive a json roundtrip unchanged)
+        """
+
+        try:
+            if json.loads(json.dumps(value), object_pairs_hook=OrderedDict) != value:
+                log.debug("Value for key '{}' changes when serialized, not caching it.".format(key))
+                return False
+        except (TypeError, ValueError) as e:
+            log.debug("Value for key '{}' can't be serialized, not caching it: {}".format(key, e))
+            return False
+
+        save_json_cache(self.get_name(key), OrderedDict([("version", CACHE_FORMAT_VERSION), ("value", value)]))
+        self.prune()
+        return True
+
+    def prune(self):
+
+        cache_dir = get_cache_dir()
+        if cache_dir is None:
+            return
+        folder = os.path.join(cache_dir, self.name)
+
+        try:
+            files = [os.path.join(folder, f) for f in os.listdir(folder) if f.endswith(".json")]
+            files.sort(key=lambda f: os.stat(f).st_mtime, reverse=True)
+            for f in files[self.max_entries:]:
+                os.remove(f)
+        except (OSError) as e:
+            log.debug("Could not prune cache '{}', ignoring: {}".format(self.name, e))
+
+
+def hash_file(path, hasher=None):
+    """Calculates the sha1 hash of a files content.
+
+    Args:
+      path (str): the file
+      hasher (object): an (optional) existing hashlib object to update
+    Returns:
+      str: the hex digest
+    """
+
+    if hasher is None:
+        hasher = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+def hash_object(obj):
+    """Calculates a stable sha1 hash for a json-serializable object.
+
+    Args:
+      obj (object): the object
+    Returns:
+      str: the hex digest
+    """
+
+    content = json.dumps(obj, sort_keys=True, default=repr)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def hash_folder(path, exclude_dirs=None):
+    """Calculates the sha1 hash of the content of a folder (file names and file contents).
+
+    Args:
+      path (str): the folder
+      exclude_dirs (list): names of folders to ignore
+    Returns:
+      str: the hex digest
+    """
+
+    if exclude_dirs is None:
+        exclude_dirs = []
+
+    hasher = hashlib.sha1()
+    for root, dirnames, filenames in os.walk(path, topdown=True, followlinks=True):
+        dirnames[:] = sorted(d for d in dirnames if d not in exclude_dirs)
+        for filename in sorted(filenames):
+            file_path = os.path.join(root, filename)
+            hasher.update(repr(os.path.relpath(file_path, path)).encode("utf-8"))
+            hash_file(file_path, hasher=hasher)
+
+    return hasher.hexdigest()
+
+
+def copy_tree(source, target):
+    """Copies a folder tree, merging it into the target if that exists already.
+
+    Files are always copied (never hard-linked), so changing them in the target doesn't change the source.
+    Symlinks are recreated as symlinks.
+
+    Args:
+      source (str): the source folder
+      target (str): the target folder
+    """
+
+    for root, dirnames, filenames in os.walk(source):
+        target_root = os.path.join(target, os.path.relpath(root, source))
+        if not os.path.exists(target_root):
+            os.makedirs(target_root)
+            shutil.copystat(root, target_root)
+        for name in dirnames + filenames:
+            source_path = os.path.join(root, name)
+            target_path = os.path.join(target_root, name)
+            if os.path.islink(source_path):
+                if os.path.lexists(target_path):
+                    os.remove(target_path)
+                os.symlink(os.readlink(source_path), target_path)
+            elif name in filenames:
+                shutil.copy2(source_path, target_path)
+
+
+def get_cached_folder(name):
+    """Returns the path to a cached folder, or None if it (or the cache) doesn't exist.
+
+    Args:
+      name (str): the name of the folder within the cache
+    """
+
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return None
+
+    path = os.path.join(cache_dir, name)
+    if not os.path.isdir(path):
+        return None
+    return path
+
+
+def save_cached_folder(name, source):
+    """Atomically stores a copy of a folder in the cache.
+
+    Failing to write the cache is logged, but otherwise ignored.
+
+    Args:
+      name (str): the name of the folder within the cache
+      source (str): the folder to store
+    """
+
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return
+
+    path = os.path.join(cache_dir, name)
+    temp_path = None
+    try:
+        parent = os.path.dirname(path)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        temp_path = tempfile.mkdtemp(prefix=".{}.".format(os.path.basename(name)), dir=parent)
+        os.rmdir(temp_path)
+        shutil.copytree(source, temp_path, symlinks=True)
+        os.rename(temp_path, path)
+    except (Exception) as e:
+        log.debug("Could not store folder '{}' in cache, ignoring: {}".format(path, e))
+        if temp_path is not None and os.path.exists(temp_path):
+            shutil.rmtree(temp_path, ignore_errors=True)
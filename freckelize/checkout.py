@@ -0,0 +1,718 @@
+# -*- coding: utf-8 -*-
+
+"""Helpers to avoid unnecessary freckle checkouts."""
+
+from __future__ import absolute_import, division, print_function
+
+import contextlib
+import errno
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+
+try:
+    from os import scandir
+except (ImportError):
+    from scandir import scandir
+
+from six.moves.urllib.parse import urlparse
+from six.moves.urllib.request import urlopen
+
+from .cache import get_cache_dir, get_cache_file, hash_object
+
+log = logging.getLogger("freckles")
+
+LOCAL_HOSTS = ["localhost", "127.0.0.1", "::1"]
+FRECKLE_MARKER_FILE_NAME = ".freckle"
+FRECKLE_IGNORE_MARKER_FILE_NAME = ".ignore.freckle"
+FOLDER_FILES_KEY = "files"
+# repo types that can be downloaded before the checkout play, which then only has to copy them
+PREFETCH_REPO_TYPES = ["git", "remote_archive"]
+# default maximum number of freckle repos to download in parallel before the checkout play
+DEFAULT_CHECKOUT_WORKERS = 4
+# git must never wait for a password or passphrase while prefetching, if it needs one the checkout play clones the repo instead
+PREFETCH_GIT_ENV = {"GIT_TERMINAL_PROMPT": "0", "GIT_SSH_COMMAND": "ssh -o BatchMode=yes"}
+
+
+def is_local_host(host):
+    """Returns whether the host is the machine freckelize is running on."""
+
+    return host in LOCAL_HOSTS
+
+
+def get_inventory_hostname(host):
+    """Returns the name a host has in the inventory of a run, i.e. without protocol, user and port.
+
+    Args:
+      host (str): the host, as specified by the user (e.g. 'ssh://admin@example.com:2222')
+    Returns:
+      str: the inventory hostname
+    """
+
+    if "://" in host:
+        host = host.split("://", 1)[1]
+    if "@" in host:
+        host = host.split("@", 1)[1]
+    # more than one colon means an IPv6 address
+    if host.count(":") == 1:
+        host = host.split(":")[0]
+
+    return host
+
+
+def folder_fingerprint(path, exclude_dirs=None):
+    """Calculates a cheap fingerprint for the content of a freckle folder.
+
+    The fingerprint covers the mtimes of all folders (which change when files are added, removed or
+    renamed), and mtime and size of all '*.freckle' files. It does not read any file content.
+
+    Args:
+      path (str): the folder
+      exclude_dirs (list): names of folders to ignore
+    Returns:
+      str: the fingerprint, or None if the folder doesn't exist
+    """
+
+    if not os.path.isdir(path):
+        return None
+
+    if exclude_dirs is None:
+        exclude_dirs = []
+
+    hasher = hashlib.sha1()
+    for root, dirnames, filenames in os.walk(path, topdown=True, followlinks=True):
+        dirnames[:] = sorted(d for d in dirnames if d not in exclude_dirs)
+        rel_root = os.path.relpath(root, path)
+        hasher.update(repr(("d", rel_root, os.stat(root).st_mtime)).encode("utf-8"))
+        for filename in sorted(filenames):
+            if not filename.endswith(".freckle"):
+                continue
+            try:
+                stat = os.stat(os.path.join(root, filename))
+            except (OSError):
+                # broken symlink, most likely
+                continue
+            hasher.update(repr(("f", rel_root, filename, stat.st_mtime, stat.st_size)).encode("utf-8"))
+
+    return hasher.hexdigest()
+
+
+def git_output(args, cwd=None, env=None):
+    """Runs a git command, and returns its (stripped) output, or None if it failed."""
+
+    try:
+        with open(os.devnull, "w") as devnull:
+            output = subprocess.check_output(["git"] + args, cwd=cwd, stderr=devnull, env=env)
+    except (OSError, subprocess.CalledProcessError) as e:
+        log.debug("Git command 'git {}' failed: {}".format(" ".join(args), e))
+        return None
+
+    return output.decode("utf-8").strip()
+
+
+def get_checkout_path(repo_desc):
+    """Returns the local path of a freckle checkout."""
+
+    if repo_desc.get("checkout_skip", False):
+        return repo_desc["remote_url"]
+
+    return os.path.join(os.path.expanduser(repo_desc["local_parent"]), repo_desc["local_name"])
+
+
+@contextlib.contextmanager
+def prefetch_staging_dir():
+    """Context manager that provides the folder freckle repos are prefetched into.
+
+    Prefetched repos are kept in the freckelize cache folder, so later runs only have to update git clones.
+    If caching is disabled, a temporary folder is used, and deleted afterwards.
+    """
+
+    cache_dir = get_cache_dir()
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, "prefetch")
+        try:
+            if not os.path.exists(path):
+                os.makedirs(path)
+        except (OSError) as e:
+            log.debug("Can't create prefetch folder '{}', using temporary one: {}".format(path, e))
+        else:
+            yield path
+            return
+
+    temp_dir = tempfile.mkdtemp(prefix="freckelize_prefetch_")
+    try:
+        yield temp_dir
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def prefetch_repo(repo_desc, staging_dir):
+    """Downloads a remote freckle repo to the local machine, so the checkout play only has to copy it.
+
+    Git repositories are cloned into a folder named after the repo id (or, if a clone from an earlier
+    run exists there, updated), remote archives are downloaded into it. The returned repo description
+    points the checkout play to the local copy, everything else (target, filters, id, priority) stays
+    the same.
+
+    Args:
+      repo_desc (dict): the expanded repo description, as returned by :meth:`FreckleRepo.expand`
+      staging_dir (str): the folder to download repos into
+    Returns:
+      dict: the repo description of the local copy, or None if the repo can't be prefetched
+    """
+
+    repo_type = repo_desc.get("type", None)
+    if repo_type not in PREFETCH_REPO_TYPES or repo_desc.get("checkout_skip", False):
+        return None
+
+    path = os.path.join(staging_dir, repo_desc["id"])
+    local_desc = dict(repo_desc)
+    local_desc["source_delete"] = False
+
+    if repo_type == "git":
+        if not update_git_clone(repo_desc["remote_url"], path, branch=repo_desc.get("remote_branch", None)):
+            return None
+        local_desc["type"] = "local_folder"
+        local_desc["remote_url"] = path
+    else:
+        archive = download_archive(repo_desc["remote_url"], path)
+        if archive is None:
+            return None
+        local_desc["type"] = "local_archive"
+        local_desc["remote_url"] = archive
+
+    return local_desc
+
+
+def update_git_clone(url, path, branch=None):
+    """Makes sure a folder contains an up-to-date clone of a git repository.
+
+    An existing clone of the same url is updated (fast-forward only), in every other case the folder
+    is replaced with a new clone.
+
+    Args:
+      url (str): the url of the repository
+      path (str): the folder
+      branch (str): the branch to check out, defaults to the remote HEAD
+    Returns:
+      bool: whether the clone is up-to-date
+    """
+
+    env = dict(os.environ)
+    for key, value in PREFETCH_GIT_ENV.items():
+        env.setdefault(key, value)
+
+    if os.path.isdir(os.path.join(path, ".git")) and git_output(["config", "--get", "remote.origin.url"], cwd=path) == url:
+        current_branch = git_output(["rev-parse", "--abbrev-ref", "HEAD"], cwd=path)
+        if branch is None or branch == current_branch:
+            if git_output(["pull", "--ff-only", "--quiet"], cwd=path, env=env) is not None:
+                return True
+
+    if os.path.lexists(path):
+        shutil.rmtree(path, ignore_errors=True)
+
+    args = ["clone", "--quiet"]
+    if branch:
+        args.extend(["--branch", branch])
+    return git_output(args + [url, path], env=env) is not None
+
+
+def download_archive(url, path):
+    """Downloads a remote archive into a folder, keeping the file name of the url.
+
+    Args:
+      url (str): the url of the archive
+      path (str): the folder to download into
+    Returns:
+      str: the path to the downloaded archive, or None if the download failed
+    """
+
+    filename = os.path.basename(urlparse(url).path) or "archive"
+    target = os.path.join(path, filename)
+    temp_path = None
+    try:
+        if not os.path.exists(path):
+            os.makedirs(path)
+        fd, temp_path = tempfile.mkstemp(prefix=".download.", dir=path)
+        with os.fdopen(fd, "wb") as f:
+            response = urlopen(url)
+            try:
+                shutil.copyfileobj(response, f)
+            finally:
+                response.close()
+        os.rename(temp_path, target)
+    except (Exception) as e:
+        log.debug("Can't download archive '{}': {}".format(url, e))
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+        return None
+
+    return target
+
+
+def repo_fingerprint(repo_desc, exclude_dirs=None):
+    """Calculates the fingerprint of a freckle repo on the local machine.
+
+    Only local folders that don't need to be copied, and git repositories are supported. Local folders
+    are fingerprinted with the same walk the native scan uses (see :func:`walk_local_freckle`). For
+    git repositories, the fingerprint includes the local HEAD and the current remote ref, which means
+    it'll only match if the remote didn't change since the last checkout.
+
+    Args:
+      repo_desc (dict): the expanded repo description, as returned by :meth:`FreckleRepo.expand`
+      exclude_dirs (list): names of folders to ignore
+    Returns:
+      str: the fingerprint, or None if the repo can't be fingerprinted
+    """
+
+    repo_type = repo_desc.get("type", None)
+
+    if repo_type == "local_folder" and repo_desc.get("checkout_skip", False):
+        try:
+            return walk_local_freckle(repo_desc, exclude_dirs=exclude_dirs)[2]
+        except (OSError) as e:
+            log.debug("Can't fingerprint local freckle folder '{}': {}".format(repo_desc["remote_url"], e))
+            return None
+
+    if repo_type == "git":
+        path = get_checkout_path(repo_desc)
+        if not os.path.isdir(os.path.join(path, ".git")):
+            return None
+        head = git_output(["rev-parse", "HEAD"], cwd=path)
+        if not head:
+            return None
+        remote_refs = git_output(["ls-remote", repo_desc["remote_url"], repo_desc.get("remote_branch", "HEAD")])
+        if not remote_refs:
+            return None
+        remote_ref = remote_refs.splitlines()[0].split()[0]
+        if remote_ref != head:
+            return None
+        tree = folder_fingerprint(path, exclude_dirs=exclude_dirs)
+        return "{}-{}".format(head, tree)
+
+    return None
+
+
+class CheckoutState(object):
+    """Records fingerprints and checkout metadata of freckle repos, to be able to skip unchanged ones.
+
+    State is stored per repo id (which is stable across runs, see :func:`freckelize.freckelize.get_repo_id`),
+    so a newer checkout of a repo replaces the older one. The metadata of each repo is stored as newline-delimited
+    json: a header line containing the fingerprint and the hash of the repo description, followed by one line per
+    folder. That way it can be written and read one folder at a time.
+
+    Args:
+      exclude_dirs (list): names of folders to ignore when fingerprinting folders
+    """
+
+    def __init__(self, exclude_dirs=None):
+
+        self.exclude_dirs = exclude_dirs
+
+    def get_desc_hash(self, repo_desc):
+        """Returns the hash of a repo description, to detect whether stored state was created with different settings.
+
+        The run-specific priority is not part of the hash.
+        """
+
+        desc = dict((k, v) for k, v in repo_desc.items() if k != "priority")
+        return hash_object(desc)
+
+    def get_state_file(self, repo_desc):
+
+        return get_cache_file(os.path.join("checkout", repo_desc["id"]), extension="jsonl")
+
+    def get_cached_metadata(self, repo_desc, fingerprint=None):
+        """Returns the checkout metadata of the last run, if the repo didn't change since then.
+
+        The 'parent_repo_id' and 'repo_priority' values of the returned folders are adjusted to the
+        current repo.
+
+        Args:
+          repo_desc (dict): the expanded repo description
+          fingerprint (str): the current fingerprint of the repo, calculated if not provided
+        Returns:
+          iterator: the folders metadata, or None if the repo changed (or was never checked out)
+        """
+
+        path = self.get_state_file(repo_desc)
+        if path is None or not os.path.exists(path):
+            return None
+
+        try:
+            with io.open(path, encoding="utf-8") as f:
+                header = json.loads(f.readline())
+        except (Exception) as e:
+            log.debug("Can't read checkout state '{}', ignoring: {}".format(path, e))
+            return None
+
+        if header.get("desc", None) != self.get_desc_hash(repo_desc):
+            return None
+
+        if fingerprint is None:
+            fingerprint = repo_fingerprint(repo_desc, exclude_dirs=self.exclude_dirs)
+        if fingerprint is None or fingerprint != header.get("fingerprint", None):
+            return None
+
+        return self.read_state_file(path, repo_desc)
+
+    def read_state_file(self, path, repo_desc):
+
+        folders = iter_metadata_file(path)
+        # skip header
+        next(folders)
+        for folder in folders:
+            folder["parent_repo_id"] = repo_desc["id"]
+            folder["repo_priority"] = repo_desc["priority"] + folder.pop("repo_priority_offset", 0)
+            yield folder
+
+    def record(self, repo_descs, folders, fingerprints=None):
+        """Stores the checkout metadata of repos, alongside their current fingerprint.
+
+        This passes through all folders, and writes the ones belonging to one of the provided repos
+        to disk as they are consumed. State files are only replaced once all folders are consumed.
+
+        Args:
+          repo_descs (list): the expanded repo descriptions
+          folders (iterator): the folders metadata, as created by the checkout run
+          fingerprints (dict): already calculated fingerprints, with the repo id as key
+        Returns:
+          iterator: the unchanged folders metadata
+        """
+
+        if fingerprints is None:
+            fingerprints = {}
+
+        writers = {}
+        try:
+            for repo_desc in repo_descs:
+                fingerprint = fingerprints.get(repo_desc["id"], None)
+                if fingerprint is None:
+                    fingerprint = repo_fingerprint(repo_desc, exclude_dirs=self.exclude_dirs)
+                path = self.get_state_file(repo_desc)
+                if fingerprint is None or path is None:
+                    continue
+                if not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                fd, temp_path = tempfile.mkstemp(prefix=".checkout.", dir=os.path.dirname(path))
+                f = os.fdopen(fd, "w")
+                f.write(json.dumps({"fingerprint": fingerprint, "desc": self.get_desc_hash(repo_desc)}))
+                f.write("\n")
+                writers[repo_desc["id"]] = (repo_desc, f, temp_path, path)
+        except (IOError, OSError) as e:
+            log.debug("Can't write checkout state, ignoring: {}".format(e))
+
+        completed = False
+        try:
+            for folder in folders:
+                writer = writers.get(folder.get("parent_repo_id", None), None)
+                if writer is not None:
+                    stored = dict((k, v) for k, v in folder.items() if k not in ["parent_repo_id", "repo_priority"])
+                    priority = folder.get("repo_priority", None)
+                    if isinstance(priority, int):
+                        stored["repo_priority_offset"] = priority - writer[0]["priority"]
+                    writer[1].write(json.dumps(stored))
+                    writer[1].write("\n")
+                yield folder
+            completed = True
+        finally:
+            for repo_desc, f, temp_path, path in writers.values():
+                f.close()
+                if completed:
+                    os.rename(temp_path, path)
+                else:
+                    os.remove(temp_path)
+
+    def update(self, repo_desc, folders):
+        """Stores the checkout metadata of a single repo.
+
+        Args:
+          repo_desc (dict): the expanded repo description
+          folders (list): the folders metadata of this repo
+        """
+
+        for folder in self.record([repo_desc], folders):
+            pass
+
+
+def iter_metadata_file(path, chunk_size=65536):
+    """Reads folder metadata records from a file, one at a time.
+
+    Supports files containing either a single json list, or one json object per line.
+
+    Args:
+      path (str): the metadata file
+      chunk_size (int): how much to read at once when parsing a json list
+    Returns:
+      iterator: the records
+    """
+
+    decoder = json.JSONDecoder()
+    with io.open(path, encoding="utf-8") as f:
+        buf = f.read(chunk_size)
+        stripped = buf.lstrip()
+        if not stripped.startswith("["):
+            while True:
+                lines = buf.split("\n")
+                buf = lines.pop()
+                for line in lines:
+                    if line.strip():
+                        yield json.loads(line)
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                buf = buf + chunk
+            if buf.strip():
+                yield json.loads(buf)
+            return
+
+        buf = stripped[1:]
+        eof = False
+        while True:
+            buf = buf.lstrip().lstrip(",").lstrip()
+            if buf.startswith("]"):
+                return
+            if buf:
+                try:
+                    record, end = decoder.raw_decode(buf)
+                except (ValueError):
+                    if eof:
+                        raise
+                else:
+                    buf = buf[end:]
+                    yield record
+                    continue
+            elif eof:
+                raise ValueError("Unexpected end of metadata file: {}".format(path))
+
+            # read at least as much as we have buffered, to not re-parse big records too often
+            chunk = f.read(max(chunk_size, len(buf)))
+            if not chunk:
+                eof = True
+            buf = buf + chunk
+
+
+def list_folder(path):
+    """Lists a folder, returning a tuple of (sub-folder names, file names), both sorted."""
+
+    dirs = []
+    files = []
+    for entry in scandir(path):
+        try:
+            if entry.is_dir():
+                dirs.append(entry.name)
+            else:
+                files.append(entry.name)
+        except (OSError):
+            # broken symlink
+            files.append(entry.name)
+
+    return (sorted(dirs), sorted(files))
+
+
+def matches_filters(path, include, exclude):
+    """Checks whether a freckle folder should be used, according to 'include' and 'exclude' filters.
+
+    Filters are matched against the end of the path, 'exclude' takes precedence over 'include'.
+    """
+
+    path = path.rstrip(os.path.sep)
+    for e in exclude:
+        if path.endswith(e.rstrip(os.path.sep)):
+            return False
+
+    if not include:
+        return True
+
+    for i in include:
+        if path.endswith(i.rstrip(os.path.sep)):
+            return True
+
+    return False
+
+
+def scan_local_freckle(repo_desc, content_key, exclude_dirs=None, tree=None):
+    """Reads the metadata of a local freckle folder, without using Ansible.
+
+    This creates the same folder records the 'freckles_checkout' play writes to its 'repo_metadata' file,
+    and can be used for 'local_folder' repos that don't need to be copied.
+
+    A folder is a freckle folder if it contains a '.freckle' file. The root folder is always a freckle
+    folder, unless it has no '.freckle' file but sub-folders have. Folders containing an '.ignore.freckle'
+    file (and everything below them) are never freckle folders. Files matching '.*.freckle' are read as
+    extra vars of the freckle folder they belong to. Like in the checkout play, metadata that contains
+    jinja templates is not used.
+
+    The folder structure is read (and checked for readability) before this function returns, unless it is
+    provided. File contents are read one freckle folder at a time, while iterating over the result.
+
+    Args:
+      repo_desc (dict): the expanded repo description, as returned by :meth:`FreckleRepo.expand`
+      content_key (str): the key to store the content of a '.freckle' file under
+      exclude_dirs (list): names of folders to ignore
+      tree (tuple): the result of :func:`walk_local_freckle` for this repo, if already available
+    Returns:
+      iterator: the folder metadata dicts
+    Raises:
+      OSError: if a folder or metadata file can't be read (in which case the checkout play should be used)
+    """
+
+    if exclude_dirs is None:
+        exclude_dirs = []
+
+    if tree is None:
+        tree = walk_local_freckle(repo_desc, exclude_dirs=exclude_dirs)
+    (freckle_folders, folder_files, fingerprint) = tree
+
+    return read_local_freckle_folders(repo_desc, content_key, freckle_folders, dict(folder_files), exclude_dirs)
+
+
+def walk_local_freckle(repo_desc, exclude_dirs=None):
+    """Walks a local freckle folder once, to find its freckle folders and calculate its fingerprint.
+
+    The fingerprint covers the mtimes of all folders (which change when files are added, removed or
+    renamed), and mtime and size of all metadata files. It does not read any file content, so it can be
+    compared against the fingerprint of an earlier checkout before the metadata is read.
+
+    Args:
+      repo_desc (dict): the expanded repo description
+      exclude_dirs (list): names of folders to ignore
+    Returns:
+      tuple: a tuple of the form (freckle_folders, folder_files, fingerprint); folder_files maps each freckle folder to the files that belong to it
+    Raises:
+      OSError: if a folder or metadata file can't be read
+    """
+
+    if exclude_dirs is None:
+        exclude_dirs = []
+
+    root = repo_desc["remote_url"]
+
+    freckle_folders = []
+    folder_files = {}
+    hasher = hashlib.sha1()
+    visited = set()
+    stack = [(root, None, False)]
+    while stack:
+        folder, parent_freckle, ignored = stack.pop()
+        stat = os.stat(folder)
+        if (stat.st_dev, stat.st_ino) in visited:
+            log.debug("Symlink cycle detected, not descending into: {}".format(folder))
+            continue
+        visited.add((stat.st_dev, stat.st_ino))
+
+        dirs, files = list_folder(folder)
+        rel_folder = os.path.relpath(folder, root)
+        hasher.update(repr(("d", rel_folder, stat.st_mtime)).encode("utf-8"))
+
+        if FRECKLE_IGNORE_MARKER_FILE_NAME in files and parent_freckle is not None:
+            ignored = True
+        if not ignored and (FRECKLE_MARKER_FILE_NAME in files or parent_freckle is None):
+            if parent_freckle is not None and repo_desc.get("non_recursive", False):
+                continue
+            freckle_folders.append(folder)
+            parent_freckle = folder
+
+        for f in files:
+            if not is_metadata_file(f):
+                continue
+            path = os.path.join(folder, f)
+            if not os.access(path, os.R_OK):
+                raise OSError(errno.EACCES, "Can't read freckle metadata file", path)
+            file_stat = os.stat(path)
+            hasher.update(repr(("f", rel_folder, f, file_stat.st_mtime, file_stat.st_size)).encode("utf-8"))
+
+        folder_files.setdefault(parent_freckle, []).extend(os.path.join(folder, f) for f in files)
+        for d in reversed(dirs):
+            if d not in exclude_dirs:
+                stack.append((os.path.join(folder, d), parent_freckle, ignored))
+
+    if len(freckle_folders) > 1 and not os.path.exists(os.path.join(root, FRECKLE_MARKER_FILE_NAME)):
+        # root folder is only a container for the child freckles
+        folder_files.pop(root, None)
+        freckle_folders.remove(root)
+
+    return (freckle_folders, folder_files, hasher.hexdigest())
+
+
+def is_metadata_file(filename):
+    """Returns whether a file is read by the native scan (a '.freckle' file, or an extra vars file)."""
+
+    return filename.startswith(".") and filename.endswith(".freckle")
+
+
+def read_local_freckle_folders(repo_desc, content_key, freckle_folders, folder_files, exclude_dirs):
+
+    include = repo_desc.get("include", None) or []
+    exclude = repo_desc.get("exclude", None) or []
+
+    for folder in freckle_folders:
+        files_in_folder = folder_files.pop(folder, [])
+        if not matches_filters(folder, include, exclude):
+            continue
+
+        metadata = {
+            "full_path": folder,
+            "folder_name": os.path.basename(folder),
+            "parent_repo_id": repo_desc["id"],
+            "repo_priority": repo_desc["priority"]
+        }
+
+        marker_file = os.path.join(folder, FRECKLE_MARKER_FILE_NAME)
+        if os.path.exists(marker_file):
+            content = read_text_file(marker_file)
+            # templates in metadata would just be confusing
+            if "{{" not in content:
+                metadata[content_key] = content
+
+        extra_vars = {}
+        for f in files_in_folder:
+            filename = os.path.basename(f)
+            if filename in [FRECKLE_MARKER_FILE_NAME, FRECKLE_IGNORE_MARKER_FILE_NAME] or not is_metadata_file(filename):
+                continue
+            content = read_text_file(f)
+            if "{{" in content:
+                log.debug("Extra vars file contains template, ignoring it: {}".format(f))
+                continue
+            extra_vars[os.path.relpath(f, folder)] = content
+
+        metadata["extra_vars"] = extra_vars
+        if repo_desc.get("add_file_list", False):
+            metadata[FOLDER_FILES_KEY] = list_freckle_files(folder, exclude_dirs=exclude_dirs)
+
+        yield metadata
+
+
+def list_freckle_files(path, exclude_dirs=None):
+    """Lists all files below a freckle folder, in the same format the 'freckles_checkout' play uses.
+
+    Paths are absolute, files in child freckle folders are included, and jinja delimiters in file names
+    are escaped.
+
+    Args:
+      path (str): the freckle folder
+      exclude_dirs (list): names of folders to ignore
+    Returns:
+      list: the file paths
+    """
+
+    if exclude_dirs is None:
+        exclude_dirs = []
+
+    result = []
+    for root, dirnames, filenames in os.walk(path, topdown=True):
+        dirnames[:] = [d for d in dirnames if d not in exclude_dirs]
+        result.extend(os.path.join(root, f).replace("{{", "\\{\\{").replace("}}", "\\}\\}") for f in filenames)
+
+    return result
+
+
+def read_text_file(path):
+
+    with io.open(path, encoding="utf-8") as f:
+        return f.read()
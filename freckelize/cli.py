@@ -4,27 +4,30 @@
 from __future__ import absolute_import, division, print_function
 
 import logging
+import os
 import sys
 from collections import OrderedDict
 
-import click_completion
+import click
 import click_log
-from frkl import frkl
-from luci import vars_file, readable_json
 
-from freckles.freckles_base_cli import FrecklesBaseCommand
-from freckles.freckles_defaults import *
-from freckles.utils import DEFAULT_FRECKLES_CONFIG, RepoType
 from . import print_version
-from .freckelize import FreckleDetails, FreckleRepo, Freckelize
+from .checkout import DEFAULT_CHECKOUT_WORKERS
+from .connection import DEFAULT_FRECKELIZE_FORKS
+from .environments import DEFAULT_KEEP_RUN_ENVIRONMENTS
+from .metadata import DEFAULT_MERGE_POOL_THRESHOLD
+from .timings import PhaseTimings
 # from .freckle_detect import create_freckle_descs
-from .utils import FreckelizeAdapterReader, FreckelizeAdapterFinder
 
 log = logging.getLogger("freckles")
 click_log.basic_config(log)
 
-# optional shell completion
-click_completion.init()
+COMPLETION_ENV_VAR_NAME = "_FRECKELIZE_COMPLETE"
+
+# optional shell completion, only loaded when actually completing
+if COMPLETION_ENV_VAR_NAME in os.environ.keys():
+    import click_completion
+    click_completion.init()
 
 # TODO: this is a bit ugly, probably have refactor how role repos are used
 # nsbl.defaults.DEFAULT_ROLES_PATH = os.path.join(os.path.dirname(__file__), "external", "default_role_repo")
@@ -48,200 +51,71 @@ EXCLUDE_ARG_METAVAR = 'FILTER_STRING'
 ASK_PW_HELP = 'whether to force ask for a password, force ask not to, or let freckles decide (which might not always work)'
 ASK_PW_CHOICES = click.Choice(["auto", "true", "false"])
 NON_RECURSIVE_HELP = "whether to exclude all freckle child folders, default: false"
+FORKS_HELP = "maximum number of hosts Ansible processes in parallel, default: {}".format(DEFAULT_FRECKELIZE_FORKS)
+FORKS_METAVAR = "NUMBER"
+CHECKOUT_WORKERS_HELP = "maximum number of git repos and remote archives to download in parallel before the checkout run, default: {}".format(DEFAULT_CHECKOUT_WORKERS)
+PARALLEL_MERGE_THRESHOLD_HELP = "minimum number of freckle folders to merge their metadata in parallel processes, 0 to disable, default: {}".format(DEFAULT_MERGE_POOL_THRESHOLD)
+REUSE_PLAN_HELP = "reuse the run plan of an earlier, identical invocation if none of the freckle repos or adapters changed (only for local runs)"
+SHARED_CONNECTION_HELP = "share ssh connections and gathered facts between the checkout and the processing run, and only prepare each host once"
+KEEP_ENVIRONMENTS_HELP = "delete older Ansible run environments (including their logs) for the same host and freckles, keeping only the newest ones, default: keep all"
+PROFILE_TIMINGS_HELP = "print how long each phase of the run took"
+PROFILE_TIMINGS_FILE_HELP = "write phase timings to a file"
+PROFILE_TIMINGS_FORMAT_HELP = "format of the phase timings file, default: json"
+INCREMENTAL_HELP = "skip the checkout of freckle repos that didn't change since the last run (local host only), default: false"
+
+class FreckelizeCommand(click.MultiCommand):
+    """Class to build the freckelize command-line interface.
+
+    This only proxies the freckles-backed command (see :class:`freckelize.command.FreckelizeAdapterCommand`), which,
+    together with the freckles config it needs, is only created once the options or adapters of the command are used.
+    That way importing this module doesn't load freckles, nsbl or Ansible.
+    """
+
+    def __init__(self, print_version_callback=print_version, **kwargs):
+
+        super(FreckelizeCommand, self).__init__(**kwargs)
+        self.print_version_callback = print_version_callback
+        self.command_kwargs = kwargs
+        self.command = None
+
+    def get_freckles_command(self):
+
+        if self.command is None:
+            from .command import FreckelizeAdapterCommand
+            self.command = FreckelizeAdapterCommand(print_version_callback=self.print_version_callback, **self.command_kwargs)
+
+        return self.command
+
+    def make_context(self, info_name, args, parent=None, **extra):
+
+        return self.get_freckles_command().make_context(info_name, args, parent=parent, **extra)
+
+    def get_params(self, ctx):
+
+        return self.get_freckles_command().get_params(ctx)
+
+    def list_commands(self, ctx):
+
+        return self.get_freckles_command().list_commands(ctx)
+
+    def get_command(self, ctx, name):
+
+        return self.get_freckles_command().get_command(ctx, name)
+
+    def invoke(self, ctx):
+
+        return self.get_freckles_command().invoke(ctx)
 
-DEFAULT_FRECKELIZE_ROLES_PATH = os.path.join(os.path.dirname(__file__), "external", "roles")
-DEFAULT_FRECKELIZE_ADAPTERS_PATH = os.path.join(os.path.dirname(__file__), "external", "adapters")
-DEFAULT_FRECKELIZE_BLUEPRINTS_PATH = os.path.join(os.path.dirname(__file__), "external", "blueprints")
-DEFAULT_USER_ADAPTERS_PATH = os.path.join(os.path.expanduser("~"), ".freckles", "frecklecutables")
-
-class FreckelizeCommand(FrecklesBaseCommand):
-    """Class to build the frecklecute command-line interface."""
-
-    FRECKELIZE_ARGS = [(
-        "freckle", {
-            "required": False,
-            "alias": "freckle",
-            "doc": {
-                "help": FRECKLE_ARG_HELP
-            },
-            "click": {
-                "option": {
-                    "multiple": True,
-                    "param_decls": ["--freckle", "-f"],
-                    "type": RepoType(),
-                    "metavar": FRECKLE_ARG_METAVAR
-                }
-            }
-        }),
-        ("profile_extra_vars", {
-            "alias": "vars",
-            "required": False,
-            "type": list,
-            "doc": {
-                "help": VARS_ARG_HELP
-            },
-            "click": {
-                "option": {
-                    "metavar": VARS_ARG_METAVAR,
-                    "multiple": True,
-                    "type": vars_file
-                }
-            }
-        }),
-        ("target_folder", {
-            "alias": "target-folder",
-            "required": False,
-            # "default": "~/freckles",
-            "type": str,
-            "doc": {
-                "help": TARGET_ARG_HELP
-            },
-            "click": {
-                "option": {
-                    "param_decls": ["--target-folder", "-t"],
-                    "metavar": TARGET_ARG_METAVAR
-                }
-            }
-        }),
-        ("target_name", {
-            "alias": "target-name",
-            "required": False,
-            "type": str,
-            "doc": {
-                "help": TARGET_NAME_ARG_HELP
-            },
-            "click": {
-                "option": {
-                    "metavar": TARGET_NAME_ARG_METAVAR
-                }
-            }
-        }),
-        ("include", {
-            "alias": "include",
-            "required": False,
-            "doc": {
-                "help": INCLUDE_ARG_HELP
-            },
-            "click": {
-                "option": {
-                    "param_decls": ["--include", "-i"],
-                    "multiple": True,
-                    "metavar": INCLUDE_ARG_METAVAR
-                }
-            }
-        }),
-        ("exclude", {
-            "alias": "exclude",
-            "required": False,
-            "doc": {
-                "help": EXCLUDE_ARG_HELP
-            },
-            "click": {
-                "option": {
-                    "param_decls": ["--exclude", "-e"],
-                    "multiple": True,
-                    "metavar": EXCLUDE_ARG_METAVAR
-                }
-            }
-        }),
-        # ("ask_become_pass", {
-        #     "alias": "ask-become-pass",
-        #     "doc": {
-        #         "help": ASK_PW_HELP
-        #     },
-        #     "click": {
-        #         "option": {
-        #             "param_decls": ["--ask-become-pass", "-pw"],
-        #             "type": ASK_PW_CHOICES
-        #         }
-        #     }
-        # }),
-        ("non_recursive", {
-            "alias": "non-recursive",
-            "type": bool,
-            "required": False,
-            "default": False,
-            "doc": {
-                "help": NON_RECURSIVE_HELP
-            },
-            "click": {
-                "option": {
-                    "is_flag": True
-                }
-            }
-        })
-    ]
-
-    @staticmethod
-    def freckelize_extra_params():
-
-        freckle_option = click.Option(param_decls=["--freckle", "-f"], required=False, multiple=True, type=RepoType(),
-                                  metavar=FRECKLE_ARG_METAVAR, help=FRECKLE_ARG_HELP)
-        target_option = click.Option(param_decls=["--target-folder", "-t"], required=False, multiple=False, type=str,
-                                     metavar=TARGET_ARG_METAVAR,
-                                     help=TARGET_ARG_HELP)
-        target_name_option = click.Option(param_decls=["--target-name"], required=False, multiple=False, type=str,
-                                     metavar=TARGET_NAME_ARG_METAVAR,
-                                     help=TARGET_NAME_ARG_HELP)
-        include_option = click.Option(param_decls=["--include", "-i"],
-                                      help=INCLUDE_ARG_HELP,
-                                      type=str, metavar=INCLUDE_ARG_METAVAR, default=[], multiple=True)
-        exclude_option = click.Option(param_decls=["--exclude", "-e"],
-                                      help=EXCLUDE_ARG_HELP,
-                                      type=str, metavar=EXCLUDE_ARG_METAVAR, default=[], multiple=True)
-        parent_only_option = click.Option(param_decls=["--non-recursive"],
-                                          help=NON_RECURSIVE_HELP,
-                                          is_flag=True,
-                                          default=False,
-                                          required=False,
-                                          type=bool
-        )
-
-        params = [freckle_option, target_option, target_name_option, include_option, exclude_option,
-                           parent_only_option]
-
-        return params
-
-
-    def __init__(self, extra_params=None, print_version_callback=print_version, **kwargs):
-
-        config = DEFAULT_FRECKLES_CONFIG
-        config.add_repo(DEFAULT_FRECKELIZE_ROLES_PATH)
-        config.add_repo(DEFAULT_FRECKELIZE_ADAPTERS_PATH)
-        config.add_repo(DEFAULT_FRECKELIZE_BLUEPRINTS_PATH)
-        config.add_user_repo(DEFAULT_USER_ADAPTERS_PATH)
-
-        extra_params = FreckelizeCommand.freckelize_extra_params()
-        super(FreckelizeCommand, self).__init__(config=config, extra_params=extra_params, print_version_callback=print_version_callback, **kwargs)
-        self.config = DEFAULT_FRECKLES_CONFIG
-        self.reader = FreckelizeAdapterReader()
-        self.finder = None
-
-    def get_dictlet_finder(self):
-
-        if self.finder is None:
-            # need to wait for paths to be initialized
-            self.finder =  FreckelizeAdapterFinder(self.paths)
-
-        return self.finder
-
-    def get_dictlet_reader(self):
-
-        return self.reader
-
-    def get_additional_args(self):
-
-        return OrderedDict(FreckelizeCommand.FRECKELIZE_ARGS)
-
-    def freckles_process(self, command_name, default_vars, extra_vars, user_input, metadata, dictlet_details, config, parent_params, command_var_spec):
-
-        result = {"name": command_name, "default_vars": default_vars, "extra_vars": extra_vars, "user_input": user_input, "adapter_metadata": metadata, "adapter_details": dictlet_details}
-
-        return result
 
 
 def assemble_freckelize_run(*args, **kwargs):
 
+    # only needed for an actual run, so imported late to keep '--help' and friends fast
+    from frkl import frkl
+    from luci import readable_json
+    from freckles.freckles_defaults import DEFAULT_FRECKLE_TARGET_MARKER
+    from .freckelize import FreckleDetails, FreckleRepo, Freckelize
+
     no_run = kwargs.get("no_run")
     hosts = list(kwargs["host"])
     if not hosts:
@@ -257,6 +131,25 @@ def assemble_freckelize_run(*args, **kwargs):
     default_exclude = list(kwargs.get("exclude", []))
 
     default_password = kwargs.get("password", None)
+    incremental = kwargs.get("incremental", False)
+    reuse_plan = kwargs.get("reuse_plan", False)
+    keep_environments = kwargs.get("keep_environments", None)
+    if keep_environments is None:
+        keep_environments = DEFAULT_KEEP_RUN_ENVIRONMENTS
+    shared_connection = kwargs.get("shared_connection", False)
+    profile_timings = kwargs.get("profile_timings", False)
+    profile_timings_file = kwargs.get("profile_timings_file", None)
+    profile_timings_format = kwargs.get("profile_timings_format", None) or "json"
+    timings = PhaseTimings(enabled=profile_timings or bool(profile_timings_file))
+    checkout_workers = kwargs.get("checkout_workers", None)
+    if checkout_workers is None:
+        checkout_workers = DEFAULT_CHECKOUT_WORKERS
+    merge_pool_threshold = kwargs.get("parallel_merge_threshold", None)
+    if merge_pool_threshold is None:
+        merge_pool_threshold = DEFAULT_MERGE_POOL_THRESHOLD
+    forks = kwargs.get("forks", None)
+    if forks is None:
+        forks = DEFAULT_FRECKELIZE_FORKS
     default_non_recursive = kwargs.get("non_recursive", None)
 
     default_extra_vars_list = list(kwargs.get("vars", []))
@@ -384,10 +277,15 @@ def assemble_freckelize_run(*args, **kwargs):
         raise click.ClickException("Can't process password: {}".format(default_password))
 
     try:
-        f = Freckelize(freckle_details, ask_become_pass=default_password, password=password)
-        f.execute(hosts=hosts, no_run=no_run, output_format=default_output_format)
+        f = Freckelize(freckle_details, ask_become_pass=default_password, password=password, incremental=incremental, checkout_workers=checkout_workers, timings=timings, merge_pool_threshold=merge_pool_threshold, reuse_plan=reuse_plan, keep_environments=keep_environments, shared_connection=shared_connection)
+        f.execute(hosts=hosts, no_run=no_run, output_format=default_output_format, forks=forks)
     except (Exception) as e:
         raise click.ClickException(str(e))
+    finally:
+        if profile_timings:
+            timings.print_summary()
+        if profile_timings_file:
+            timings.write(profile_timings_file, output_format=profile_timings_format)
 
     sys.exit(0)
 
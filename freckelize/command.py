@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+"""The freckles-backed freckelize command, only imported once the command-line interface actually needs it."""
+from __future__ import absolute_import, division, print_function
+
+import logging
+import os
+from collections import OrderedDict
+
+import click
+from luci import vars_file
+
+from freckles.freckles_base_cli import FrecklesBaseCommand
+from freckles.utils import DEFAULT_FRECKLES_CONFIG, RepoType
+from . import print_version
+from .checkout import DEFAULT_CHECKOUT_WORKERS
+from .cli import FRECKLE_ARG_HELP, FRECKLE_ARG_METAVAR, VARS_ARG_HELP, VARS_ARG_METAVAR, TARGET_ARG_HELP, \
+    TARGET_ARG_METAVAR, TARGET_NAME_ARG_HELP, TARGET_NAME_ARG_METAVAR, INCLUDE_ARG_HELP, INCLUDE_ARG_METAVAR, \
+    EXCLUDE_ARG_HELP, EXCLUDE_ARG_METAVAR, NON_RECURSIVE_HELP, FORKS_HELP, FORKS_METAVAR, CHECKOUT_WORKERS_HELP, \
+    PARALLEL_MERGE_THRESHOLD_HELP, INCREMENTAL_HELP, REUSE_PLAN_HELP, KEEP_ENVIRONMENTS_HELP, SHARED_CONNECTION_HELP, \
+    PROFILE_TIMINGS_HELP, PROFILE_TIMINGS_FILE_HELP, PROFILE_TIMINGS_FORMAT_HELP
+from .connection import DEFAULT_FRECKELIZE_FORKS
+from .environments import DEFAULT_KEEP_RUN_ENVIRONMENTS
+from .metadata import DEFAULT_MERGE_POOL_THRESHOLD
+from .timings import TIMINGS_FORMATS
+from .utils import FreckelizeAdapterReader, FreckelizeAdapterFinder
+
+log = logging.getLogger("freckles")
+
+DEFAULT_FRECKELIZE_ROLES_PATH = os.path.join(os.path.dirname(__file__), "external", "roles")
+DEFAULT_FRECKELIZE_ADAPTERS_PATH = os.path.join(os.path.dirname(__file__), "external", "adapters")
+DEFAULT_FRECKELIZE_BLUEPRINTS_PATH = os.path.join(os.path.dirname(__file__), "external", "blueprints")
+DEFAULT_USER_ADAPTERS_PATH = os.path.join(os.path.expanduser("~"), ".freckles", "frecklecutables")
+
+class FreckelizeAdapterCommand(FrecklesBaseCommand):
+    """Class to build the freckles-backed part of the freckelize command-line interface (adapters and their options)."""
+
+    FRECKELIZE_ARGS = [(
+        "freckle", {
+            "required": False,
+            "alias": "freckle",
+            "doc": {
+                "help": FRECKLE_ARG_HELP
+            },
+            "click": {
+                "option": {
+                    "multiple": True,
+                    "param_decls": ["--freckle", "-f"],
+                    "type": RepoType(),
+                    "metavar": FRECKLE_ARG_METAVAR
+                }
+            }
+        }),
+        ("profile_extra_vars", {
+            "alias": "vars",
+            "required": False,
+            "type": list,
+            "doc": {
+                "help": VARS_ARG_HELP
+            },
+            "click": {
+                "option": {
+                    "metavar": VARS_ARG_METAVAR,
+                    "multiple": True,
+                    "type": vars_file
+                }
+            }
+        }),
+        ("target_folder", {
+            "alias": "target-folder",
+            "required": False,
+            # "default": "~/freckles",
+            "type": str,
+            "doc": {
+                "help": TARGET_ARG_HELP
+            },
+            "click": {
+                "option": {
+                    "param_decls": ["--target-folder", "-t"],
+                    "metavar": TARGET_ARG_METAVAR
+                }
+            }
+        }),
+        ("target_name", {
+            "alias": "target-name",
+            "required": False,
+            "type": str,
+            "doc": {
+                "help": TARGET_NAME_ARG_HELP
+            },
+            "click": {
+                "option": {
+                    "metavar": TARGET_NAME_ARG_METAVAR
+                }
+            }
+        }),
+        ("include", {
+            "alias": "include",
+            "required": False,
+            "doc": {
+                "help": INCLUDE_ARG_HELP
+            },
+            "click": {
+                "option": {
+                    "param_decls": ["--include", "-i"],
+                    "multiple": True,
+                    "metavar": INCLUDE_ARG_METAVAR
+                }
+            }
+        }),
+        ("exclude", {
+            "alias": "exclude",
+            "required": False,
+            "doc": {
+                "help": EXCLUDE_ARG_HELP
+            },
+            "click": {
+                "option": {
+                    "param_decls": ["--exclude", "-e"],
+                    "multiple": True,
+                    "metavar": EXCLUDE_ARG_METAVAR
+                }
+            }
+        }),
+        # ("ask_become_pass", {
+        #     "alias": "ask-become-pass",
+        #     "doc": {
+        #         "help": ASK_PW_HELP
+        #     },
+        #     "click": {
+        #         "option": {
+        #             "param_decls": ["--ask-become-pass", "-pw"],
+        #             "type": ASK_PW_CHOICES
+        #         }
+        #     }
+        # }),
+        ("non_recursive", {
+            "alias": "non-recursive",
+            "type": bool,
+            "required": False,
+            "default": False,
+            "doc": {
+                "help": NON_RECURSIVE_HELP
+            },
+            "click": {
+                "option": {
+                    "is_flag": True
+                }
+            }
+        })
+    ]
+
+    @staticmethod
+    def freckelize_extra_params():
+
+        freckle_option = click.Option(param_decls=["--freckle", "-f"], required=False, multiple=True, type=RepoType(),
+                                  metavar=FRECKLE_ARG_METAVAR, help=FRECKLE_ARG_HELP)
+        target_option = click.Option(param_decls=["--target-folder", "-t"], required=False, multiple=False, type=str,
+                                     metavar=TARGET_ARG_METAVAR,
+                                     help=TARGET_ARG_HELP)
+        target_name_option = click.Option(param_decls=["--target-name"], required=False, multiple=False, type=str,
+                                     metavar=TARGET_NAME_ARG_METAVAR,
+                                     help=TARGET_NAME_ARG_HELP)
+        include_option = click.Option(param_decls=["--include", "-i"],
+                                      help=INCLUDE_ARG_HELP,
+                                      type=str, metavar=INCLUDE_ARG_METAVAR, default=[], multiple=True)
+        exclude_option = click.Option(param_decls=["--exclude", "-e"],
+                                      help=EXCLUDE_ARG_HELP,
+                                      type=str, metavar=EXCLUDE_ARG_METAVAR, default=[], multiple=True)
+        parent_only_option = click.Option(param_decls=["--non-recursive"],
+                                          help=NON_RECURSIVE_HELP,
+                                          is_flag=True,
+                                          default=False,
+                                          required=False,
+                                          type=bool
+        )
+
+        forks_option = click.Option(param_decls=["--forks"],
+                                    help=FORKS_HELP,
+                                    type=click.IntRange(min=1),
+                                    metavar=FORKS_METAVAR,
+                                    default=DEFAULT_FRECKELIZE_FORKS,
+                                    required=False)
+
+        checkout_workers_option = click.Option(param_decls=["--checkout-workers"],
+                                               help=CHECKOUT_WORKERS_HELP,
+                                               type=click.IntRange(min=1),
+                                               metavar=FORKS_METAVAR,
+                                               default=DEFAULT_CHECKOUT_WORKERS,
+                                               required=False)
+        parallel_merge_threshold_option = click.Option(param_decls=["--parallel-merge-threshold"],
+                                                       help=PARALLEL_MERGE_THRESHOLD_HELP,
+                                                       type=click.IntRange(min=0),
+                                                       metavar=FORKS_METAVAR,
+                                                       default=DEFAULT_MERGE_POOL_THRESHOLD,
+                                                       required=False)
+        incremental_option = click.Option(param_decls=["--incremental"],
+                                          help=INCREMENTAL_HELP,
+                                          is_flag=True,
+                                          default=False,
+                                          required=False,
+                                          type=bool)
+
+        reuse_plan_option = click.Option(param_decls=["--reuse-plan"],
+                                         help=REUSE_PLAN_HELP,
+                                         is_flag=True,
+                                         default=False,
+                                         required=False,
+                                         type=bool)
+        keep_environments_option = click.Option(param_decls=["--keep-environments"],
+                                                help=KEEP_ENVIRONMENTS_HELP,
+                                                type=click.IntRange(min=0),
+                                                metavar=FORKS_METAVAR,
+                                                default=DEFAULT_KEEP_RUN_ENVIRONMENTS,
+                                                required=False)
+        shared_connection_option = click.Option(param_decls=["--shared-connection"],
+                                                help=SHARED_CONNECTION_HELP,
+                                                is_flag=True,
+                                                default=False,
+                                                required=False,
+                                                type=bool)
+        profile_timings_option = click.Option(param_decls=["--profile-timings"],
+                                              help=PROFILE_TIMINGS_HELP,
+                                              is_flag=True,
+                                              default=False,
+                                              required=False,
+                                              type=bool)
+        profile_timings_file_option = click.Option(param_decls=["--profile-timings-file"],
+                                                   help=PROFILE_TIMINGS_FILE_HELP,
+                                                   type=click.Path(dir_okay=False, writable=True),
+                                                   metavar=TARGET_ARG_METAVAR,
+                                                   required=False)
+        profile_timings_format_option = click.Option(param_decls=["--profile-timings-format"],
+                                                     help=PROFILE_TIMINGS_FORMAT_HELP,
+                                                     type=click.Choice(TIMINGS_FORMATS),
+                                                     default="json",
+                                                     required=False)
+
+        params = [freckle_option, target_option, target_name_option, include_option, exclude_option,
+                           parent_only_option, forks_option, checkout_workers_option, parallel_merge_threshold_option, incremental_option,
+                           reuse_plan_option, keep_environments_option, shared_connection_option,
+                           profile_timings_option, profile_timings_file_option, profile_timings_format_option]
+
+        return params
+
+
+    def __init__(self, extra_params=None, print_version_callback=print_version, **kwargs):
+
+        config = DEFAULT_FRECKLES_CONFIG
+        config.add_repo(DEFAULT_FRECKELIZE_ROLES_PATH)
+        config.add_repo(DEFAULT_FRECKELIZE_ADAPTERS_PATH)
+        config.add_repo(DEFAULT_FRECKELIZE_BLUEPRINTS_PATH)
+        config.add_user_repo(DEFAULT_USER_ADAPTERS_PATH)
+
+        extra_params = FreckelizeAdapterCommand.freckelize_extra_params()
+        super(FreckelizeAdapterCommand, self).__init__(config=config, extra_params=extra_params, print_version_callback=print_version_callback, **kwargs)
+        self.config = DEFAULT_FRECKLES_CONFIG
+        self.reader = FreckelizeAdapterReader()
+        self.finder = None
+
+    def get_dictlet_finder(self):
+
+        if self.finder is None:
+            # need to wait for paths to be initialized
+            self.finder =  FreckelizeAdapterFinder(self.paths)
+
+        return self.finder
+
+    def get_dictlet_reader(self):
+
+        return self.reader
+
+    def get_additional_args(self):
+
+        return OrderedDict(FreckelizeAdapterCommand.FRECKELIZE_ARGS)
+
+    def freckles_process(self, command_name, default_vars, extra_vars, user_input, metadata, dictlet_details, config, parent_params, command_var_spec):
+
+        result = {"name": command_name, "default_vars": default_vars, "extra_vars": extra_vars, "user_input": user_input, "adapter_metadata": metadata, "adapter_details": dictlet_details}
+
+        return result
+
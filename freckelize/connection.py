@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""Ansible settings for the sub-runs of a freckelize run, e.g. to share connections and gathered facts between them."""
+
+from __future__ import absolute_import, division, print_function
+
+import contextlib
+import logging
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+from .cache import get_cache_dir
+
+log = logging.getLogger("freckles")
+
+# default maximum number of hosts to process in parallel
+DEFAULT_FRECKELIZE_FORKS = 5
+# how long (in seconds) idle ssh master connections and cached facts are kept around
+DEFAULT_CONTROL_PERSIST = 120
+SHARED_CONNECTION_SSH_ARGS = "-o ControlMaster=auto -o ControlPersist={}s"
+
+
+def get_shared_connection_env(control_path_dir, fact_cache_dir, control_persist=DEFAULT_CONTROL_PERSIST, base_env=None):
+    """Calculates the environment variables that make Ansible re-use connections and facts.
+
+    Ssh connections are multiplexed over a persistent master connection, and facts are only gathered
+    if they are not in the (jsonfile) fact cache already. Settings that are already present in the base
+    environment are not overwritten. Ansible's default ssh arguments already use a master connection, so
+    'ANSIBLE_SSH_ARGS' is only changed if it is set, but doesn't configure a 'ControlMaster': in that case
+    the connection sharing options are appended.
+
+    Args:
+      control_path_dir (str): the folder to keep ssh control sockets in
+      fact_cache_dir (str): the folder to cache gathered facts in
+      control_persist (int): how long (in seconds) to keep idle connections and cached facts
+      base_env (dict): the current environment, defaults to 'os.environ'
+    Returns:
+      OrderedDict: the environment variables to set
+    """
+
+    if base_env is None:
+        base_env = os.environ
+
+    result = OrderedDict()
+
+    current_ssh_args = base_env.get("ANSIBLE_SSH_ARGS", "")
+    if current_ssh_args and "ControlMaster" not in current_ssh_args:
+        result["ANSIBLE_SSH_ARGS"] = "{} {}".format(current_ssh_args, SHARED_CONNECTION_SSH_ARGS.format(control_persist))
+
+    defaults = OrderedDict([
+        ("ANSIBLE_SSH_CONTROL_PATH_DIR", control_path_dir),
+        ("ANSIBLE_GATHERING", "smart"),
+        ("ANSIBLE_CACHE_PLUGIN", "jsonfile"),
+        ("ANSIBLE_CACHE_PLUGIN_CONNECTION", fact_cache_dir),
+        ("ANSIBLE_CACHE_PLUGIN_TIMEOUT", str(control_persist))
+    ])
+
+    for key, value in defaults.items():
+        if not base_env.get(key, None):
+            result[key] = value
+
+    return result
+
+
+@contextlib.contextmanager
+def shared_connection(control_persist=DEFAULT_CONTROL_PERSIST):
+    """Context manager that configures all Ansible runs started within it to share connections and facts.
+
+    The settings are applied to the environment of the current process (which is inherited by Ansible), and
+    reverted afterwards. Control sockets are kept in the freckelize cache folder (or a temporary folder, if
+    caching is disabled). Facts are cached in a temporary folder that is deleted afterwards, so they are never
+    re-used by a later invocation.
+
+    Args:
+      control_persist (int): how long (in seconds) to keep idle connections and cached facts
+    Returns:
+      OrderedDict: the environment variables that were set
+    """
+
+    temp_dir = tempfile.mkdtemp(prefix="freckelize_connection_")
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        control_path_dir = os.path.join(temp_dir, "cp")
+    else:
+        control_path_dir = os.path.join(cache_dir, "connection", "cp")
+    fact_cache_dir = os.path.join(temp_dir, "facts")
+
+    try:
+        env = get_shared_connection_env(control_path_dir, fact_cache_dir, control_persist=control_persist)
+        for key in ["ANSIBLE_SSH_CONTROL_PATH_DIR", "ANSIBLE_CACHE_PLUGIN_CONNECTION"]:
+            if key in env and not os.path.exists(env[key]):
+                os.makedirs(env[key], 0o700)
+
+        log.debug("Sharing connections and facts between Ansible runs: {}".format(dict(env)))
+        with ansible_environment(env):
+            yield env
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def ansible_environment(env):
+    """Context manager that sets environment variables for all Ansible runs started within it.
+
+    The variables are set in the environment of the current process (which is inherited by Ansible), and
+    reverted afterwards.
+
+    Args:
+      env (dict): the environment variables to set
+    Returns:
+      dict: the environment variables that were set
+    """
+
+    old_env = dict((key, os.environ.get(key, None)) for key in env.keys())
+    os.environ.update(env)
+    try:
+        yield env
+    finally:
+        for key, value in old_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
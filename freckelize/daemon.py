@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+
+"""A resident freckelize process that keeps adapter, blueprint and metadata caches warm.
+
+The daemon ('freckelize-daemon') listens on a Unix socket. For every request it forks a child, which inherits
+everything that was already imported and discovered, and runs the command-line interface with the arguments,
+working directory, environment and standard streams (passed as file descriptors) of the client. The client
+(see :func:`run_in_daemon`) only waits for the exit code. 'freckelize' only forwards runs to the daemon if
+the 'FRECKELIZE_USE_DAEMON' environment variable is set.
+
+The freckles configuration is read again before a request if the configuration file changed. Adapter and
+blueprint repos are watched, cached entries of repos that changed are reloaded before the next run. Runs write
+the persistent caches themselves, the daemon loads them again before it forks the next run.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import array
+import errno
+import json
+import logging
+import os
+import signal
+import socket
+import struct
+import sys
+
+import click
+
+log = logging.getLogger("freckles")
+
+FRECKELIZE_DAEMON_SOCKET_ENV_NAME = "FRECKELIZE_DAEMON_SOCKET"
+FRECKELIZE_USE_DAEMON_ENV_NAME = "FRECKELIZE_USE_DAEMON"
+DEFAULT_FRECKELIZE_DAEMON_SOCKET = os.path.join(os.path.expanduser("~"), ".freckles", "freckelize.sock")
+# the streams that are handed over to the daemon
+FORWARDED_FDS = [0, 1, 2]
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+
+
+def get_socket_path():
+    """Returns the path of the daemon socket.
+
+    Can be overwritten with the 'FRECKELIZE_DAEMON_SOCKET' environment variable. If that variable is set to an
+    empty string, the daemon is never used.
+
+    Returns:
+      str: the socket path, or None if disabled
+    """
+
+    path = os.environ.get(FRECKELIZE_DAEMON_SOCKET_ENV_NAME, None)
+    if path is None:
+        return DEFAULT_FRECKELIZE_DAEMON_SOCKET
+    if not path:
+        return None
+    return os.path.expanduser(path)
+
+
+def use_daemon():
+    """Returns whether runs should be forwarded to the daemon, which needs to be enabled with the 'FRECKELIZE_USE_DAEMON' environment variable."""
+
+    return os.environ.get(FRECKELIZE_USE_DAEMON_ENV_NAME, "").lower() in ["1", "true", "yes"]
+
+
+def daemon_supported():
+
+    return hasattr(socket, "AF_UNIX") and hasattr(socket.socket, "sendmsg") and hasattr(os, "fork")
+
+
+def read_message(conn, buffer=b""):
+    """Reads one newline-terminated json message from a connection.
+
+    Args:
+      conn (socket): the connection
+      buffer (bytes): data that was already received
+    Returns:
+      tuple: the message (or None if the connection was closed before a full message arrived), and the remaining data
+    """
+
+    while b"\n" not in buffer:
+        if len(buffer) > MAX_REQUEST_SIZE:
+            raise Exception("Message too large.")
+        data = conn.recv(65536)
+        if not data:
+            return (None, buffer)
+        buffer = buffer + data
+
+    line, buffer = buffer.split(b"\n", 1)
+    return (json.loads(line.decode("utf-8")), buffer)
+
+
+def write_message(conn, message):
+
+    conn.sendall(json.dumps(message).encode("utf-8") + b"\n")
+
+
+def run_in_daemon(args):
+    """Forwards a freckelize invocation to a running daemon, if that is enabled (see :func:`use_daemon`).
+
+    Args:
+      args (list): the command-line arguments
+    Returns:
+      int: the exit code, or None if the daemon is not enabled or not available (in which case nothing was executed)
+    """
+
+    if not use_daemon():
+        return None
+
+    socket_path = get_socket_path()
+    if socket_path is None or not daemon_supported() or not os.path.exists(socket_path):
+        return None
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            conn.connect(socket_path)
+        except (socket.error) as e:
+            log.debug("Could not connect to freckelize daemon, running locally: {}".format(e))
+            return None
+
+        request = {"args": list(args), "cwd": os.getcwd(), "env": dict(os.environ)}
+        data = json.dumps(request).encode("utf-8") + b"\n"
+        for stream in [sys.stdout, sys.stderr]:
+            stream.flush()
+        conn.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", FORWARDED_FDS))])
+
+        # the daemon confirms it started the run with the pid of the process executing it
+        started, buffer = read_message(conn)
+        if started is None:
+            log.debug("Freckelize daemon closed the connection, running locally.")
+            return None
+
+        while True:
+            try:
+                result, buffer = read_message(conn, buffer)
+                break
+            except (KeyboardInterrupt):
+                # the run is not part of this terminal's process group, so it needs to be told explicitly
+                try:
+                    os.kill(started["pid"], signal.SIGINT)
+                except (OSError):
+                    pass
+
+        if result is None:
+            click.echo("Connection to freckelize daemon lost.", err=True)
+            return 1
+        return result["exit_code"]
+    finally:
+        conn.close()
+
+
+class FreckelizeDaemon(object):
+    """Serves freckelize runs on a Unix socket.
+
+    Args:
+      socket_path (str): the path of the socket
+    """
+
+    def __init__(self, socket_path):
+
+        self.socket_path = socket_path
+        self.server = None
+        self.children = set()
+        self.running = False
+        # the state of the freckles configuration file when it was last read
+        self.config_stamp = None
+
+    def warm_up(self):
+        """Imports and discovers everything that can be shared by all runs."""
+
+        from .cli import cli
+        from .utils import get_available_blueprints, flush_adapter_caches
+        from freckles.utils import DEFAULT_FRECKLES_CONFIG
+        import freckelize.freckelize  # noqa: F401
+
+        if self.config_stamp is None:
+            self.config_stamp = self.get_config_stamp()
+
+        try:
+            with cli.make_context("freckelize", [], resilient_parsing=True) as ctx:
+                commands = cli.list_commands(ctx)
+            log.debug("Preloaded {} adapters.".format(len(commands)))
+            get_available_blueprints(DEFAULT_FRECKLES_CONFIG)
+        except (Exception) as e:
+            log.warning("Could not preload adapters and blueprints: {}".format(e))
+        # runs write the caches themselves, so they must not be overwritten with the daemon's copy when it exits
+        flush_adapter_caches()
+
+    def get_config_stamp(self):
+        """Returns a value that changes whenever the freckles configuration file changes (None if it doesn't exist)."""
+
+        from freckles.utils import DEFAULT_FRECKLES_CONFIG
+
+        try:
+            stat = os.stat(DEFAULT_FRECKLES_CONFIG.config_file)
+        except (OSError):
+            return None
+        return (stat.st_ino, stat.st_mtime, stat.st_size)
+
+    def reload_config(self):
+        """Reads the freckles configuration (e.g. trusted repos) again if it changed, and re-creates the command-line interface.
+
+        The configuration object is shared by all modules that imported it, so it's re-initialized in place. The
+        command-line interface derives its adapter paths from the configuration when it's created. Discovered
+        adapters are cached per path, so unchanged repos are not searched again.
+
+        Returns:
+          bool: whether the configuration changed
+        """
+
+        config_stamp = self.get_config_stamp()
+        if config_stamp == self.config_stamp:
+            return False
+
+        from six.moves import reload_module
+        from freckles.utils import DEFAULT_FRECKLES_CONFIG
+        import freckelize.cli
+
+        log.debug("Freckles configuration changed, reloading it.")
+        DEFAULT_FRECKLES_CONFIG.__init__()
+        reload_module(freckelize.cli)
+        self.config_stamp = config_stamp
+        return True
+
+    def refresh(self, force_poll=False):
+        """Evicts cached adapters and blueprints of repos that changed, and loads them again.
+
+        Persistent caches that were written by earlier runs are loaded again first, so the next run inherits
+        their entries, and the daemon never writes an outdated copy.
+
+        Args:
+          force_poll (bool): check polled repos even if the poll interval didn't pass yet
+        """
+
+        from .utils import invalidate_changed_caches, reload_adapter_caches
+
+        reload_adapter_caches()
+        changed = invalidate_changed_caches(force_poll=force_poll)
+        if changed:
+            log.debug("Repos changed, reloading: {}".format(", ".join(sorted(changed))))
+            self.warm_up()
+
+    def listen(self):
+
+        parent = os.path.dirname(self.socket_path)
+        if parent and not os.path.exists(parent):
+            os.makedirs(parent, 0o700)
+
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+                raise Exception("Freckelize daemon already running on: {}".format(self.socket_path))
+            except (socket.error):
+                # stale socket from a daemon that didn't shut down properly
+                os.remove(self.socket_path)
+            finally:
+                probe.close()
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            self.server.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        self.server.listen(16)
+        self.server.settimeout(1.0)
+
+    def check_peer(self, conn):
+        """Makes sure the client runs as the same user as the daemon (where the platform allows checking)."""
+
+        if not hasattr(socket, "SO_PEERCRED"):
+            # the socket is only accessible by the current user anyway
+            return True
+
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+        pid, uid, gid = struct.unpack("3i", creds)
+        return uid == os.getuid()
+
+    def reap_children(self):
+
+        for pid in list(self.children):
+            try:
+                finished, _ = os.waitpid(pid, os.WNOHANG)
+            except (OSError) as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                finished = pid
+            if finished:
+                self.children.discard(pid)
+
+    def receive_request(self, conn):
+
+        fds = array.array("i")
+        data, ancdata, flags, addr = conn.recvmsg(65536, socket.CMSG_LEN(len(FORWARDED_FDS) * fds.itemsize))
+        for level, kind, cmsg_data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+
+        request, _ = read_message(conn, data)
+        if request is None or len(fds) != len(FORWARDED_FDS):
+            for fd in fds:
+                os.close(fd)
+            raise Exception("Invalid request.")
+
+        return (request, list(fds))
+
+    def handle(self, conn):
+
+        if not self.check_peer(conn):
+            log.warning("Refusing connection from different user.")
+            return
+
+        request, fds = self.receive_request(conn)
+
+        # children inherit the configuration and the caches, so they need to be current
+        try:
+            config_changed = self.reload_config()
+        except (Exception) as e:
+            for fd in fds:
+                os.close(fd)
+            raise Exception("Could not read freckles configuration: {}".format(e))
+        self.refresh(force_poll=True)
+        if config_changed:
+            self.warm_up()
+
+        pid = os.fork()
+        if pid != 0:
+            self.children.add(pid)
+            for fd in fds:
+                os.close(fd)
+            return
+
+        # child
+        exit_code = 1
+        try:
+            self.server.close()
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            for stream in [sys.stdout, sys.stderr]:
+                stream.flush()
+            for target, fd in zip(FORWARDED_FDS, fds):
+                os.dup2(fd, target)
+                os.close(fd)
+            write_message(conn, {"pid": os.getpid()})
+            exit_code = self.run(request)
+        finally:
+            try:
+                for stream in [sys.stdout, sys.stderr]:
+                    stream.flush()
+                write_message(conn, {"exit_code": exit_code})
+            finally:
+                os._exit(exit_code)
+
+    def run(self, request):
+        """Runs the command-line interface in the environment of the client (called in the forked child)."""
+
+        from .cli import cli
+
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+
+        try:
+            cli.main(args=request["args"], prog_name="freckelize")
+        except (SystemExit) as e:
+            if e.code is None:
+                return 0
+            if isinstance(e.code, int):
+                return e.code
+            click.echo(e.code, err=True)
+            return 1
+        except (KeyboardInterrupt):
+            return 130
+
+        return 0
+
+    def serve(self):
+
+        self.listen()
+        click.echo("Listening on: {}".format(self.socket_path))
+        self.running = True
+        try:
+            while self.running:
+                self.reap_children()
+                try:
+                    conn, _ = self.server.accept()
+                except (socket.timeout):
+                    self.refresh()
+                    continue
+                conn.settimeout(None)
+                try:
+                    self.handle(conn)
+                except (Exception) as e:
+                    log.warning("Could not handle request: {}".format(e))
+                finally:
+                    conn.close()
+        finally:
+            self.server.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def stop(self):
+        """Makes the daemon exit after the current request (or within a second if idle)."""
+
+        self.running = False
+
+
+@click.command(name="freckelize-daemon")
+@click.option("--socket", "socket_path", help="the socket to listen on, default: {}".format(DEFAULT_FRECKELIZE_DAEMON_SOCKET), type=click.Path(dir_okay=False), required=False)
+def serve_cli(socket_path):
+    """Keeps a freckelize process running, to speed up subsequent freckelize calls.
+
+    Calls to 'freckelize' are forwarded to this process if the 'FRECKELIZE_USE_DAEMON' environment variable
+    is set, and it listens on the default socket, or the one specified in the 'FRECKELIZE_DAEMON_SOCKET'
+    environment variable.
+    """
+
+    if not daemon_supported():
+        raise click.ClickException("The freckelize daemon is not supported on this platform.")
+
+    if socket_path is None:
+        socket_path = get_socket_path() or DEFAULT_FRECKELIZE_DAEMON_SOCKET
+
+    from .utils import watch_caches
+
+    watch_caches()
+    daemon = FreckelizeDaemon(os.path.expanduser(socket_path))
+    daemon.warm_up()
+    try:
+        daemon.serve()
+    except (KeyboardInterrupt):
+        pass
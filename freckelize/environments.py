@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""Book-keeping for the nsbl run environments freckelize creates."""
+
+from __future__ import absolute_import, division, print_function
+
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+from .cache import hash_object, load_json_cache, save_json_cache
+
+log = logging.getLogger("freckles")
+
+# how many environments to keep per key (i.e. for the same host and freckle folders), by default all are kept
+DEFAULT_KEEP_RUN_ENVIRONMENTS = 0
+
+
+class RunEnvironmentRegistry(object):
+    """Keeps track of the run environments created for freckelize runs, keyed by what they were created for.
+
+    nsbl creates a new environment (playbooks, inventory, role links, logs) for every run, and freckles
+    doesn't allow re-using an existing one: the run location is fixed, and nsbl replaces an existing
+    environment instead of updating it. So environments are never updated in place, this only cleans up.
+    Environments are recorded here, so environments that were superseded by a newer one with the same key
+    can be removed, if the user asks for it. Only environments that were recorded by freckelize are ever
+    removed.
+
+    Args:
+      name (str): the name of the registry cache file
+    """
+
+    def __init__(self, name="run_environments"):
+
+        self.name = name
+        self.lock = threading.Lock()
+        self.recorded = []
+
+    def get_key(self, kind, *key_items):
+        """Calculates the key of an environment.
+
+        Args:
+          kind (str): the kind of run (e.g. 'checkout')
+          *key_items (object): what the environment is for (e.g. host and repos), newer environments with the same key supersede older ones
+        Returns:
+          str: the key
+        """
+
+        return "{}-{}".format(kind, hash_object(key_items))
+
+    def record(self, key, run_result):
+        """Records the environment of a finished (or prepared) run.
+
+        Args:
+          key (str): the key, as returned by :meth:`get_key`
+          run_result (dict): the result of 'create_and_run_nsbl_runner'
+        """
+
+        if not isinstance(run_result, dict) or not run_result.get("playbook_dir", None):
+            return
+
+        playbook_dir = os.path.realpath(run_result["playbook_dir"])
+        with self.lock:
+            self.recorded.append((key, playbook_dir, time.time()))
+
+    def prune(self, keep=DEFAULT_KEEP_RUN_ENVIRONMENTS):
+        """Saves the environments recorded in this process, and removes superseded ones.
+
+        Should only be called once no run needs its environment anymore (e.g. to read logs).
+
+        Args:
+          keep (int): how many environments to keep per key, 0 to not remove any
+        """
+
+        with self.lock:
+            registry = load_json_cache(self.name, {})
+            environments = registry.get("environments", OrderedDict())
+            for key, playbook_dir, timestamp in self.recorded:
+                environments.setdefault(key, []).append([timestamp, playbook_dir])
+            self.recorded = []
+
+            if keep:
+                for key in list(environments.keys()):
+                    envs = sorted(environments[key], key=lambda e: e[0])
+                    for timestamp, playbook_dir in envs[:-keep]:
+                        self.remove_environment(playbook_dir)
+                    envs = [e for e in envs[-keep:] if os.path.isdir(e[1])]
+                    if envs:
+                        environments[key] = envs
+                    else:
+                        del environments[key]
+
+            save_json_cache(self.name, OrderedDict([("environments", environments)]))
+
+    def remove_environment(self, playbook_dir):
+
+        # the environment is the parent of the playbook folder, it also contains the logs
+        env_dir = os.path.dirname(playbook_dir)
+        if not os.path.isdir(playbook_dir) or env_dir in ["", os.sep, os.path.expanduser("~")]:
+            return
+
+        log.debug("Removing superseded run environment: {}".format(env_dir))
+        shutil.rmtree(env_dir, ignore_errors=True)
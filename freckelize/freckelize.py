@@ -3,33 +3,101 @@
 from __future__ import absolute_import, division, print_function
 
 import copy
-import json
+import itertools
 import logging
-import operator
-import sys
 import tempfile
-import uuid
+import threading
+import time
 from collections import OrderedDict
 
-import yaml
-from cookiecutter.main import cookiecutter
 from frkl import frkl
-from luci import output, ordered_load, readable_json, readable_raw, add_key_to_dict
-from nsbl.output import print_title
+from luci import output, readable_json, readable_raw, add_key_to_dict
 from six import string_types
 
+from freckles import __version__ as freckles_version
 from freckles.freckles_base_cli import process_extra_task_lists, create_external_task_list_callback, \
     get_task_list_format
 from freckles.freckles_defaults import *
 from freckles.utils import DEFAULT_FRECKLES_CONFIG, expand_repos, create_and_run_nsbl_runner
 # from .freckle_detect import create_freckle_descs
-from .utils import get_available_blueprints, FreckelizeAdapterReader, FreckelizeAdapterFinder, DEFAULT_REPO_TYPE, \
-    DEFAULT_REPO_PRIORITY, METADATA_CONTENT_KEY
+from .cache import JsonFileCache, hash_file, hash_object
+from .checkout import CheckoutState, is_local_host, get_inventory_hostname, scan_local_freckle, walk_local_freckle, iter_metadata_file, \
+    list_freckle_files, repo_fingerprint, prefetch_repo, prefetch_staging_dir, FOLDER_FILES_KEY
+from .connection import ansible_environment, shared_connection
+from .environments import RunEnvironmentRegistry, DEFAULT_KEEP_RUN_ENVIRONMENTS
+from .layered_vars import LayeredVars, materialize_vars
+from .metadata import MetadataParser, DEFAULT_MERGE_POOL_THRESHOLD
+from .timings import PhaseTimings, timed
+from .utils import get_available_blueprints, render_blueprint, FreckelizeAdapterReader, FreckelizeAdapterFinder, DEFAULT_REPO_TYPE, \
+    DEFAULT_REPO_PRIORITY, METADATA_CONTENT_KEY, DEFAULT_FRECKELIZE_FORKS, DEFAULT_CHECKOUT_WORKERS, run_concurrently, flush_adapter_caches
 
 log = logging.getLogger("freckles")
 
 # for debug purposes, sometimes it's easier to read the output if list of files is not present in folder metadata. This will make some adapters not work though.
+# if enabled, file lists are still only added to folders that are processed by an adapter that asks for them
 ADD_FILES = True
+# adapters that need the list of files of a folder have to set this key in their '__freckles__' metadata
+ADAPTER_FILE_LIST_KEY = "add_file_list"
+# increase this if the format of run plans changes
+RUN_PLAN_FORMAT_VERSION = 1
+# run plans of earlier invocations, keyed by all of their inputs
+RUN_PLAN_CACHE = JsonFileCache("run_plans", max_entries=32)
+# number of folder records whose metadata files are parsed in one batch
+METADATA_PARSE_CHUNK_SIZE = 5000
+# all hosts of a run get the same vars, so per-host values are passed in dicts keyed by inventory hostname, and selected with this template
+HOST_VAR_TEMPLATE = "{{{{ {}[inventory_hostname] }}}}"
+# the checkout play writes one metadata file per host
+REPO_METADATA_FILE_TEMPLATE = "repo_metadata_{}"
+# nsbl names run environments after the second they are created in, and replaces existing ones with the same name,
+# so only one run can be started at a time, and never two within the same second
+NSBL_RUN_LOCK = threading.Lock()
+NSBL_LAST_RUN = {"started": None}
+
+
+def run_nsbl(task_config, **kwargs):
+    """Calls 'create_and_run_nsbl_runner', making sure runs don't overwrite each other's environment.
+
+    Runs are serialized, and a run only waits if it would start in the same second the previous one started in.
+
+    Args:
+      task_config (list): the task configuration
+      **kwargs (dict): the arguments for 'create_and_run_nsbl_runner'
+    Returns:
+      dict: the run result
+    """
+
+    with NSBL_RUN_LOCK:
+        last_started = NSBL_LAST_RUN["started"]
+        now = time.time()
+        if last_started is not None and int(now) == int(last_started):
+            time.sleep(int(now) + 1 - now)
+        NSBL_LAST_RUN["started"] = time.time()
+        return create_and_run_nsbl_runner(task_config, **kwargs)
+
+
+def get_repo_id(source, target_folder=None, target_name=None, include=None, exclude=None, non_recursive=False):
+    """Calculates the id of a freckle repo.
+
+    The id only depends on the (normalized) repo parameters, so the same freckle repo gets the same id in every run,
+    and can be used as a key for results that are kept across runs.
+
+    Args:
+      source (dict): the source repo/path
+      target_folder (str): the local target path
+      target_name (str): the local target name
+      include (list): sub-freckle folders to use
+      exclude (list): sub-freckle folders to exclude
+      non_recursive (bool): whether to only use the source base folder
+    Returns:
+      str: the id
+    """
+
+    normalized_source = dict(source)
+    local_path = os.path.expanduser(normalized_source["url"])
+    if os.path.exists(local_path):
+        normalized_source["url"] = os.path.realpath(local_path)
+
+    return hash_object([normalized_source, target_folder, target_name, sorted(include or []), sorted(exclude or []), bool(non_recursive)])
 
 
 class FreckleRepo(object):
@@ -63,9 +131,7 @@ class FreckleRepo(object):
         else:
             temp_source = source
 
-        self.id = str(uuid.uuid4())
-
-        # self.id = temp_source["url"]
+        self.id = get_repo_id(temp_source, target_folder=target_folder, target_name=target_name, include=include, exclude=exclude, non_recursive=non_recursive)
 
         self.priority = DEFAULT_REPO_PRIORITY
         self.source = temp_source
@@ -143,11 +209,11 @@ class FreckleRepo(object):
 
                 if blueprint_defaults:
                     log.debug("Found interactive blueprints, but using defaults...")
-                    cookiecutter(match, output_dir=temp_path, no_input=True)
+                    render_blueprint(match, temp_path, no_input=True)
                 else:
                     click.secho("\nFound interactive blueprint, please enter approriate values below:\n", bold=True)
 
-                    cookiecutter(match, output_dir=temp_path)
+                    render_blueprint(match, temp_path)
                     click.echo()
 
 
@@ -335,8 +401,15 @@ class Freckelize(object):
       config (FreckleConfig): the configuration to use for this run
       ask_become_pass (bool): whether Ansible should ask the user for a password if necessary
       password (str): the password to use
+      incremental (bool): whether to skip the checkout of repos that didn't change since the last run
+      checkout_workers (int): the maximum number of git repos and remote archives to download in parallel before the checkout run
+      timings (PhaseTimings): an (optional) object to record the time each phase of the run takes
+      merge_pool_threshold (int): the minimum number of freckle folders to merge their metadata in parallel processes, 0 to disable
+      reuse_plan (bool): whether to reuse the run plan of an earlier, identical invocation if none of its inputs changed
+      keep_environments (int): how many run environments (including their logs) for the same host and repos/folders to keep, 0 to keep all
+      shared_connection (bool): whether the checkout and processing runs share ssh connections and gathered facts
     """
-    def __init__(self, freckle_details, config=None, ask_become_pass=False, password=None):
+    def __init__(self, freckle_details, config=None, ask_become_pass=False, password=None, incremental=False, checkout_workers=DEFAULT_CHECKOUT_WORKERS, timings=None, merge_pool_threshold=DEFAULT_MERGE_POOL_THRESHOLD, reuse_plan=False, keep_environments=DEFAULT_KEEP_RUN_ENVIRONMENTS, shared_connection=False):
 
         if isinstance(freckle_details, string_types):
             temp_freckle_details = [FreckleDetails(freckle_details)]
@@ -349,6 +422,19 @@ class Freckelize(object):
 
         self.ask_become_pass = ask_become_pass
         self.password = password
+        self.incremental = incremental
+        self.checkout_workers = checkout_workers
+        self.merge_pool_threshold = merge_pool_threshold
+        self.reuse_plan = reuse_plan
+        self.keep_environments = keep_environments
+        self.run_environments = RunEnvironmentRegistry()
+        self.shared_connection = shared_connection
+        # hosts the box basics were already run on in this invocation
+        self.box_basics_hosts = set()
+        self.checkout_state = CheckoutState(exclude_dirs=DEFAULT_EXCLUDE_DIRS)
+        if timings is None:
+            timings = PhaseTimings(enabled=False)
+        self.timings = timings
 
         self.freckle_details = []
 
@@ -377,19 +463,39 @@ class Freckelize(object):
         self.reader = FreckelizeAdapterReader()
         self.all_repos = OrderedDict()
 
-        for f in self.freckle_details:
-            f.expand_repos(self.config)
-            for fr in f.freckle_repos:
-                self.all_repos[fr.id] = fr
+        with self.timings.phase("expand_repos"):
+            for f in self.freckle_details:
+                f.expand_repos(self.config)
+                for fr in f.freckle_repos:
+                    existing = self.all_repos.get(fr.id, None)
+                    if existing is None:
+                        self.all_repos[fr.id] = fr
+                    elif existing is not fr:
+                        # the same repo was specified more than once, it's only checked out once, using the merged vars
+                        log.debug("Repo '{}' specified more than once, merging vars.".format(fr.source["url"]))
+                        existing.add_default_vars(fr.default_vars)
+                        existing.add_overlay_vars(fr.overlay_vars)
+
+    @timed("checkout")
+    def start_checkout_run(self, hosts=None, no_run=False, output_format="default", forks=DEFAULT_FRECKELIZE_FORKS):
+        """Checks out all freckle repos on all hosts, and reads their metadata.
+
+        All hosts that need the checkout play share a single run, Ansible processes at most 'forks' of them in parallel.
 
-    def start_checkout_run(self, hosts=None, no_run=False, output_format="default"):
+        Args:
+          hosts (list): a list of hosts
+          no_run (bool): whether to only create the Ansible environment, without executing it
+          output_format (str): the output format to use
+          forks (int): the maximum number of hosts to process in parallel
+        Returns:
+          tuple: a tuple of the form (freckle_profile, profiles), each a list of (host, metadata) tuples
+        """
 
         if hosts is None:
             hosts = ["localhost"]
 
-        if isinstance(hosts, (list, tuple)):
-            if len(hosts) > 1:
-                raise Exception("More than one host not supported (for now).")
+        if isinstance(hosts, string_types):
+            hosts = [hosts]
 
         log.debug("Starting checkout run, using those repos:")
 
@@ -400,44 +506,300 @@ class Freckelize(object):
             log.info("No freckle repositories specified, doing nothing...")
             return
 
+        from nsbl.output import print_title
+
         print_title("starting freckelize run(s)...")
         click.echo()
-        extra_profile_vars = {}
 
-        repo_metadata_file = "repo_metadata"
+        selected = [(host,) + self.select_checkout_repos(host) for host in hosts]
+
+        checkout_hosts = OrderedDict((host, repos) for (host, metadata_sources, repos) in selected if repos)
+        checkout_metadata_files = {}
+        if checkout_hosts:
+            with prefetch_staging_dir() as staging_dir:
+                prefetched = self.prefetch_repos([r for repos in checkout_hosts.values() for r in repos], staging_dir)
+                checkout_repos = OrderedDict((host, [prefetched.get(r["id"], r) for r in repos]) for host, repos in checkout_hosts.items())
+                checkout_metadata_files = self.run_checkout(checkout_repos, no_run=no_run, output_format=output_format, forks=forks)
+
+        self.freckles_metadata = []
+        self.repo_lookup = []
+        self.profiles = []
+        self.freckle_profile = []
+        for host, metadata_sources, repos in selected:
+            (freckles_metadata, repo_lookup, freckle_profile, profiles_map) = self.read_host_metadata(
+                host, metadata_sources, repos, checkout_metadata_file=checkout_metadata_files.get(host, None))
+            self.freckles_metadata.append((host, freckles_metadata))
+            self.repo_lookup.append((host, repo_lookup))
+            self.freckle_profile.append((host, freckle_profile))
+            self.profiles.append((host, profiles_map))
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Using freckle details:")
+            log.debug(readable_json(materialize_vars(self.freckle_profile), indent=2))
+            log.debug("Using profile details:")
+            log.debug(readable_json(materialize_vars(self.profiles), indent=2))
 
-        extra_profile_vars = {}
-        # extra_profile_vars.setdefault("freckle", {})["no_run"] = bool(no_run)
+        return (self.freckle_profile, self.profiles)
+
+    def select_checkout_repos(self, host):
+        """Decides which freckle repos of a host need the checkout play.
+
+        Repos that are local folders on a local host are scanned natively, and (in incremental mode) repos that
+        didn't change since the last checkout use the stored metadata. All other repos need the checkout play.
+
+        Args:
+          host (str): the host
+        Returns:
+          tuple: a tuple of the form (metadata_sources, repos), metadata_sources being a list of iterators of folder metadata, repos the expanded repo descriptions that need the checkout play
+        """
 
+        # all metadata sources are iterators, so folders are processed one at a time
+        metadata_sources = []
         repos = []
         for id, r in self.all_repos.items():
-            repos.append(r.repo_desc)
+            native_scan = r.repo_desc["checkout_skip"] and r.repo_desc["type"] == "local_folder" and is_local_host(host)
+
+            # file lists for natively scanned folders are added later, only where needed
+            repo_desc = copy.copy(r.repo_desc)
+            repo_desc["add_file_list"] = not native_scan and self.repo_needs_file_list(r)
 
-        task_config = [{"vars": {"freckles": repos, "user_vars": extra_profile_vars, "repo_metadata_file": repo_metadata_file}, "tasks": ["freckles_checkout"]}]
+            # the walk of the native scan also provides the fingerprint, so the folder is only walked once
+            tree = None
+            if native_scan:
+                try:
+                    tree = walk_local_freckle(repo_desc, exclude_dirs=DEFAULT_EXCLUDE_DIRS)
+                except (OSError) as e:
+                    log.debug("Can't read local freckle folder '{}', using checkout run instead: {}".format(r.repo_desc["remote_url"], e))
+                    repo_desc["add_file_list"] = self.repo_needs_file_list(r)
+                    native_scan = False
+
+            if self.incremental and is_local_host(host):
+                fingerprint = tree[2] if tree is not None else None
+                cached_metadata = self.checkout_state.get_cached_metadata(repo_desc, fingerprint=fingerprint)
+                if cached_metadata is not None:
+                    log.debug("Repo '{}' didn't change since last checkout, skipping it.".format(r.source["url"]))
+                    metadata_sources.append(cached_metadata)
+                    continue
+
+            if native_scan:
+                # nothing to copy, so no need to start Ansible just to read the metadata
+                scanned_metadata = scan_local_freckle(repo_desc, METADATA_CONTENT_KEY, exclude_dirs=DEFAULT_EXCLUDE_DIRS, tree=tree)
+                if self.incremental:
+                    scanned_metadata = self.checkout_state.record([repo_desc], scanned_metadata, fingerprints={repo_desc["id"]: tree[2]})
+                metadata_sources.append(scanned_metadata)
+                continue
 
-        result_checkout = create_and_run_nsbl_runner(task_config, output_format=output_format, ask_become_pass=self.ask_become_pass, password=self.password,
-                                            no_run=no_run, run_box_basics=True, hosts_list=hosts)
+            repos.append(repo_desc)
 
-        playbook_dir = result_checkout["playbook_dir"]
+        return (metadata_sources, repos)
+
+    @timed("prefetch")
+    def prefetch_repos(self, repos, staging_dir):
+        """Downloads git repos and remote archives to the local machine, in parallel.
+
+        That way the network-bound part of the checkout doesn't happen one repo at a time within the checkout
+        play, which then only copies the local copies into place. Repos that can't be prefetched are checked
+        out by the play itself.
+
+        Args:
+          repos (list): the expanded repo descriptions that need the checkout play
+          staging_dir (str): the folder to download repos into
+        Returns:
+          dict: the repo id as key, the repo description of the local copy as value
+        """
+
+        to_prefetch = OrderedDict()
+        for repo_desc in repos:
+            if repo_desc["id"] not in to_prefetch:
+                to_prefetch[repo_desc["id"]] = repo_desc
+
+        results = run_concurrently(lambda repo_desc: prefetch_repo(repo_desc, staging_dir), to_prefetch.values(), max_workers=self.checkout_workers)
+
+        prefetched = {}
+        for repo_id, local_desc in zip(to_prefetch.keys(), results):
+            if local_desc is None:
+                log.debug("Can't prefetch repo '{}', checking it out in the checkout run.".format(to_prefetch[repo_id]["remote_url"]))
+                continue
+            prefetched[repo_id] = local_desc
+
+        return prefetched
+
+    @timed("host_metadata")
+    def read_host_metadata(self, host, metadata_sources, repos, checkout_metadata_file=None):
+        """Reads the metadata of all freckle repos of a single host.
+
+        Args:
+          host (str): the host
+          metadata_sources (list): iterators of folder metadata of the repos that don't need the checkout play, as returned by :meth:`select_checkout_repos`
+          repos (list): the expanded repo descriptions of the repos that were checked out by the checkout play
+          checkout_metadata_file (str): the metadata file the checkout play wrote for this host, as returned by :meth:`run_checkout`
+        Returns:
+          tuple: a tuple of the form (freckles_metadata, repo_lookup, freckle_profile, profiles_map)
+        """
+
+        metadata_sources = list(metadata_sources)
+        if repos and checkout_metadata_file is not None:
+            checkout_metadata = iter_metadata_file(checkout_metadata_file)
+            # TODO: delete file?
+
+            # state is recorded for the original repos (not their prefetched copies), so it's fingerprinted against the remote
+            if self.incremental and is_local_host(host):
+                checkout_metadata = self.checkout_state.record(repos, checkout_metadata)
+
+            metadata_sources.append(checkout_metadata)
+
+        all_repo_metadata = itertools.chain(*metadata_sources)
 
-        repo_metadata_file_abs = os.path.join(playbook_dir, os.pardir, "logs", repo_metadata_file)
+        # folders are sorted by repo priority when they are prepared, so the order of the sources doesn't matter
+        folders_metadata = self.read_checkout_metadata(all_repo_metadata)
+        (freckles_metadata, repo_lookup, repo_index) = self.prepare_checkout_metadata(folders_metadata)
+
+        freckle_profile = self.process_freckle_profile_vars(freckles_metadata.get("freckle"))
+
+        profiles_map = self.calculate_profiles_to_run(freckles_metadata, repo_lookup, repo_index)
+        self.process_profiles_vars(profiles_map, freckle_profile)
+
+        self.add_folder_file_lists(host, freckle_profile, profiles_map)
+
+        return (freckles_metadata, repo_lookup, freckle_profile, profiles_map)
+
+    @timed("checkout_play")
+    def run_checkout(self, checkout_repos, no_run=False, output_format="default", forks=DEFAULT_FRECKELIZE_FORKS):
+        """Runs the 'freckles_checkout' play for all hosts that have repos to check out, in a single run.
+
+        Each host gets its own list of repos, and writes its own metadata file, both selected by inventory hostname.
+
+        Args:
+          checkout_repos (OrderedDict): the host as key, a list of expanded repo descriptions as value
+          no_run (bool): whether to only create the Ansible environment, without executing it
+          output_format (str): the output format to use
+          forks (int): the maximum number of hosts to process in parallel
+        Returns:
+          dict: the host as key, the path to its resulting metadata file as value
+        """
+
+        hosts = list(checkout_repos.keys())
+        host_repos = dict((get_inventory_hostname(host), repos) for host, repos in checkout_repos.items())
+        extra_profile_vars = {}
+        # extra_profile_vars.setdefault("freckle", {})["no_run"] = bool(no_run)
+
+        task_config = [{"vars": {"freckles": HOST_VAR_TEMPLATE.format("freckelize_checkout_repos"),
+                                 "freckelize_checkout_repos": host_repos,
+                                 "user_vars": extra_profile_vars,
+                                 "repo_metadata_file": REPO_METADATA_FILE_TEMPLATE.format("{{ inventory_hostname }}")},
+                        "tasks": ["freckles_checkout"]}]
+
+        with ansible_environment({"ANSIBLE_FORKS": str(forks)}):
+            result_checkout = run_nsbl(task_config, output_format=output_format, ask_become_pass=self.ask_become_pass, password=self.password,
+                                       no_run=no_run, run_box_basics=True, hosts_list=hosts)
+        env_key = self.run_environments.get_key("checkout", [[host, [dict((k, v) for k, v in r.items() if k not in ["id", "priority"]) for r in repos]] for host, repos in checkout_repos.items()])
+        self.run_environments.record(env_key, result_checkout)
+
+        playbook_dir = result_checkout["playbook_dir"]
 
         return_code = result_checkout["return_code"]
 
         if return_code != 0:
-            click.echo("Checkout phase failed, not continuing...")
-            sys.exit(1)
+            raise Exception("Checkout phase failed for host(s) '{}', not continuing...".format(", ".join(hosts)))
+        if not no_run:
+            self.box_basics_hosts.update(hosts)
 
         click.echo()
 
-        all_repo_metadata = json.load(open(repo_metadata_file_abs))
-        # TODO: delete file?
-        folders_metadata = self.read_checkout_metadata(all_repo_metadata)
-        (self.freckles_metadata, self.repo_lookup) = self.prepare_checkout_metadata(folders_metadata)
+        logs_dir = os.path.join(playbook_dir, os.pardir, "logs")
+        return dict((host, os.path.join(logs_dir, REPO_METADATA_FILE_TEMPLATE.format(get_inventory_hostname(host)))) for host in hosts)
+
+    def adapter_needs_file_list(self, adapter):
+        """Returns whether an adapter asks for the list of files of the folders it processes."""
+
+        if not ADD_FILES:
+            return False
+
+        header = self.get_adapter_header(adapter)
+        if header is None:
+            return False
+
+        return bool(header.get(ADAPTER_FILE_LIST_KEY, False))
+
+    def repo_needs_file_list(self, repo):
+        """Returns whether the checkout of a repo needs to include file lists.
+
+        If the adapters to use for a repo are only known after reading it's metadata, file lists are
+        always included.
+        """
+
+        if not ADD_FILES:
+            return False
+
+        for fd in self.freckle_details:
+            # repos specified more than once are only kept once (see 'all_repos'), so compare ids
+            if repo.id not in [r.id for r in fd.freckle_repos]:
+                continue
+            if fd.profiles_to_run is None:
+                return True
+            for profile in fd.profiles_to_run:
+                if self.adapter_needs_file_list(profile):
+                    return True
+
+        return False
+
+    @timed("folder_file_lists")
+    def add_folder_file_lists(self, host, freckle_profile, profiles_map):
+        """Makes sure only folders that are processed by an adapter that needs them contain file lists.
+
+        File lists that are missing are created if the host is the local machine. Folder records are
+        replaced with copies, so records that are used by more than one profile aren't affected.
+
+        Args:
+          host (str): the host
+          freckle_profile (dict): the 'freckle' profile folders, with the folder path as key
+          profiles_map (dict): the folders to process, per profile
+        """
 
-        # allow for multiple hosts in the future
+        file_lists = {}
 
-        freckle_profile_folders = self.freckles_metadata.get("freckle")
+        def folder_metadata_with_files(folder_metadata, needs_file_list):
+
+            if not needs_file_list:
+                if FOLDER_FILES_KEY in folder_metadata.keys():
+                    folder_metadata = copy.copy(folder_metadata)
+                    del folder_metadata[FOLDER_FILES_KEY]
+                return folder_metadata
+
+            if FOLDER_FILES_KEY in folder_metadata.keys() or not is_local_host(host):
+                return folder_metadata
+
+            path = folder_metadata["full_path"]
+            if path not in file_lists.keys():
+                file_lists[path] = list_freckle_files(path, exclude_dirs=DEFAULT_EXCLUDE_DIRS)
+            folder_metadata = copy.copy(folder_metadata)
+            folder_metadata[FOLDER_FILES_KEY] = file_lists[path]
+            return folder_metadata
+
+        adapters_need_file_lists = dict((p, self.adapter_needs_file_list(p)) for p in profiles_map.keys())
+        any_needs_file_list = any(adapters_need_file_lists.values())
+
+        def folder_with_files(folder, needs_file_list):
+
+            folder = copy.copy(folder)
+            folder["folder_metadata"] = folder_metadata_with_files(folder["folder_metadata"], needs_file_list)
+            return folder
+
+        for path, folder in list(freckle_profile.items()):
+            freckle_profile[path] = folder_with_files(folder, any_needs_file_list)
+
+        for profile, folders in profiles_map.items():
+            folders[:] = [folder_with_files(folder, adapters_need_file_lists[profile]) for folder in folders]
+
+    @timed("process_folder_vars")
+    def process_freckle_profile_vars(self, freckle_profile_folders):
+        """Calculates the final vars of all folders of the 'freckle' profile.
+
+        Args:
+          freckle_profile_folders (list): the 'freckle' profile folders
+        Returns:
+          dict: the folders, with their path as key
+        """
 
         freckle_profile = {}  # this is just for easy lookup by path
         for folder in freckle_profile_folders:
@@ -450,7 +812,17 @@ class Freckelize(object):
             folder["overlay_vars"] = overlay_vars
             folder["vars"] = final_vars
 
-        profiles_map = self.calculate_profiles_to_run()
+        return freckle_profile
+
+    @timed("process_folder_vars")
+    def process_profiles_vars(self, profiles_map, freckle_profile):
+        """Calculates the final vars of all folders to process, using the 'freckle' profile vars as base.
+
+        Args:
+          profiles_map (dict): the folders to process, per profile
+          freckle_profile (dict): the 'freckle' profile folders, with their path as key
+        """
+
         for profile, folders in profiles_map.items():
 
             for folder in folders:
@@ -466,53 +838,150 @@ class Freckelize(object):
                 final_vars = self.process_folder_vars(folder["folder_vars"], default_vars, overlay_vars, base_vars)
                 folder["vars"] = final_vars
 
-        self.profiles = [(hosts[0], profiles_map)]
-        self.freckle_profile = [(hosts[0], freckle_profile)]
-
-        log.debug("Using freckle details:")
-        log.debug(readable_json(self.freckle_profile, indent=2))
-        log.debug("Using profile details:")
-        log.debug(readable_json(self.profiles, indent=2))
+    def process_folder_vars(self, folder_vars, default_vars, overlay_vars, base_vars={}):
+        """Calculates the final vars of a folder.
 
-        return (self.freckle_profile, self.profiles)
+        The result is a copy-on-write view over all layers, none of the layers are copied.
 
-    def process_folder_vars(self, folder_vars, default_vars, overlay_vars, base_vars={}):
+        Args:
+          folder_vars (dict): the vars from the folders '.freckle' file
+          default_vars (dict): the default vars of the repo
+          overlay_vars (dict): the overlay vars of the repo
+          base_vars (dict): the final vars of the folders 'freckle' profile (if not calculating the 'freckle' profile itself)
+        Returns:
+          LayeredVars: the final vars, in order of increasing priority: default, folder, base, overlay
+        """
 
-        final_vars = frkl.dict_merge(default_vars, folder_vars, copy_dct=True)
-        if base_vars:
-            frkl.dict_merge(final_vars, base_vars, copy_dct=False)
-        frkl.dict_merge(final_vars, overlay_vars, copy_dct=False)
+        return LayeredVars(default_vars, folder_vars, base_vars, overlay_vars)
 
-        return final_vars
+    @timed("execute")
+    def execute(self, hosts=["localhost"], no_run=False, output_format="default", forks=DEFAULT_FRECKELIZE_FORKS):
 
-    def execute(self, hosts=["localhost"], no_run=False, output_format="default"):
+        if isinstance(hosts, string_types):
+            hosts = [hosts]
 
-        metadata = self.start_checkout_run(hosts=hosts, no_run=False, output_format=output_format)
+        self.box_basics_hosts = set()
+        try:
+            if self.shared_connection:
+                with shared_connection():
+                    self.execute_hosts(hosts, no_run=no_run, output_format=output_format, forks=forks)
+            else:
+                self.execute_hosts(hosts, no_run=no_run, output_format=output_format, forks=forks)
+        finally:
+            # all checkout metadata is read by now, so older environments aren't needed anymore
+            if self.keep_environments:
+                self.run_environments.prune(keep=self.keep_environments)
+
+    def execute_hosts(self, hosts, no_run=False, output_format="default", forks=DEFAULT_FRECKELIZE_FORKS):
+
+        plan_key = None
+        if self.reuse_plan:
+            plan_key = self.get_run_plan_key(hosts)
+            plan = None
+            if plan_key is not None:
+                plan = RUN_PLAN_CACHE.get(plan_key)
+            if plan is not None:
+                log.debug("Inputs didn't change since the last run, reusing run plan: {}".format(plan_key))
+                self.run_plan(plan, no_run=no_run, output_format=output_format, forks=forks)
+                return
+
+        metadata = self.start_checkout_run(hosts=hosts, no_run=False, output_format=output_format, forks=forks)
 
         if metadata is None:
             return None
 
-        self.start_freckelize_run(no_run=no_run, output_format=output_format)
+        self.start_freckelize_run(no_run=no_run, output_format=output_format, forks=forks, plan_key=plan_key)
+
+    @timed("run_plan_key")
+    def get_run_plan_key(self, hosts):
+        """Calculates the key of the run plan for this invocation.
+
+        The key covers all repo descriptions and vars, the requested profiles, the hosts, the content of all
+        available adapters, and the fingerprints of all repos. Run plans can only be reused if every host
+        is the local machine, and every repo can be fingerprinted (see :meth:`checkout.repo_fingerprint`).
+
+        Args:
+          hosts (list): the hosts
+        Returns:
+          str: the key, or None if the run plan can't be reused
+        """
+
+        if not all(is_local_host(h) for h in hosts):
+            log.debug("Not all hosts are local, not using run plan cache.")
+            return None
+
+        repos = []
+        for fd in self.freckle_details:
+            fd_repos = []
+            for r in fd.freckle_repos:
+                fingerprint = repo_fingerprint(r.repo_desc, exclude_dirs=DEFAULT_EXCLUDE_DIRS)
+                if fingerprint is None:
+                    log.debug("Can't fingerprint repo '{}', not using run plan cache.".format(r.source["url"]))
+                    return None
+                fd_repos.append([r.repo_desc, r.default_vars, r.overlay_vars, fingerprint])
+            repos.append([fd.profiles_to_run, fd_repos])
+
+        adapters = []
+        for name, details in self.finder.get_all_dictlets().items():
+            try:
+                adapters.append([name, details["path"], hash_file(details["path"])])
+            except (IOError, OSError) as e:
+                log.debug("Can't hash adapter '{}', not using run plan cache: {}".format(name, e))
+                return None
+
+        return hash_object([RUN_PLAN_FORMAT_VERSION, freckles_version, ADD_FILES, hosts, repos, self.finder.paths, adapters])
+
+    @timed("freckelize_run")
+    def start_freckelize_run(self, no_run=False, output_format="default", forks=DEFAULT_FRECKELIZE_FORKS, plan_key=None):
+        """Executes the processing run on all hosts the checkout run was executed on.
 
-    def start_freckelize_run(self, no_run=False, output_format="default"):
+        Args:
+          no_run (bool): whether to only create the Ansible environment, without executing it
+          output_format (str): the output format to use
+          forks (int): the maximum number of hosts to process in parallel
+          plan_key (str): if provided, the run plan is cached under this key
+        """
 
-        if self.freckles_metadata is None:
+        if self.profiles is None:
             raise Exception("Checkout not run yet, can't continue.")
 
         log.debug("Starting freckelize run...")
 
-        host = self.profiles[0][0]
-        hosts_list = [host]
-        freckelize_metadata = self.profiles[0][1]
-        freckelize_freckle_metadata = self.freckle_profile[0][1]
-        valid_adapters, adapters_files_map = self.create_adapters_files_map(freckelize_metadata.keys())
+        plan = self.create_run_plan()
+        if plan is None:
+            click.echo("No valid adapters found, doing nothing...")
+            return None
+
+        if plan_key is not None:
+            RUN_PLAN_CACHE.put(plan_key, plan)
+
+        self.run_plan(plan, no_run=no_run, output_format=output_format, forks=forks)
+
+    @timed("create_run_plan")
+    def create_run_plan(self):
+        """Resolves adapters, and assembles everything the processing run needs.
+
+        Adapters are resolved once, and shared by all hosts. The result only contains plain, json-serializable
+        data, so it can be cached.
+
+        Returns:
+          OrderedDict: the run plan, or None if no valid adapters were found
+        """
+
+        all_adapters = OrderedDict()
+        for host, freckelize_metadata in self.profiles:
+            for adapter in freckelize_metadata.keys():
+                all_adapters[adapter] = True
+
+        # every one of those adapters has folders to process, so its task lists are needed and it's read in full,
+        # cached headers only avoid parsing adapters that were selected but have no folders
+        valid_adapters, adapters_files_map = self.create_adapters_files_map(all_adapters.keys())
 
         task_list_aliases = {}
         for name, details in adapters_files_map.items():
             task_list_aliases[name] = details["play_target"]
 
         if not valid_adapters:
-            click.echo("No valid adapters found, doing nothing...")
             return None
 
         # special case for 'ansible-tasks'
@@ -520,23 +989,65 @@ class Freckelize(object):
             # it's still possible to add the confirmation via an extra var file,
             # but I think that's ok. Happy to hear suggestions if you think this is
             # too risky though.
-            p_md = freckelize_metadata["ansible-tasks"]
-            confirmation = False
-            for md in p_md:
-                if md["overlay_vars"].get("ansible_tasks_user_confirmation", False):
-                    confirmation = True
-                    break;
-            if not confirmation:
-                raise click.ClickException("As the ansible-tasks adapter can execute arbitrary code, user confirmation is necessary to  use this adatper. Consult the output of 'freckelize ansible-tasks --help' or XXX for more information.")
+            for host, freckelize_metadata in self.profiles:
+                p_md = freckelize_metadata.get("ansible-tasks", [])
+                if not p_md:
+                    continue
+                confirmation = False
+                for md in p_md:
+                    if md["overlay_vars"].get("ansible_tasks_user_confirmation", False):
+                        confirmation = True
+                        break;
+                if not confirmation:
+                    raise click.ClickException("As the ansible-tasks adapter can execute arbitrary code, user confirmation is necessary to  use this adatper. Consult the output of 'freckelize ansible-tasks --help' or XXX for more information.")
+
+        additional_roles = self.get_adapter_dependency_roles(valid_adapters.keys())
+        sorted_adapters = self.sort_adapters_by_priority(valid_adapters.keys())
+        # all adapters are read by now
+        flush_adapter_caches()
+
+        freckle_profiles = dict(self.freckle_profile)
+        hosts = []
+        for host, freckelize_metadata in self.profiles:
+            # vars are only merged into plain dicts here, right before they are handed to nsbl
+            hosts.append([host, materialize_vars(freckelize_metadata), materialize_vars(freckle_profiles[host])])
+
+        plan = OrderedDict()
+        plan["valid_adapters"] = valid_adapters
+        plan["adapters_files_map"] = adapters_files_map
+        plan["task_list_aliases"] = task_list_aliases
+        plan["additional_roles"] = sorted(additional_roles)
+        plan["sorted_adapters"] = sorted_adapters
+        plan["hosts"] = hosts
+
+        return plan
+
+    @timed("run_plan")
+    def run_plan(self, plan, no_run=False, output_format="default", forks=DEFAULT_FRECKELIZE_FORKS):
+        """Executes a run plan, as created by :meth:`create_run_plan`.
+
+        All hosts share a single run, Ansible processes at most 'forks' of them in parallel.
+
+        Args:
+          plan (dict): the run plan
+          no_run (bool): whether to only create the Ansible environment, without executing it
+          output_format (str): the output format to use
+          forks (int): the maximum number of hosts to process in parallel
+        """
+
+        valid_adapters = plan["valid_adapters"]
+        sorted_adapters = plan["sorted_adapters"]
+        task_list_aliases = plan["task_list_aliases"]
+        additional_roles = plan["additional_roles"]
+        hosts = plan["hosts"]
 
         tasks_for_callback = []
         for ad, details in valid_adapters.items():
             tasks_for_callback.append(details)
 
-        callback = create_external_task_list_callback(adapters_files_map, tasks_for_callback)
-        additional_roles = self.get_adapter_dependency_roles(valid_adapters.keys())
+        callback = create_external_task_list_callback(plan["adapters_files_map"], tasks_for_callback)
 
-        sorted_adapters = self.sort_adapters_by_priority(valid_adapters.keys())
+        from nsbl.output import print_title
 
         click.echo()
         print_title("using adapters:", title_char="-")
@@ -549,27 +1060,50 @@ class Freckelize(object):
             click.echo(": {}".format(valid_adapters[a]["path"]))
             click.secho("      folders", bold=True, nl=False)
             click.echo(":")
-            for folder in freckelize_metadata[a]:
-                full_path = folder["folder_metadata"]["full_path"]
-                click.echo("         - {}".format(full_path))
+            for host, freckelize_metadata, freckelize_freckle_metadata in hosts:
+                for folder in freckelize_metadata.get(a, []):
+                    full_path = folder["folder_metadata"]["full_path"]
+                    if len(hosts) > 1:
+                        click.echo("         - {}: {}".format(host, full_path))
+                    else:
+                        click.echo("         - {}".format(full_path))
 
         click.echo()
 
+        profiles_metadata = {}
+        freckle_metadata = {}
+        profile_order = {}
+        env_key_items = []
+        for host, freckelize_metadata, freckelize_freckle_metadata in hosts:
+            inventory_hostname = get_inventory_hostname(host)
+            host_adapters = [a for a in sorted_adapters if a in freckelize_metadata.keys()]
+            profiles_metadata[inventory_hostname] = freckelize_metadata
+            freckle_metadata[inventory_hostname] = freckelize_freckle_metadata
+            profile_order[inventory_hostname] = host_adapters
+            env_key_items.append([host, [[a, [f["folder_metadata"]["full_path"] for f in freckelize_metadata[a]]] for a in host_adapters]])
+
         task_config = [
-            {"vars": {},
+            {"vars": {"freckelize_hosts_profiles_metadata": profiles_metadata,
+                      "freckelize_hosts_freckle_metadata": freckle_metadata,
+                      "freckelize_hosts_profile_order": profile_order},
              "tasks": [{"freckles":
                         # {"user_vars": {},
-                         {"freckelize_profiles_metadata": freckelize_metadata,
-                         "freckelize_freckle_metadata": freckelize_freckle_metadata,
-                         "profile_order": sorted_adapters,
+                         {"freckelize_profiles_metadata": HOST_VAR_TEMPLATE.format("freckelize_hosts_profiles_metadata"),
+                         "freckelize_freckle_metadata": HOST_VAR_TEMPLATE.format("freckelize_hosts_freckle_metadata"),
+                         "profile_order": HOST_VAR_TEMPLATE.format("freckelize_hosts_profile_order"),
                           "task_list_aliases": task_list_aliases}}]}]
 
         additional_repo_paths = []
+        # with shared connections, facts gathered in the checkout run are still cached
+        run_box_basics = not (self.shared_connection and all(host in self.box_basics_hosts for host, _, _ in hosts))
 
-        result = create_and_run_nsbl_runner(
-            task_config, output_format=output_format, ask_become_pass=self.ask_become_pass, password=self.password,
-            pre_run_callback=callback, no_run=no_run, additional_roles=additional_roles,
-            run_box_basics=True, additional_repo_paths=additional_repo_paths, hosts_list=hosts_list)
+        with self.timings.phase("freckelize_play"), ansible_environment({"ANSIBLE_FORKS": str(forks)}):
+            result = run_nsbl(
+                task_config, output_format=output_format, ask_become_pass=self.ask_become_pass, password=self.password,
+                pre_run_callback=callback, no_run=no_run, additional_roles=additional_roles,
+                run_box_basics=run_box_basics, additional_repo_paths=additional_repo_paths, hosts_list=[host for host, _, _ in hosts])
+        env_key = self.run_environments.get_key("freckelize", env_key_items)
+        self.run_environments.record(env_key, result)
 
         click.echo()
         if no_run:
@@ -581,33 +1115,39 @@ class Freckelize(object):
             click.echo("Variables that would have been used for an actual run:")
             click.echo()
 
-            click.secho("Profiles:", bold=True)
-            click.secho("--------", bold=True)
-            for profile, folders in freckelize_metadata.items():
-                click.echo()
-                click.secho("profile: ", bold=True, nl=False)
-                click.echo("{}".format(profile))
+            for host, freckelize_metadata, freckelize_freckle_metadata in hosts:
+                if len(hosts) > 1:
+                    click.secho("Host: ", bold=True, nl=False)
+                    click.echo(host)
+                    click.echo()
+                click.secho("Profiles:", bold=True)
+                click.secho("--------", bold=True)
+                for profile, folders in freckelize_metadata.items():
+                    click.echo()
+                    click.secho("profile: ", bold=True, nl=False)
+                    click.echo("{}".format(profile))
+                    click.echo()
+                    for folder in folders:
+                        folder_metadata = folder["folder_metadata"]
+                        click.secho("  path: ", bold=True, nl=False)
+                        click.echo(folder_metadata["full_path"])
+                        if folder["vars"]:
+                            click.secho("  vars: ", bold=True, nl=True)
+                            output(folder["vars"], output_type="yaml", indent=4, nl=False)
+                            click.echo(u"\u001b[2K\r", nl=False)
+                        else:
+                            click.secho("  vars: ", bold=True, nl=False)
+                            click.echo("none")
+                        if folder["extra_vars"]:
+                            click.secho("  extra vars:", bold=True)
+                            output(folder["extra_vars"], output_type="yaml", indent=4)
+                        else:
+                            click.secho("  extra_vars: ", bold=True, nl=False)
+                            click.echo("none")
                 click.echo()
-                for folder in folders:
-                    folder_metadata = folder["folder_metadata"]
-                    click.secho("  path: ", bold=True, nl=False)
-                    click.echo(folder_metadata["full_path"])
-                    if folder["vars"]:
-                        click.secho("  vars: ", bold=True, nl=True)
-                        output(folder["vars"], output_type="yaml", indent=4, nl=False)
-                        click.echo(u"\u001b[2K\r", nl=False)
-                    else:
-                        click.secho("  vars: ", bold=True, nl=False)
-                        click.echo("none")
-                    if folder["extra_vars"]:
-                        click.secho("  extra vars:", bold=True)
-                        output(folder["extra_vars"], output_type="yaml", indent=4)
-                    else:
-                        click.secho("  extra_vars: ", bold=True, nl=False)
-                        click.echo("none")
-            click.echo()
 
 
+    @timed("resolve_adapters")
     def sort_adapters_by_priority(self, adapters):
 
         if not adapters:
@@ -617,13 +1157,14 @@ class Freckelize(object):
 
         for adapter in adapters:
 
-            metadata = self.get_adapter_metadata(adapter)
-            priority = metadata.get("__freckles__", {}).get("adapter_priority", DEFAULT_FRECKELIZE_PROFILE_PRIORITY)
+            header = self.get_adapter_header(adapter) or {}
+            priority = header.get("adapter_priority", DEFAULT_FRECKELIZE_PROFILE_PRIORITY)
             prios.append([priority, adapter])
 
         profiles_sorted = sorted(prios, key=lambda tup: tup[0])
         return [item[1] for item in profiles_sorted]
 
+    @timed("resolve_adapters")
     def get_adapter_dependency_roles(self, adapters):
 
         if not adapters:
@@ -632,8 +1173,8 @@ class Freckelize(object):
         all_deps = set()
         for adapter in adapters:
 
-            metadata = self.get_adapter_metadata(adapter)
-            roles = metadata.get("__freckles__", {}).get("roles", [])
+            header = self.get_adapter_header(adapter) or {}
+            roles = header.get("roles", [])
             all_deps |= set(roles)
 
         return list(all_deps)
@@ -643,6 +1184,23 @@ class Freckelize(object):
         adapter_details = self.finder.get_dictlet(adapter)
         return adapter_details
 
+    def get_adapter_header(self, adapter):
+        """Returns the header (priority, roles, file list flag) of an adapter.
+
+        Doesn't parse the adapter if it's header is cached already, see :meth:`FreckelizeAdapterReader.read_adapter_header`.
+
+        Args:
+          adapter (str): the adapter name
+        Returns:
+          OrderedDict: the header, or None if no adapter with that name exists
+        """
+
+        adapter_details = self.get_adapter_details(adapter)
+        if adapter_details is None:
+            return None
+
+        return self.reader.read_adapter_header(adapter_details)
+
     def get_adapter_metadata(self, adapter):
 
         adapter_details = self.get_adapter_details(adapter)
@@ -652,8 +1210,11 @@ class Freckelize(object):
 
         return adapter_metadata
 
+    @timed("resolve_adapters")
     def create_adapters_files_map(self, adapters):
 
+        import yaml
+
         files_map = {}
         valid_adapters = OrderedDict()
 
@@ -691,11 +1252,24 @@ class Freckelize(object):
 
         return (valid_adapters, files_map)
 
-    def calculate_profiles_to_run(self):
+    @timed("calculate_profiles_to_run")
+    def calculate_profiles_to_run(self, freckles_metadata, repo_lookup, repo_index=None):
+        """Calculates which folders to process with which profile.
+
+        Args:
+          freckles_metadata (dict): the folders available per profile, as returned by :meth:`prepare_checkout_metadata`
+          repo_lookup (dict): the folder paths per repo id, as returned by :meth:`prepare_checkout_metadata`
+          repo_index (dict): the folders per profile, per repo id, as returned by :meth:`prepare_checkout_metadata` (will be created if not provided)
+        Returns:
+          OrderedDict: the profile name as key, a list of folders as value (copies, so per-profile values can be added to them)
+        """
 
-        if self.freckles_metadata is None:
+        if freckles_metadata is None:
             raise Exception("Checkout not run yet, can't calculate profiles to run.")
 
+        if repo_index is None:
+            repo_index = self.create_repo_index(freckles_metadata)
+
         all_profiles = OrderedDict()
         for fd in self.freckle_details:
             if fd.profiles_to_run is None:
@@ -703,7 +1277,7 @@ class Freckelize(object):
                 run_map = OrderedDict()
 
                 for repo in fd.freckle_repos:
-                    fd_folders = self.get_freckle_folders_for_repo(repo.id)
+                    fd_folders = self.get_freckle_folders_for_repo(repo.id, repo_index)
                     for p, folders in fd_folders.items():
                         if p == "freckle":
                             continue
@@ -711,19 +1285,19 @@ class Freckelize(object):
                             if not folder["folder_vars"].get("__auto_run__", True):
                                 click.echo("  - auto-run disabled for profile '{}' in folder '{}', ignoring...".format(p, folder["folder_metadata"]["folder_name"]))
                             else:
-                                all_profiles.setdefault(p, []).append(folder)
+                                all_profiles.setdefault(p, []).append(copy.copy(folder))
             else:
                 for profile in fd.profiles_to_run:
                     for repo in fd.freckle_repos:
-                        paths_to_get = copy.deepcopy(self.repo_lookup[repo.id])
-                        profile_folders = self.get_freckle_folders_for_repo(repo.id)
+                        paths_to_get = OrderedDict(repo_lookup.get(repo.id, {}))
+                        profile_folders = self.get_freckle_folders_for_repo(repo.id, repo_index)
                         # first check if there is a folder that has profile-specific vars
                         for f in profile_folders.get(profile, []):
                             full_path = f["folder_metadata"]["full_path"]
                             if full_path in paths_to_get:
                                 log.debug("Using '{}' profile folder for path: {}".format(profile, full_path))
-                                all_profiles.setdefault(profile, []).append(f)
-                                paths_to_get.remove(full_path)
+                                all_profiles.setdefault(profile, []).append(copy.copy(f))
+                                del paths_to_get[full_path]
 
                         # if there are still folders left, we use the 'freckle' ones
                         if paths_to_get:
@@ -731,31 +1305,51 @@ class Freckelize(object):
                                 full_path = f["folder_metadata"]["full_path"]
                                 if full_path in paths_to_get:
                                     log.debug("Using 'freckle' profile folder for path: {}".format(full_path))
-                                    all_profiles.setdefault(profile, []).append(f)
-                                    paths_to_get.remove(full_path)
+                                    all_profiles.setdefault(profile, []).append(copy.copy(f))
+                                    del paths_to_get[full_path]
 
                         if paths_to_get:
-                            raise Exception("Could not find all folders for profile '{}'. Leftover: {}".format(profile, paths_to_get))
+                            raise Exception("Could not find all folders for profile '{}'. Leftover: {}".format(profile, list(paths_to_get.keys())))
 
         return all_profiles
 
-    def get_freckle_folders_for_repo(self, repo_id):
+    def get_freckle_folders_for_repo(self, repo_id, repo_index):
 
-        if self.freckles_metadata is None:
+        if repo_index is None:
             raise Exception("Checkout not run yet, can't calculate freckle folders.")
 
-        repos = OrderedDict()
+        return repo_index.get(repo_id, OrderedDict())
+
+    def create_repo_index(self, freckles_metadata):
+        """Creates a lookup index for the available folders of all repos.
 
-        for profile, details_list in self.freckles_metadata.items():
+        Args:
+          freckles_metadata (dict): the folders available per profile, as returned by :meth:`prepare_checkout_metadata`
+        Returns:
+          OrderedDict: the repo id as key, an OrderedDict with profile name as key and a list of folders as value
+        """
 
+        repo_index = OrderedDict()
+        for profile, details_list in freckles_metadata.items():
             for details in details_list:
-                if details["folder_metadata"]["parent_repo_id"] == repo_id:
-                    repos.setdefault(profile, []).append(details)
+                repo_id = details["folder_metadata"]["parent_repo_id"]
+                repo_index.setdefault(repo_id, OrderedDict()).setdefault(profile, []).append(details)
 
-        return repos
+        return repo_index
 
+    @timed("prepare_checkout_metadata")
     def prepare_checkout_metadata(self, folders_metadata):
+        """Sorts the processed folder metadata by profile and repo priority, and creates the lookup indexes used in later phases.
+
+        All folders are kept in memory from here on, as the profiles to run can only be calculated once every
+        folder is known. If the folder metadata is streamed from :meth:`read_checkout_metadata`, the time to
+        read it is included in this phase.
 
+        Args:
+          folders_metadata (iterator): the folder metadata, as returned by :meth:`read_checkout_metadata`
+        Returns:
+          tuple: a tuple of the form (profiles_available, repo_lookup, repo_index); repo_lookup maps each repo id to an ordered dict of it's folder paths, repo_index is described in :meth:`create_repo_index`
+        """
 
         profiles_available = OrderedDict()
         all_folders = []
@@ -769,8 +1363,7 @@ class Freckelize(object):
 
             repo_id = folder_metadata["parent_repo_id"]
             full_path = folder_metadata["full_path"]
-            if full_path not in repo_lookup.setdefault(repo_id, []):
-                repo_lookup[repo_id].append(full_path)
+            repo_lookup.setdefault(repo_id, OrderedDict())[full_path] = True
 
             profile_folder_vars = OrderedDict()
             for v in folder_vars:
@@ -788,15 +1381,55 @@ class Freckelize(object):
             if not "freckle" in profile_folder_vars.keys():
                 profiles_available.setdefault("freckle", []).append({"folder_metadata": folder_metadata, "folder_vars": {}, "extra_vars": extra_vars})
 
-        return (profiles_available, repo_lookup)
+        for details_list in profiles_available.values():
+            details_list.sort(key=lambda k: k["folder_metadata"]["repo_priority"])
+
+        repo_index = self.create_repo_index(profiles_available)
+
+        return (profiles_available, repo_lookup, repo_index)
 
     def read_checkout_metadata(self, folders_metadata):
+        """Parses and merges the metadata of all freckle folders.
+
+        Folder records are processed in chunks of 'METADATA_PARSE_CHUNK_SIZE', and the results of a chunk are
+        yielded before the next one is read, so only one chunk of raw and intermediate metadata is held at a
+        time. The metadata file contents of each chunk are parsed in one batch (see :class:`MetadataParser`),
+        if a chunk contains more than 'merge_pool_threshold' folders, their profile vars are merged in a process pool.
+
+        Args:
+          folders_metadata (iterator): the folder records, as created by the checkout run
+        Returns:
+          iterator: dicts with 'vars', 'extra_vars' and 'folder_metadata' keys, in the order of the folder records
+        """
+
+        parser = MetadataParser(merge_pool_threshold=self.merge_pool_threshold)
+        folders_metadata = iter(folders_metadata)
+        try:
+            while True:
+                with self.timings.phase("read_checkout_metadata"):
+                    chunk = list(itertools.islice(folders_metadata, METADATA_PARSE_CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    result = self.read_checkout_metadata_chunk(chunk, parser)
+                for item in result:
+                    yield item
+        finally:
+            parser.close()
+
+    def read_checkout_metadata_chunk(self, chunk, parser):
 
         temp_vars = OrderedDict()
         extra_vars = OrderedDict()
         folder_metadata_lookup = {}
 
-        for metadata in folders_metadata:
+        raw_contents = []
+        for metadata in chunk:
+            raw_contents.append(metadata.get(METADATA_CONTENT_KEY, False) or "")
+            for extra_metadata_raw in (metadata.get("extra_vars", False) or {}).values():
+                raw_contents.append(extra_metadata_raw)
+        parsed_contents = iter(parser.parse_all(raw_contents))
+
+        for metadata in chunk:
 
             repo_id = metadata["parent_repo_id"]
             folder = metadata["full_path"]
@@ -804,9 +1437,8 @@ class Freckelize(object):
             folder_metadata_lookup.setdefault(repo_id, {})[folder] = metadata
 
             raw_metadata = metadata.pop(METADATA_CONTENT_KEY, False)
+            md = next(parsed_contents)
             if raw_metadata:
-                # md = yaml.safe_load(raw_metadata)
-                md = ordered_load(raw_metadata)
                 if not md:
                     md = []
                 if isinstance(md, dict):
@@ -819,12 +1451,12 @@ class Freckelize(object):
             else:
                 md = [{"profile": {"name": "freckle"}, "vars": {}}]
 
-            temp_vars.setdefault(repo_id, {}).setdefault(folder, []).append(md)
+            temp_vars.setdefault(repo_id, OrderedDict()).setdefault(folder, []).append(md)
 
             extra_vars_raw = metadata.pop("extra_vars", False)
             if extra_vars_raw:
                 for rel_path, extra_metadata_raw in extra_vars_raw.items():
-                    extra_metadata = ordered_load(extra_metadata_raw)
+                    extra_metadata = next(parsed_contents)
                     if not extra_metadata:
                         # this means there was an empty file. We interprete that as setting a flag to true
                         extra_metadata = True
@@ -844,25 +1476,22 @@ class Freckelize(object):
                     add_key_to_dict(extra_vars.setdefault(repo_id, {}).setdefault(folder, {}), ".".join(tokens), extra_metadata)
                     # extra_vars.setdefault(folder, {}).setdefault(sub_path, {})[filename[1:-8]] = extra_metadata
 
-        result = []
+        folders = []
+        metadata_lists = []
         for repo_id, folder_map in temp_vars.items():
             for freckle_folder, metadata_list in folder_map.items():
-                chain = [frkl.FrklProcessor(DEFAULT_PROFILE_VAR_FORMAT)]
-                try:
-                    frkl_obj = frkl.Frkl(metadata_list, chain)
-                    # mdrc_init = {"append_keys": "vars/packages"}
-                    # frkl_callback = frkl.MergeDictResultCallback(mdrc_init)
-                    frkl_callback = frkl.MergeResultCallback()
-                    profile_vars_new = frkl_obj.process(frkl_callback)
-                    item = {}
-                    item["vars"] = profile_vars_new
-                    item["extra_vars"] = extra_vars.get(repo_id, {}).get(freckle_folder, {})
-                    item["folder_metadata"] = folder_metadata_lookup[repo_id][freckle_folder]
-                    result.append(item)
-                except (frkl.FrklConfigException) as e:
-                    raise Exception(
-                        "Can't read freckle metadata file '{}/.freckle': {}".format(freckle_folder, e.message))
-
-        result.sort(key=lambda k: operator.itemgetter(k["folder_metadata"]["repo_priority"]))
+                folders.append((repo_id, freckle_folder))
+                metadata_lists.append(metadata_list)
+
+        result = []
+        for (repo_id, freckle_folder), (success, profile_vars_new) in zip(folders, parser.merge_all(metadata_lists)):
+            if not success:
+                raise Exception(
+                    "Can't read freckle metadata file '{}/.freckle': {}".format(freckle_folder, profile_vars_new))
+            item = {}
+            item["vars"] = profile_vars_new
+            item["extra_vars"] = extra_vars.get(repo_id, {}).get(freckle_folder, {})
+            item["folder_metadata"] = folder_metadata_lookup[repo_id][freckle_folder]
+            result.append(item)
 
         return result
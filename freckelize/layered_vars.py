@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+"""Layered, copy-on-write views over variable dictionaries."""
+
+from __future__ import absolute_import, division, print_function
+
+from collections import OrderedDict
+
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping
+
+
+class LayeredVars(MutableMapping):
+    """A read-through view over a stack of var dictionaries.
+
+    Looking up a key returns the value of the highest layer that contains it, mappings are merged recursively
+    with the same semantics as ``frkl.dict_merge`` (a non-mapping value replaces everything below it). None of
+    the layers are copied or modified: writes and deletes only affect the view itself.
+
+    Use :meth:`to_dict` (or :func:`materialize_vars`) to get a plain (ordered) dictionary, e.g. before
+    serializing.
+
+    Args:
+      *layers (dict): the var dictionaries, lowest priority first
+    """
+
+    def __init__(self, *layers):
+
+        self.layers = []
+        for layer in layers:
+            if not layer:
+                continue
+            if isinstance(layer, LayeredVars):
+                if layer.deleted or layer.children:
+                    # deletes and nested changes can't be expressed as layers
+                    self.layers.append(layer.to_dict())
+                else:
+                    self.layers.extend(layer.layers)
+            else:
+                self.layers.append(layer)
+
+        self.local = OrderedDict()
+        self.layers.append(self.local)
+        self.deleted = set()
+        # views for nested mappings, cached so that changes to them are kept
+        self.children = {}
+
+    def __getitem__(self, key):
+
+        if key in self.deleted:
+            raise KeyError(key)
+
+        if key in self.children:
+            return self.children[key]
+
+        values = []
+        for layer in reversed(self.layers):
+            if key not in layer:
+                continue
+            value = layer[key]
+            if not isinstance(value, Mapping):
+                if not values:
+                    return value
+                break
+            values.append(value)
+
+        if not values:
+            raise KeyError(key)
+
+        child = LayeredVars(*reversed(values))
+        self.children[key] = child
+        return child
+
+    def __setitem__(self, key, value):
+
+        self.local[key] = value
+        self.children.pop(key, None)
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+
+        if key not in self:
+            raise KeyError(key)
+
+        self.local.pop(key, None)
+        self.children.pop(key, None)
+        self.deleted.add(key)
+
+    def __contains__(self, key):
+
+        if key in self.deleted:
+            return False
+        return any(key in layer for layer in self.layers)
+
+    def __iter__(self):
+
+        seen = set()
+        for layer in self.layers:
+            for key in layer:
+                if key in seen or key in self.deleted:
+                    continue
+                seen.add(key)
+                yield key
+
+    def __len__(self):
+
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+
+        return "LayeredVars({})".format(dict(self.to_dict()))
+
+    def to_dict(self):
+        """Returns a plain, merged copy of this view.
+
+        Returns:
+          OrderedDict: the merged vars
+        """
+
+        result = OrderedDict()
+        for key in self:
+            value = self[key]
+            if isinstance(value, LayeredVars):
+                value = value.to_dict()
+            result[key] = value
+
+        return result
+
+
+def materialize_vars(obj):
+    """Replaces all :class:`LayeredVars` views within an object with plain dictionaries.
+
+    Dictionaries, lists and tuples are copied if (and only if) they contain a view.
+
+    Args:
+      obj (object): the object
+    Returns:
+      object: the object, without views
+    """
+
+    if isinstance(obj, LayeredVars):
+        return obj.to_dict()
+
+    if isinstance(obj, dict):
+        items = [(k, materialize_vars(v)) for k, v in obj.items()]
+        if all(new is old for (_, new), old in zip(items, obj.values())):
+            return obj
+        result = obj.__class__() if isinstance(obj, OrderedDict) else {}
+        for k, v in items:
+            result[k] = v
+        return result
+
+    if isinstance(obj, (list, tuple)):
+        items = [materialize_vars(v) for v in obj]
+        if all(new is old for new, old in zip(items, obj)):
+            return obj
+        return obj.__class__(items)
+
+    return obj
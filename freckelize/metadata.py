@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+"""Parsing of freckle metadata ('.freckle' and '.<name>.freckle' files)."""
+
+from __future__ import absolute_import, division, print_function
+
+import copy
+import hashlib
+import logging
+import multiprocessing
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger("freckles")
+
+# minimum number of distinct, not yet parsed file contents before a process pool is used
+DEFAULT_PARSE_POOL_THRESHOLD = 2000
+# number of file contents a pool worker parses per task
+PARSE_POOL_CHUNK_SIZE = 250
+# minimum number of freckle folders before their profile vars are merged in a process pool
+DEFAULT_MERGE_POOL_THRESHOLD = 1000
+# number of folders a pool worker merges per task
+MERGE_POOL_CHUNK_SIZE = 100
+
+_ORDERED_LOADER = None
+
+
+def get_ordered_loader():
+    """Returns a yaml loader class that keeps the order of mapping keys.
+
+    The loader is based on the libyaml 'CSafeLoader' if available, and falls back to the pure-Python 'SafeLoader'.
+    """
+
+    global _ORDERED_LOADER
+    if _ORDERED_LOADER is not None:
+        return _ORDERED_LOADER
+
+    import yaml
+
+    base_loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+    class OrderedLoader(base_loader):
+        pass
+
+    def construct_mapping(loader, node):
+        loader.flatten_mapping(node)
+        return OrderedDict(loader.construct_pairs(node))
+
+    OrderedLoader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, construct_mapping)
+    _ORDERED_LOADER = OrderedLoader
+
+    return _ORDERED_LOADER
+
+
+def ordered_yaml_load(content):
+    """Parses a yaml string, keeping the order of mapping keys.
+
+    Args:
+      content (str): the yaml content
+    Returns:
+      object: the parsed content, None for empty content
+    """
+
+    import yaml
+
+    if not content or not content.strip():
+        return None
+
+    return yaml.load(content, Loader=get_ordered_loader())
+
+
+def _parse_contents(contents):
+    """Worker function for the process pool (needs to be module-level to be picklable)."""
+
+    return [ordered_yaml_load(c) for c in contents]
+
+
+def merge_profile_vars(metadata_list):
+    """Merges all (parsed) metadata of a freckle folder into a list of profile vars.
+
+    Args:
+      metadata_list (list): the parsed metadata
+    Returns:
+      list: the merged profile vars
+    """
+
+    from frkl import frkl
+    from freckles.freckles_defaults import DEFAULT_PROFILE_VAR_FORMAT
+
+    chain = [frkl.FrklProcessor(DEFAULT_PROFILE_VAR_FORMAT)]
+    frkl_obj = frkl.Frkl(metadata_list, chain)
+    # mdrc_init = {"append_keys": "vars/packages"}
+    # frkl_callback = frkl.MergeDictResultCallback(mdrc_init)
+    frkl_callback = frkl.MergeResultCallback()
+
+    return frkl_obj.process(frkl_callback)
+
+
+def _merge_profile_vars_list(metadata_lists):
+    """Worker function for the process pool.
+
+    Invalid metadata errors are returned instead of raised, as not all of them survive pickling.
+    """
+
+    from frkl import frkl
+
+    result = []
+    for metadata_list in metadata_lists:
+        try:
+            result.append((True, merge_profile_vars(metadata_list)))
+        except (frkl.FrklConfigException) as e:
+            result.append((False, getattr(e, "message", None) or str(e)))
+
+    return result
+
+
+class MetadataParser(object):
+    """Parses and merges freckle metadata.
+
+    Identical contents are only parsed once, and empty ones not at all. If a batch contains enough distinct
+    contents, or enough folders to merge, the work is distributed over a process pool.
+
+    Args:
+      processes (int): the number of processes to use, defaults to the number of cpus; 1 disables the process pool
+      pool_threshold (int): the minimum number of contents to parse before a process pool is used
+      merge_pool_threshold (int): the minimum number of folders to merge before a process pool is used, 0 to never use one
+    """
+
+    def __init__(self, processes=None, pool_threshold=DEFAULT_PARSE_POOL_THRESHOLD, merge_pool_threshold=DEFAULT_MERGE_POOL_THRESHOLD):
+
+        if processes is None:
+            try:
+                processes = multiprocessing.cpu_count()
+            except (NotImplementedError):
+                processes = 1
+        self.processes = processes
+        self.pool_threshold = pool_threshold
+        self.merge_pool_threshold = merge_pool_threshold
+        self.pool = None
+        # content hash -> parsed content
+        self.memo = {}
+
+    def get_key(self, content):
+
+        return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+    def parse_all(self, contents):
+        """Parses a list of file contents.
+
+        Args:
+          contents (list): the file contents (strings)
+        Returns:
+          list: the parsed contents, in the same order; empty contents result in None
+        """
+
+        keys = []
+        to_parse = OrderedDict()
+        for content in contents:
+            if not content or not content.strip():
+                keys.append(None)
+                continue
+            key = self.get_key(content)
+            keys.append(key)
+            if key not in self.memo and key not in to_parse:
+                to_parse[key] = content
+
+        if to_parse:
+            parsed = self.parse_distinct(list(to_parse.values()))
+            self.memo.update(zip(to_parse.keys(), parsed))
+
+        # callers might modify the results, so the memo is never handed out directly
+        result = []
+        for key in keys:
+            if key is None:
+                result.append(None)
+            else:
+                result.append(copy.deepcopy(self.memo[key]))
+
+        return result
+
+    def parse(self, content):
+        """Parses a single file content.
+
+        Args:
+          content (str): the file content
+        Returns:
+          object: the parsed content, None for empty content
+        """
+
+        return self.parse_all([content])[0]
+
+    def get_pool(self):
+        """Returns the process pool, or None if no pool can (or should) be used.
+
+        A pool is only created if no other threads are running (e.g. when processing several hosts in parallel),
+        as forking a multi-threaded process can deadlock.
+        """
+
+        if self.processes <= 1:
+            return None
+
+        if self.pool is None:
+            if threading.active_count() > 1:
+                log.debug("Other threads are running, processing metadata in-process.")
+                return None
+            try:
+                self.pool = multiprocessing.Pool(self.processes)
+            except (OSError, ImportError) as e:
+                log.debug("Could not create process pool, processing metadata in-process: {}".format(e))
+                self.processes = 1
+                return None
+
+        return self.pool
+
+    def parse_distinct(self, contents):
+
+        pool = None
+        if len(contents) >= self.pool_threshold:
+            pool = self.get_pool()
+
+        if pool is None:
+            return _parse_contents(contents)
+
+        log.debug("Parsing {} metadata files using {} processes.".format(len(contents), self.processes))
+        chunks = [contents[i:i + PARSE_POOL_CHUNK_SIZE] for i in range(0, len(contents), PARSE_POOL_CHUNK_SIZE)]
+        result = []
+        for parsed in pool.map(_parse_contents, chunks):
+            result.extend(parsed)
+
+        return result
+
+    def merge_all(self, metadata_lists):
+        """Merges the metadata of a list of folders, see :meth:`merge_profile_vars`.
+
+        Args:
+          metadata_lists (list): a list of parsed metadata lists, one per folder
+        Returns:
+          list: a tuple (success, result) per folder, in the same order; if merging failed, result is the error message
+        """
+
+        pool = None
+        if self.merge_pool_threshold and len(metadata_lists) >= self.merge_pool_threshold:
+            pool = self.get_pool()
+
+        if pool is None:
+            return _merge_profile_vars_list(metadata_lists)
+
+        log.debug("Merging metadata of {} folders using {} processes.".format(len(metadata_lists), self.processes))
+        chunks = [metadata_lists[i:i + MERGE_POOL_CHUNK_SIZE] for i in range(0, len(metadata_lists), MERGE_POOL_CHUNK_SIZE)]
+        result = []
+        for merged in pool.map(_merge_profile_vars_list, chunks):
+            result.extend(merged)
+
+        return result
+
+    def close(self):
+
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
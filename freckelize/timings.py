@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""Timing instrumentation for the phases of a freckelize run."""
+
+from __future__ import absolute_import, division, print_function
+
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import click
+
+log = logging.getLogger("freckles")
+
+TIMINGS_FORMATS = ["json", "chrome-trace"]
+
+
+class PhaseTimings(object):
+    """Records how long each phase of a freckelize run takes.
+
+    Phases can be nested, and can run in parallel in different threads. If not enabled, recording a phase
+    does nothing.
+
+    Args:
+      enabled (bool): whether to record timings
+    """
+
+    def __init__(self, enabled=True):
+
+        self.enabled = enabled
+        self.events = []
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+
+    @contextlib.contextmanager
+    def phase(self, name, **details):
+        """Context manager to time a phase.
+
+        Args:
+          name (str): the name of the phase
+          **details (dict): additional details to record (e.g. the host)
+        """
+
+        if not self.enabled:
+            yield
+            return
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            event = OrderedDict()
+            event["name"] = name
+            event["start"] = start - self.start_time
+            event["duration"] = end - start
+            event["thread"] = threading.current_thread().name
+            event["details"] = details
+            with self.lock:
+                self.events.append(event)
+
+    def summary(self):
+        """Returns the total time and number of calls per phase, in order of first occurrence.
+
+        Returns:
+          OrderedDict: phase name as key, a dict with 'total' and 'count' keys as value
+        """
+
+        result = OrderedDict()
+        for event in sorted(self.events, key=lambda e: e["start"]):
+            phase = result.setdefault(event["name"], {"total": 0.0, "count": 0})
+            phase["total"] = phase["total"] + event["duration"]
+            phase["count"] = phase["count"] + 1
+
+        return result
+
+    def print_summary(self):
+
+        summary = self.summary()
+        if not summary:
+            return
+
+        name_width = max(len(name) for name in summary.keys())
+        click.echo()
+        click.secho("Phase timings:", bold=True)
+        click.echo()
+        for name, phase in summary.items():
+            click.echo("  {}  {:>10.3f}s  {:>5}x".format(name.ljust(name_width), phase["total"], phase["count"]))
+        click.echo()
+
+    def to_dict(self):
+
+        return OrderedDict([("phases", self.summary()), ("events", self.events)])
+
+    def to_chrome_trace(self):
+        """Returns the recorded events in the Chrome trace event format.
+
+        The result can be loaded in 'chrome://tracing' or similar tools.
+        """
+
+        thread_ids = {}
+        trace_events = []
+        for event in self.events:
+            tid = thread_ids.setdefault(event["thread"], len(thread_ids) + 1)
+            trace_events.append({
+                "name": event["name"],
+                "cat": "freckelize",
+                "ph": "X",
+                "ts": int(event["start"] * 1000000),
+                "dur": int(event["duration"] * 1000000),
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": event["details"]
+            })
+
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def write(self, path, output_format="json"):
+        """Writes the recorded timings to a file.
+
+        Args:
+          path (str): the output file
+          output_format (str): one of 'json' or 'chrome-trace'
+        """
+
+        if output_format == "json":
+            content = self.to_dict()
+        elif output_format == "chrome-trace":
+            content = self.to_chrome_trace()
+        else:
+            raise Exception("Timings format '{}' not supported, use one of: {}".format(output_format, ", ".join(TIMINGS_FORMATS)))
+
+        with open(os.path.expanduser(path), "w") as f:
+            json.dump(content, f, indent=2)
+
+
+def timed(phase_name):
+    """Decorator to record the time a method takes, using the 'timings' attribute of it's object."""
+
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+
+            with self.timings.phase(phase_name):
+                return func(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -3,18 +3,27 @@
 from __future__ import absolute_import, division, print_function
 
 import copy
-import fnmatch
+import io
 import logging
+import re
+import threading
+import weakref
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
-import nsbl
 from frkl import frkl
 from luci import DictletFinder, TextFileDictletReader, JINJA_DELIMITER_PROFILES, replace_string, ordered_load, \
     readable_json
 
+from freckles import __version__ as freckles_version
 from freckles.freckles_base_cli import parse_tasks_dictlet
 from freckles.freckles_defaults import *
 from freckles.utils import DEFAULT_FRECKLES_CONFIG, freckles_jinja_extensions, RepoType
+from .cache import MarkerFileIndex, PersistentLRUCache, hash_file, hash_folder, hash_object, get_cached_folder, \
+    save_cached_folder, copy_tree
+from .checkout import DEFAULT_CHECKOUT_WORKERS
+from .connection import DEFAULT_FRECKELIZE_FORKS
+from .watch import RepoWatcher, DEFAULT_POLL_INTERVAL
 
 # from .freckle_detect import create_freckle_descs
 
@@ -24,12 +33,140 @@ ADAPTER_CACHE = {}
 DEFAULT_REPO_TYPE = RepoType()
 DEFAULT_REPO_PRIORITY = 10000
 METADATA_CONTENT_KEY = "freckle_metadata_file_content"
+# how deep below a repo root to look for adapter and blueprint marker files
+MARKER_SEARCH_MAX_DEPTH = 10
+# maximum number of repos to search for adapters and blueprints in parallel
+DEFAULT_DISCOVERY_WORKERS = 8
+
+# persistent (across runs) index of all adapter files in a repo
+ADAPTER_INDEX = MarkerFileIndex("adapter_index", "*.{}".format(ADAPTER_MARKER_EXTENSION), exclude_dirs=DEFAULT_EXCLUDE_DIRS, max_depth=MARKER_SEARCH_MAX_DEPTH)
+# parsed adapter files, keyed by content hash
+ADAPTER_METADATA_CACHE = PersistentLRUCache("adapter_metadata", max_size=256)
+# the parts of adapter metadata that are needed before the checkout (file lists) and to sort adapters, keyed by path and
+# validated by file size and mtime
+ADAPTER_HEADER_CACHE = PersistentLRUCache("adapter_headers", max_size=1024)
+# the '__freckles__' keys that are part of an adapter header
+ADAPTER_HEADER_KEYS = ["adapter_priority", "roles", "add_file_list"]
 
 BLUEPRINT_CACHE = {}
+# jinja expressions whose result changes from render to render ('now' from jinja2_time, cookiecutter's random helpers)
+NON_DETERMINISTIC_TEMPLATE_PATTERN = re.compile(r"\{[{%][^}]*\b(now|random\w*)\b")
+# persistent (across runs) index of all blueprints in a repo
+BLUEPRINT_INDEX = MarkerFileIndex("blueprint_index", "*.{}".format(BLUEPRINT_MARKER_EXTENSION), exclude_dirs=DEFAULT_EXCLUDE_DIRS, max_depth=MARKER_SEARCH_MAX_DEPTH)
+
+def flush_adapter_caches():
+    """Writes the adapter metadata and header caches to disk, meant to be called once adapters are read."""
+
+    ADAPTER_METADATA_CACHE.flush()
+    ADAPTER_HEADER_CACHE.flush()
+
+
+def reload_adapter_caches():
+    """Loads the persistent adapter and blueprint caches again if other processes (e.g. runs forked from the daemon) wrote them."""
+
+    for cache in [ADAPTER_INDEX, BLUEPRINT_INDEX, ADAPTER_METADATA_CACHE, ADAPTER_HEADER_CACHE]:
+        cache.reload()
+
+
+# only set in long-running processes, see 'watch_caches'
+CACHE_WATCHER = None
+# all adapter finders, so their caches can be invalidated too
+ADAPTER_FINDERS = weakref.WeakSet()
+
+
+def watch_caches(poll_interval=DEFAULT_POLL_INTERVAL, use_inotify=True):
+    """Enables change detection for the adapter and blueprint caches.
+
+    This is only useful for long-running processes: once enabled, adapter and blueprint repos are watched
+    (using inotify if available, otherwise by polling), and cached adapters and blueprints of repos that
+    changed are evicted.
+
+    Args:
+      poll_interval (float): the minimum number of seconds between two polls, if inotify can't be used
+      use_inotify (bool): whether to use inotify if available
+    """
+
+    global CACHE_WATCHER
+    if CACHE_WATCHER is not None:
+        return
+
+    CACHE_WATCHER = RepoWatcher(exclude_dirs=DEFAULT_EXCLUDE_DIRS, poll_interval=poll_interval, use_inotify=use_inotify)
+    for path in list(ADAPTER_CACHE.keys()) + list(BLUEPRINT_CACHE.keys()):
+        CACHE_WATCHER.watch(path)
+
+
+def invalidate_repo_caches(path=None):
+    """Evicts cached adapters and blueprints of a repo.
+
+    Args:
+      path (str): the repo path, if None all entries are evicted
+    """
+
+    paths = [path]
+    if path is None:
+        paths = set(ADAPTER_CACHE.keys()) | set(BLUEPRINT_CACHE.keys())
+
+    for p in paths:
+        log.debug("Invalidating cached adapters and blueprints for: {}".format(p))
+        ADAPTER_CACHE.pop(p, None)
+        BLUEPRINT_CACHE.pop(p, None)
+        for finder in list(ADAPTER_FINDERS):
+            finder.invalidate_path(p)
+
+
+def invalidate_changed_caches(force_poll=False):
+    """Evicts cached adapters and blueprints of all repos that changed since the last check.
+
+    Does nothing if :meth:`watch_caches` wasn't called.
+
+    Args:
+      force_poll (bool): check polled repos even if the poll interval didn't pass yet
+    Returns:
+      set: the repos that changed
+    """
+
+    if CACHE_WATCHER is None:
+        return set()
+
+    changed = CACHE_WATCHER.changed_paths(force_poll=force_poll)
+    for path in changed:
+        invalidate_repo_caches(path)
+
+    return changed
+
+
+def run_concurrently(func, items, max_workers=DEFAULT_FRECKELIZE_FORKS):
+    """Calls a function for every item, using a pool of threads.
+
+    If one of the calls raises an exception, that exception is re-raised after all calls finished.
+
+    Args:
+      func (function): the function to call with each item as the only argument
+      items (list): the items
+      max_workers (int): the maximum number of concurrent calls
+    Returns:
+      list: the results, in the same order as the items
+    """
+
+    items = list(items)
+    if max_workers is None or max_workers < 1:
+        max_workers = DEFAULT_FRECKELIZE_FORKS
+
+    if len(items) <= 1 or max_workers == 1:
+        return [func(item) for item in items]
+
+    pool = ThreadPool(min(max_workers, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
 
 def get_available_blueprints(config=None):
     """Find all available blueprints."""
 
+    import nsbl
+
     log.debug("Looking for blueprints...")
     if not config:
         config = DEFAULT_FRECKLES_CONFIG
@@ -37,9 +174,8 @@ def get_available_blueprints(config=None):
     repos = nsbl.tasks.get_local_repos(config.trusted_repos, DEFAULT_LOCAL_REPO_PATH_BASE, DEFAULT_ROLE_REPOS, DEFAULT_ABBREVIATIONS)
 
     result = {}
-    for repo in repos:
-
-        blueprints = get_blueprints_from_repo(repo)
+    # all repos are searched in parallel, results are merged in repo order
+    for blueprints in run_concurrently(get_blueprints_from_repo, repos, max_workers=DEFAULT_DISCOVERY_WORKERS):
         for name, path in blueprints.items():
             result[name] = path
 
@@ -56,6 +192,7 @@ def get_blueprints_from_repo(blueprint_repo):
     if not os.path.exists(blueprint_repo) or not os.path.isdir(os.path.realpath(blueprint_repo)):
         return {}
 
+    invalidate_changed_caches()
     if blueprint_repo in BLUEPRINT_CACHE.keys():
         return BLUEPRINT_CACHE[blueprint_repo]
 
@@ -63,25 +200,106 @@ def get_blueprints_from_repo(blueprint_repo):
 
     try:
 
-        for root, dirnames, filenames in os.walk(os.path.realpath(blueprint_repo), topdown=True, followlinks=True):
-            dirnames[:] = [d for d in dirnames if d not in DEFAULT_EXCLUDE_DIRS]
-            for filename in fnmatch.filter(filenames, "*.{}".format(BLUEPRINT_MARKER_EXTENSION)):
-                blueprint_metadata_file = os.path.realpath(os.path.join(root, filename))
-                blueprint_folder = os.path.abspath(os.path.dirname(blueprint_metadata_file))
+        # only folders that changed since the last run are actually listed
+        for marker_file in BLUEPRINT_INDEX.get_markers(blueprint_repo):
+            blueprint_metadata_file = os.path.realpath(marker_file)
+            blueprint_folder = os.path.abspath(os.path.dirname(blueprint_metadata_file))
 
-                #profile_name = ".".join(os.path.basename(blueprint_metadata_file).split(".")[1:2])
-                profile_name = os.path.basename(blueprint_metadata_file).split(".")[0]
+            #profile_name = ".".join(os.path.basename(blueprint_metadata_file).split(".")[1:2])
+            profile_name = os.path.basename(blueprint_metadata_file).split(".")[0]
 
-                result[profile_name] = blueprint_folder
+            result[profile_name] = blueprint_folder
 
     except (UnicodeDecodeError) as e:
-        click.echo(" X one or more filenames in '{}' can't be decoded, ignoring. This can cause problems later. ".format(root))
+        click.echo(" X one or more filenames in '{}' can't be decoded, ignoring. This can cause problems later. ".format(blueprint_repo))
 
     BLUEPRINT_CACHE[blueprint_repo] = result
+    if CACHE_WATCHER is not None:
+        CACHE_WATCHER.watch(blueprint_repo)
 
     return result
 
 
+def get_cookiecutter_user_config():
+    """Returns the content of the cookiecutter user configuration (which can contain default context values)."""
+
+    config_file = os.environ.get("COOKIECUTTER_CONFIG", os.path.expanduser("~/.cookiecutterrc"))
+    if not os.path.isfile(config_file):
+        return None
+
+    with open(config_file) as f:
+        return f.read()
+
+
+def blueprint_is_cacheable(blueprint_folder):
+    """Returns whether a blueprint renders to the same output every time, given the same input.
+
+    Blueprints with hooks (which can run arbitrary code), custom jinja extensions, or templates (in file
+    names or content) that use the current time or random values are not.
+
+    Args:
+      blueprint_folder (str): the blueprint
+    Returns:
+      bool: whether renders of the blueprint can be cached
+    """
+
+    if os.path.isdir(os.path.join(blueprint_folder, "hooks")):
+        return False
+
+    for root, dirnames, filenames in os.walk(blueprint_folder, topdown=True):
+        dirnames[:] = [d for d in dirnames if d not in DEFAULT_EXCLUDE_DIRS]
+        for name in dirnames + filenames:
+            if NON_DETERMINISTIC_TEMPLATE_PATTERN.search(name):
+                return False
+        for filename in filenames:
+            with io.open(os.path.join(root, filename), encoding="utf-8", errors="ignore") as f:
+                content = f.read()
+            if NON_DETERMINISTIC_TEMPLATE_PATTERN.search(content):
+                return False
+            if root == blueprint_folder and filename == "cookiecutter.json" and "_extensions" in content:
+                return False
+
+    return True
+
+
+def render_blueprint(blueprint_folder, output_dir, no_input=False):
+    """Renders a (cookiecutter) blueprint into a folder.
+
+    Non-interactive renders of blueprints that always render the same way (see :func:`blueprint_is_cacheable`)
+    are cached, keyed by the content hash of the blueprint and the cookiecutter user configuration. A cache hit
+    is copied into the output folder, instead of running cookiecutter again.
+
+    Args:
+      blueprint_folder (str): the blueprint
+      output_dir (str): the folder to render the blueprint into
+      no_input (bool): whether to use the blueprint defaults instead of asking the user for values
+    """
+
+    # cookiecutter is only needed here, so we only import it here
+    from cookiecutter import __version__ as cookiecutter_version
+    from cookiecutter.main import cookiecutter
+
+    if not no_input:
+        cookiecutter(blueprint_folder, output_dir=output_dir)
+        return
+
+    key = hash_object([hash_folder(blueprint_folder, exclude_dirs=DEFAULT_EXCLUDE_DIRS), get_cookiecutter_user_config(), cookiecutter_version])
+    cache_name = os.path.join("blueprints", key)
+
+    cached = get_cached_folder(cache_name)
+    if cached is not None:
+        log.debug("Using cached render of blueprint: {}".format(blueprint_folder))
+        for name in os.listdir(cached):
+            copy_tree(os.path.join(cached, name), os.path.join(output_dir, name))
+        return
+
+    cookiecutter(blueprint_folder, output_dir=output_dir, no_input=True)
+    if blueprint_is_cacheable(blueprint_folder):
+        save_cached_folder(cache_name, output_dir)
+    else:
+        log.debug("Blueprint doesn't always render the same way, not caching it: {}".format(blueprint_folder))
+
+
 def find_freckelize_adapters(path):
     """Helper method to find freckelize adapters.
 
@@ -97,28 +315,28 @@ def find_freckelize_adapters(path):
     if not os.path.exists(path) or not os.path.isdir(os.path.realpath(path)):
         return {}
 
+    invalidate_changed_caches()
     if path in ADAPTER_CACHE.keys():
         return ADAPTER_CACHE[path]
 
     result = {}
     try:
-        for root, dirnames, filenames in os.walk(os.path.realpath(path), topdown=True, followlinks=True):
+        # only folders that changed since the last run are actually listed
+        for marker_file in ADAPTER_INDEX.get_markers(path):
+            adapter_metadata_file = os.path.realpath(marker_file)
+            # adapter_folder = os.path.abspath(os.path.dirname(adapter_metadata_file))
+            # profile_name = ".".join(os.path.basename(adapter_metadata_file).split(".")[1:2])
 
-            dirnames[:] = [d for d in dirnames if d not in DEFAULT_EXCLUDE_DIRS]
+            profile_name = os.path.basename(adapter_metadata_file).split(".")[0]
 
-            for filename in fnmatch.filter(filenames, "*.{}".format(ADAPTER_MARKER_EXTENSION)):
-                adapter_metadata_file = os.path.realpath(os.path.join(root, filename))
-                # adapter_folder = os.path.abspath(os.path.dirname(adapter_metadata_file))
-                # profile_name = ".".join(os.path.basename(adapter_metadata_file).split(".")[1:2])
-
-                profile_name = os.path.basename(adapter_metadata_file).split(".")[0]
-
-                result[profile_name] = {"path": adapter_metadata_file, "type": "file"}
+            result[profile_name] = {"path": adapter_metadata_file, "type": "file"}
 
     except (UnicodeDecodeError) as e:
-        click.echo(" X one or more filenames in '{}' can't be decoded, ignoring. This can cause problems later. ".format(root))
+        click.echo(" X one or more filenames in '{}' can't be decoded, ignoring. This can cause problems later. ".format(path))
 
     ADAPTER_CACHE[path] = result
+    if CACHE_WATCHER is not None:
+        CACHE_WATCHER.watch(path)
 
     return result
 
@@ -127,52 +345,81 @@ def find_freckelize_adapters(path):
 class FreckelizeAdapterFinder(DictletFinder):
     """Finder class for freckelize adapters.
 
+    All adapters of all paths are collected into one index (adapter name -> adapter details), which is built
+    once and only rebuilt if one of the paths changed (see :meth:`watch_caches`). If more than one path contains
+    an adapter with the same name, the one in the path that comes last wins (user repos are added after
+    the bundled ones).
+
+    Args:
+      paths (list): the repo paths to search for adapters
     """
 
     def __init__(self, paths, **kwargs):
 
         super(FreckelizeAdapterFinder, self).__init__(**kwargs)
         self.paths = paths
+        # the name -> adapter index
         self.adapter_cache = None
         self.path_cache = {}
+        self.lock = threading.RLock()
+        ADAPTER_FINDERS.add(self)
 
     def get_all_dictlet_names(self):
 
         return self.get_all_dictlets().keys()
 
     def get_all_dictlets(self):
-        """Find all freckelize adapters."""
+        """Find all freckelize adapters.
 
-        log.debug("Retrieving all dictlets")
+        Returns:
+          OrderedDict: the adapter name as key, the adapter details as value (must not be modified)
+        """
 
-        if self.adapter_cache is None:
-            self.adapter_cache = {}
-        dictlet_names = OrderedDict()
+        invalidate_changed_caches()
 
-        all_adapters = OrderedDict()
+        with self.lock:
+            if self.adapter_cache is not None:
+                return self.adapter_cache
+            missing = [p for p in self.paths if p not in self.path_cache.keys()]
 
-        for path in self.paths:
-            if path not in self.path_cache.keys():
+        # search all repos that aren't cached yet in parallel, without holding the lock: the workers
+        # might invalidate paths of this finder
+        found = run_concurrently(find_freckelize_adapters, missing, max_workers=DEFAULT_DISCOVERY_WORKERS)
+
+        with self.lock:
+            for path, adapters in zip(missing, found):
+                self.path_cache[path] = adapters
+            if self.adapter_cache is None:
+                self.adapter_cache = self.build_index()
+            return self.adapter_cache
+
+    def build_index(self):
+
+        log.debug("Building adapter index")
 
+        index = OrderedDict()
+        for path in self.paths:
+            adapters = self.path_cache.get(path, None)
+            if adapters is None:
                 adapters = find_freckelize_adapters(path)
                 self.path_cache[path] = adapters
-                frkl.dict_merge(all_adapters, adapters, copy_dct=False)
-                frkl.dict_merge(self.adapter_cache, adapters, copy_dct=False)
+            for name, details in adapters.items():
+                index[name] = details
 
-        return all_adapters
+        return index
 
-    def get_dictlet(self, name):
+    def invalidate_path(self, path):
+        """Evicts the cached adapters of one of the paths."""
 
-        log.debug("Retrieving adapter: {}".format(name))
-        if self.adapter_cache is None:
-            self.get_all_dictlet_names()
+        with self.lock:
+            if path in self.path_cache.keys():
+                del self.path_cache[path]
+                self.adapter_cache = None
 
-        dictlet = self.adapter_cache.get(name, None)
+    def get_dictlet(self, name):
 
-        if dictlet is None:
-            return None
-        else:
-            return dictlet
+        log.debug("Retrieving adapter: {}".format(name))
+        return self.get_all_dictlets().get(name, None)
 
 class FreckelizeAdapterReader(TextFileDictletReader):
     """Reads a text file and generates metadata for freckelize.
@@ -193,6 +440,92 @@ class FreckelizeAdapterReader(TextFileDictletReader):
         super(FreckelizeAdapterReader, self).__init__(**kwargs)
         self.delimiter_profile = delimiter_profile
         self.tasks_keyword = FX_TASKS_KEY_NAME
+        self.metadata_cache = ADAPTER_METADATA_CACHE
+        self.header_cache = ADAPTER_HEADER_CACHE
+
+    def get_cache_key(self, dictlet_details, *args, **kwargs):
+        """Calculates the metadata cache key for an adapter.
+
+        The key is made up of the content hash of the adapter file, and the (json) hash of all other
+        inputs of the parsing process.
+
+        Returns:
+          str: the key, or None if the adapter can't be cached
+        """
+
+        if dictlet_details.get("type", None) != "file":
+            return None
+
+        try:
+            content_hash = hash_file(dictlet_details["path"])
+        except (IOError, OSError) as e:
+            log.debug("Can't hash adapter file '{}', not caching: {}".format(dictlet_details["path"], e))
+            return None
+
+        inputs_hash = hash_object([freckles_version, self.delimiter_profile, args, kwargs])
+        return "{}-{}".format(content_hash, inputs_hash)
+
+    def read_dictlet(self, dictlet_details, *args, **kwargs):
+        """Reads and parses an adapter, using the adapter metadata cache if possible."""
+
+        key = self.get_cache_key(dictlet_details, *args, **kwargs)
+        if key is not None:
+            metadata = self.metadata_cache.get(key, None)
+            if metadata is not None:
+                log.debug("Using cached metadata for adapter: {}".format(dictlet_details["path"]))
+                return metadata
+
+        metadata = super(FreckelizeAdapterReader, self).read_dictlet(dictlet_details, *args, **kwargs)
+
+        if key is not None and metadata is not None:
+            self.metadata_cache.put(key, metadata)
+
+        return metadata
+
+    def read_adapter_header(self, dictlet_details):
+        """Returns the small part of an adapter's metadata that's needed to sort and resolve adapters.
+
+        Headers are cached across runs, and only re-read if the size or modification time of the adapter
+        file changed. That way deciding on file lists before the checkout doesn't need to read (or hash) any
+        adapter file. It doesn't make runs themselves cheaper though: every adapter in a run plan is executed,
+        so its full metadata (tasks and extra task lists) is read anyway, see :meth:`read_dictlet`.
+
+        Args:
+          dictlet_details (dict): the adapter details, as returned by the adapter finder
+        Returns:
+          OrderedDict: the '__freckles__' values for 'adapter_priority', 'roles' and 'add_file_list' (if set)
+        """
+
+        key = None
+        stat = None
+        if dictlet_details.get("type", None) == "file":
+            key = dictlet_details["path"]
+            try:
+                file_stat = os.stat(key)
+                stat = [file_stat.st_size, file_stat.st_mtime, hash_object([freckles_version, self.delimiter_profile])]
+            except (OSError) as e:
+                log.debug("Can't stat adapter file '{}', not caching header: {}".format(key, e))
+                key = None
+
+        if key is not None:
+            cached = self.header_cache.get(key, None)
+            if cached is not None and cached["stat"] == stat:
+                return cached["header"]
+
+        metadata = self.read_dictlet(dictlet_details, {}, {})
+        if metadata is None:
+            return None
+
+        freckles_metadata = metadata.get("__freckles__", {})
+        header = OrderedDict()
+        for header_key in ADAPTER_HEADER_KEYS:
+            if header_key in freckles_metadata.keys():
+                header[header_key] = freckles_metadata[header_key]
+
+        if key is not None:
+            self.header_cache.put(key, OrderedDict([("stat", stat), ("header", header)]))
+
+        return header
 
     def process_lines(self, content, current_vars):
 
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+"""Change detection for repo folders, used to invalidate in-memory caches in long-running processes."""
+
+from __future__ import absolute_import, division, print_function
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+
+from .checkout import folder_fingerprint
+
+log = logging.getLogger("freckles")
+
+DEFAULT_POLL_INTERVAL = 5.0
+
+# see 'man 7 inotify'
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+# the caches only map names to paths, so only files being added, removed or renamed matter
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify(object):
+    """Minimal inotify binding (using ctypes), watching whole folder trees.
+
+    Args:
+      exclude_dirs (list): names of folders to not watch
+    """
+
+    def __init__(self, exclude_dirs=None):
+
+        if exclude_dirs is None:
+            exclude_dirs = []
+        self.exclude_dirs = exclude_dirs
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+        # watch descriptor -> root
+        self.roots = {}
+
+    def add_tree(self, root):
+        """Adds watches for a folder and all its sub-folders.
+
+        Raises:
+          OSError: if a watch can't be added (e.g. because the watch limit is reached)
+        """
+
+        for folder, dirnames, _ in os.walk(root, topdown=True, followlinks=True):
+            dirnames[:] = [d for d in dirnames if d not in self.exclude_dirs]
+            path = folder
+            if not isinstance(path, bytes):
+                path = path.encode(sys.getfilesystemencoding())
+            wd = self.libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+            if wd < 0:
+                e = ctypes.get_errno()
+                if e in (errno.ENOENT, errno.ENOTDIR):
+                    # removed while walking
+                    continue
+                raise OSError(e, "Can't watch '{}': {}".format(folder, os.strerror(e)))
+            self.roots[wd] = root
+
+    def remove_tree(self, root):
+
+        for wd, r in list(self.roots.items()):
+            if r == root:
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.roots[wd]
+
+    def read_changed_roots(self):
+        """Returns all roots with changes since the last call, without blocking.
+
+        Returns:
+          set: the changed roots
+        """
+
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except (OSError) as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not data:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset = offset + EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost, everything could have changed
+                    changed.update(self.roots.values())
+                    continue
+                root = self.roots.get(wd, None)
+                if root is None:
+                    continue
+                if mask & IN_IGNORED:
+                    del self.roots[wd]
+                    continue
+                changed.add(root)
+
+        # new sub-folders need watches too, adding existing ones again is a no-op
+        for root in changed:
+            if os.path.isdir(root):
+                try:
+                    self.add_tree(root)
+                except (OSError) as e:
+                    log.debug("Could not update watches for '{}': {}".format(root, e))
+
+        return changed
+
+    def close(self):
+
+        os.close(self.fd)
+
+
+class RepoWatcher(object):
+    """Detects changes (added, removed or renamed files or folders) below a set of repo folders.
+
+    Uses inotify where available, and falls back to comparing folder mtimes (at most every 'poll_interval'
+    seconds) otherwise, or for repos that can't be watched.
+
+    Args:
+      exclude_dirs (list): names of folders to ignore
+      poll_interval (float): the minimum number of seconds between two polls
+      use_inotify (bool): whether to try using inotify
+    """
+
+    def __init__(self, exclude_dirs=None, poll_interval=DEFAULT_POLL_INTERVAL, use_inotify=True):
+
+        if exclude_dirs is None:
+            exclude_dirs = []
+        self.exclude_dirs = exclude_dirs
+        self.poll_interval = poll_interval
+        self.lock = threading.RLock()
+
+        self.inotify = None
+        if use_inotify and sys.platform.startswith("linux"):
+            try:
+                self.inotify = Inotify(exclude_dirs=exclude_dirs)
+            except (Exception) as e:
+                log.debug("Could not initialize inotify, polling for changes instead: {}".format(e))
+
+        self.watched = set()
+        # root -> fingerprint, for repos that are polled
+        self.fingerprints = {}
+        self.last_poll = 0
+
+    def watch(self, path):
+        """Starts watching a repo folder (if it's not watched already)."""
+
+        with self.lock:
+            if path in self.watched:
+                return
+            self.watched.add(path)
+
+            if self.inotify is not None:
+                try:
+                    self.inotify.add_tree(path)
+                    return
+                except (OSError) as e:
+                    log.debug("Could not watch '{}', polling for changes instead: {}".format(path, e))
+                    self.inotify.remove_tree(path)
+
+            self.fingerprints[path] = folder_fingerprint(path, exclude_dirs=self.exclude_dirs)
+
+    def unwatch(self, path):
+
+        with self.lock:
+            self.watched.discard(path)
+            self.fingerprints.pop(path, None)
+            if self.inotify is not None:
+                self.inotify.remove_tree(path)
+
+    def changed_paths(self, force_poll=False):
+        """Returns all watched repo folders that changed since the last call.
+
+        Args:
+          force_poll (bool): poll (non-inotify) repos, even if the poll interval didn't pass yet
+        Returns:
+          set: the changed repo folders
+        """
+
+        with self.lock:
+            changed = set()
+            if self.inotify is not None:
+                changed.update(self.inotify.read_changed_roots())
+
+            now = time.time()
+            if self.fingerprints and (force_poll or now - self.last_poll >= self.poll_interval):
+                self.last_poll = now
+                for path, old_fingerprint in list(self.fingerprints.items()):
+                    fingerprint = folder_fingerprint(path, exclude_dirs=self.exclude_dirs)
+                    if fingerprint != old_fingerprint:
+                        self.fingerprints[path] = fingerprint
+                        changed.add(path)
+
+            return changed
+
+    def close(self):
+
+        with self.lock:
+            if self.inotify is not None:
+                self.inotify.close()
+                self.inotify = None
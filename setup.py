@@ -13,7 +13,8 @@ with open('HISTORY.rst') as history_file:
 
 requirements = [
     'Click>=6.7',
-    'freckles>=0.5.4'
+    'freckles>=0.5.4',
+    'scandir;python_version<"3.5"'
 ]
 
 setup_requirements = ['pytest-runner', ]
@@ -34,7 +35,8 @@ setup(
     description="Data-centric environment management",
     entry_points={
         'console_scripts': [
-            'freckelize=freckelize.cli:cli',
+            'freckelize=freckelize:main',
+            'freckelize-daemon=freckelize.daemon:serve_cli',
         ],
     },
     install_requires=requirements,
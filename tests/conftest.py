@@ -0,0 +1,14 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Shared fixtures for the `freckelize` tests."""
+
+import pytest
+
+
+@pytest.fixture
+def cache_dir(tmpdir, monkeypatch):
+    """Points the freckelize cache to a temporary folder."""
+    path = tmpdir.mkdir("cache")
+    monkeypatch.setenv("FRECKELIZE_CACHE_DIR", str(path))
+    return path
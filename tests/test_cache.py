@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the persistent caches in `freckelize.cache`."""
+
+import os
+from collections import OrderedDict
+
+import pytest
+
+from freckelize.cache import JsonFileCache, MarkerFileIndex, PersistentLRUCache, get_cached_folder, hash_folder, copy_tree, \
+    load_json_cache, save_cached_folder
+
+
+def test_marker_index_finds_markers(cache_dir, tmpdir):
+    repo = tmpdir.mkdir("repo")
+    repo.mkdir("one").join("one.adapter.freckle").write("")
+    repo.mkdir(".git").join("two.adapter.freckle").write("")
+    repo.join("README.md").write("")
+
+    index = MarkerFileIndex("test_index", "*.adapter.freckle", exclude_dirs=[".git"])
+    markers = index.get_markers(str(repo))
+
+    assert [os.path.basename(m) for m in markers] == ["one.adapter.freckle"]
+    assert "test_index" in [os.path.splitext(f)[0] for f in os.listdir(str(cache_dir))]
+
+
+def test_marker_index_only_rescans_changed_folders(cache_dir, tmpdir, monkeypatch):
+    repo = tmpdir.mkdir("repo")
+    repo.mkdir("one").join("one.adapter.freckle").write("")
+    two = repo.mkdir("two")
+
+    MarkerFileIndex("test_index", "*.adapter.freckle").get_markers(str(repo))
+
+    two.join("two.adapter.freckle").write("")
+    os.utime(str(two), (0, 12345))
+
+    index = MarkerFileIndex("test_index", "*.adapter.freckle")
+    scanned = []
+    orig_scan_folder = index.scan_folder
+
+    def scan_folder(folder, mtime):
+        scanned.append(folder)
+        return orig_scan_folder(folder, mtime)
+
+    monkeypatch.setattr(index, "scan_folder", scan_folder)
+    markers = index.get_markers(str(repo))
+
+    assert scanned == [os.path.realpath(str(two))]
+    assert sorted(os.path.basename(m) for m in markers) == ["one.adapter.freckle", "two.adapter.freckle"]
+
+
+@pytest.mark.skipif(not hasattr(os, "geteuid") or os.geteuid() == 0, reason="permissions are not enforced for root")
+def test_marker_index_skips_unreadable_folders(cache_dir, tmpdir):
+    repo = tmpdir.mkdir("repo")
+    repo.mkdir("one").join("one.adapter.freckle").write("")
+    secret = repo.mkdir("secret")
+    secret.join("secret.adapter.freckle").write("")
+    secret.chmod(0)
+    try:
+        markers = MarkerFileIndex("test_index", "*.adapter.freckle").get_markers(str(repo))
+        assert [os.path.basename(m) for m in markers] == ["one.adapter.freckle"]
+    finally:
+        secret.chmod(0o755)
+
+    # the unreadable folder wasn't cached as empty
+    markers = MarkerFileIndex("test_index", "*.adapter.freckle").get_markers(str(repo))
+    assert sorted(os.path.basename(m) for m in markers) == ["one.adapter.freckle", "secret.adapter.freckle"]
+
+
+def test_broken_cache_file_is_ignored(cache_dir):
+    cache_dir.join("broken.json").write("{not json")
+    assert load_json_cache("broken", default={}) == {}
+
+
+def test_lru_cache_persists_and_evicts(cache_dir):
+    cache = PersistentLRUCache("test_lru", max_size=2)
+    cache.put("a", OrderedDict([("z", 1), ("y", 2)]))
+    cache.put("b", {"b": 2})
+    cache.get("a")
+    cache.put("c", {"c": 3})
+    cache.flush()
+
+    reloaded = PersistentLRUCache("test_lru", max_size=2)
+    assert reloaded.get("b") is None
+    assert list(reloaded.get("a").keys()) == ["z", "y"]
+    assert reloaded.get("c") == {"c": 3}
+
+
+def test_lru_cache_writes_on_flush(cache_dir):
+    cache = PersistentLRUCache("test_lru")
+    for i in range(10):
+        cache.put(str(i), {"value": i})
+    assert not cache_dir.join("test_lru.json").exists()
+
+    cache.flush()
+    assert PersistentLRUCache("test_lru").get("9") == {"value": 9}
+
+
+def test_lru_cache_reloads_changes_of_other_processes(cache_dir):
+    daemon = PersistentLRUCache("test_lru")
+    daemon.put("a", {"a": 1})
+    daemon.flush()
+    assert not daemon.reload()
+
+    run = PersistentLRUCache("test_lru")
+    run.put("b", {"b": 2})
+    run.flush()
+
+    assert daemon.reload()
+    assert daemon.get("b") == {"b": 2}
+    # nothing changed, so flushing doesn't overwrite what the run wrote
+    daemon.flush()
+    assert PersistentLRUCache("test_lru").get("b") == {"b": 2}
+
+
+def test_marker_index_reloads_changes_of_other_processes(cache_dir, tmpdir):
+    one = tmpdir.mkdir("one")
+    one.join("one.adapter.freckle").write("")
+    two = tmpdir.mkdir("two")
+    two.join("two.adapter.freckle").write("")
+
+    daemon = MarkerFileIndex("test_index", "*.adapter.freckle")
+    daemon.get_markers(str(one))
+    assert not daemon.reload()
+
+    MarkerFileIndex("test_index", "*.adapter.freckle").get_markers(str(two))
+
+    assert daemon.reload()
+    assert sorted(daemon.load()["roots"].keys()) == sorted([os.path.realpath(str(one)), os.path.realpath(str(two))])
+
+
+def test_lru_cache_returns_copies(cache_dir):
+    cache = PersistentLRUCache("test_lru")
+    cache.put("a", {"list": [1]})
+    cache.get("a")["list"].append(2)
+    assert cache.get("a") == {"list": [1]}
+
+
+def test_cached_folder_roundtrip(cache_dir, tmpdir):
+    source = tmpdir.mkdir("rendered")
+    source.mkdir("project").join("README.md").write("hello")
+
+    assert get_cached_folder("blueprints/abc") is None
+    save_cached_folder("blueprints/abc", str(source))
+    cached = get_cached_folder("blueprints/abc")
+    assert hash_folder(cached) == hash_folder(str(source))
+
+    target = tmpdir.join("target")
+    copy_tree(cached, str(target))
+    assert target.join("project", "README.md").read() == "hello"
+
+    # edits in the target must not end up in the cache
+    target.join("project", "README.md").write("edited")
+    assert os.path.getsize(os.path.join(cached, "project", "README.md")) == len("hello")
+
+    source.join("project", "README.md").write("changed")
+    assert hash_folder(cached) != hash_folder(str(source))
+
+
+def test_marker_index_prunes_walk(cache_dir, tmpdir):
+    repo = tmpdir.mkdir("repo")
+    repo.join("top.adapter.freckle").write("")
+    role = repo.mkdir("roles").mkdir("my-role")
+    role.join("role.adapter.freckle").write("")
+    role.mkdir("tasks").join("main.yml").write("")
+    role.join("tasks").join("hidden.adapter.freckle").write("")
+    deep = repo.mkdir("a").mkdir("b").mkdir("c")
+    deep.join("deep.adapter.freckle").write("")
+    # symlink loop
+    repo.join("a").join("loop").mksymlinkto(repo)
+
+    index = MarkerFileIndex("test_index", "*.adapter.freckle", max_depth=2)
+    markers = [os.path.relpath(m, str(repo)) for m in index.get_markers(str(repo))]
+
+    assert markers == ["top.adapter.freckle", os.path.join("roles", "my-role", "role.adapter.freckle")]
+
+    index = MarkerFileIndex("test_index_unlimited", "*.adapter.freckle")
+    markers = [os.path.relpath(m, str(repo)) for m in index.get_markers(str(repo))]
+
+    assert os.path.join("a", "b", "c", "deep.adapter.freckle") in markers
+    assert len(markers) == 3
+
+
+def test_json_file_cache(cache_dir):
+    cache = JsonFileCache("test_plans", max_entries=2)
+    plan = OrderedDict([("hosts", [["localhost", {"b": 1, "a": 2}]])])
+
+    assert cache.get("one") is None
+    assert cache.put("one", plan)
+    assert cache.get("one") == plan
+    assert list(cache.get("one")["hosts"][0][1].keys()) == ["b", "a"]
+
+    # values that don't survive serialization are not cached
+    assert not cache.put("tuple", {"a": (1, 2)})
+    assert cache.get("tuple") is None
+
+    # the oldest values are removed first
+    cache.put("two", {})
+    os.utime(str(cache_dir.join("test_plans", "two.json")), (0, 0))
+    cache.put("three", {})
+    assert cache.get("two") is None
+    assert cache.get("one") == plan
+    assert len(cache_dir.join("test_plans").listdir()) == 2
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `freckelize.checkout`."""
+
+import json
+import os
+import subprocess
+
+import pytest
+
+from freckelize.checkout import CheckoutState, folder_fingerprint, get_inventory_hostname, iter_metadata_file, \
+    list_freckle_files, prefetch_repo, repo_fingerprint, scan_local_freckle, walk_local_freckle
+
+
+@pytest.fixture
+def freckle(tmpdir):
+    """A local freckle folder."""
+    path = tmpdir.mkdir("freckle")
+    path.join(".freckle").write("- python-dev\n")
+    path.join("setup.py").write("")
+    return path
+
+
+def test_folder_fingerprint_changes_with_metadata(freckle):
+    before = folder_fingerprint(str(freckle))
+    assert before == folder_fingerprint(str(freckle))
+
+    freckle.join(".freckle").write("- python-dev:\n    python_version: 3.6\n")
+    os.utime(str(freckle.join(".freckle")), (0, 12345))
+
+    assert folder_fingerprint(str(freckle)) != before
+
+
+@pytest.mark.parametrize("host, expected", [
+    ("localhost", "localhost"),
+    ("admin@example.com", "example.com"),
+    ("ssh://admin@example.com:2222", "example.com"),
+    ("::1", "::1")
+])
+def test_get_inventory_hostname(host, expected):
+    assert get_inventory_hostname(host) == expected
+
+
+def test_checkout_state_reuses_metadata(cache_dir, freckle):
+    repo_desc = {"type": "local_folder", "checkout_skip": True, "remote_url": str(freckle), "id": "one", "priority": 100}
+    folders = [{"full_path": str(freckle), "parent_repo_id": "one", "repo_priority": 101}]
+
+    state = CheckoutState()
+    assert state.get_cached_metadata(repo_desc) is None
+    state.update(repo_desc, folders)
+
+    repo_desc["priority"] = 200
+    cached = list(state.get_cached_metadata(repo_desc))
+    assert cached == [{"full_path": str(freckle), "parent_repo_id": "one", "repo_priority": 201}]
+
+    # different settings for the same repo
+    changed_desc = dict(repo_desc, add_file_list=True)
+    assert state.get_cached_metadata(changed_desc) is None
+
+    freckle.join("new_folder").mkdir()
+    os.utime(str(freckle), (0, 12345))
+    assert state.get_cached_metadata(repo_desc) is None
+
+
+def test_checkout_state_two_repos(cache_dir, tmpdir):
+    descs = []
+    for name in ["one", "two"]:
+        path = tmpdir.mkdir(name)
+        path.join(".freckle").write("- python-dev\n")
+        descs.append({"type": "local_folder", "checkout_skip": True, "remote_url": str(path), "id": name, "priority": 100})
+
+    state = CheckoutState()
+    # one checkout run (and metadata file) per repo
+    for desc in descs:
+        folders = [{"full_path": desc["remote_url"], "parent_repo_id": desc["id"], "repo_priority": 100}]
+        assert list(state.record([desc], iter(folders))) == folders
+
+    for desc in descs:
+        cached = list(state.get_cached_metadata(desc))
+        assert [f["full_path"] for f in cached] == [desc["remote_url"]]
+
+
+def test_scan_walk_fingerprints_repo(cache_dir, freckle):
+    repo_desc = {"type": "local_folder", "checkout_skip": True, "remote_url": str(freckle), "id": "one", "priority": 100}
+    tree = walk_local_freckle(repo_desc)
+    assert tree[2] == repo_fingerprint(repo_desc)
+
+    state = CheckoutState()
+    folders = list(state.record([repo_desc], scan_local_freckle(repo_desc, "content", tree=tree), fingerprints={"one": tree[2]}))
+    assert [f["full_path"] for f in folders] == [str(freckle)]
+    assert list(state.get_cached_metadata(repo_desc, fingerprint=tree[2])) == folders
+
+    freckle.join(".python-dev.freckle").write("python_version: 3.6\n")
+    os.utime(str(freckle), (0, 12345))
+    assert walk_local_freckle(repo_desc)[2] != tree[2]
+    assert state.get_cached_metadata(repo_desc) is None
+
+
+def test_scan_local_multi_freckle(tmpdir):
+    root = tmpdir.mkdir("repo")
+    one = root.mkdir("one")
+    one.join(".freckle").write("- python-dev\n")
+    one.join("setup.py").write("")
+    one.mkdir("vars").join(".python-dev.freckle").write("python_version: 3.6\n")
+    two = root.mkdir("two")
+    two.join(".freckle").write("")
+    root.mkdir("three").join("README").write("")
+
+    repo_desc = {"remote_url": str(root), "id": "repo", "priority": 100, "include": [], "exclude": ["two"],
+                 "non_recursive": False, "add_file_list": True}
+    folders = list(scan_local_freckle(repo_desc, "content"))
+
+    assert [f["full_path"] for f in folders] == [str(one)]
+    assert folders[0]["content"] == "- python-dev\n"
+    assert folders[0]["extra_vars"] == {os.path.join("vars", ".python-dev.freckle"): "python_version: 3.6\n"}
+    assert sorted(folders[0]["files"]) == [str(one.join(".freckle")), str(one.join("setup.py")), str(one.join("vars", ".python-dev.freckle"))]
+
+
+def test_scan_local_single_freckle_non_recursive(tmpdir):
+    root = tmpdir.mkdir("repo")
+    root.mkdir("child").join(".freckle").write("")
+
+    repo_desc = {"remote_url": str(root), "id": "repo", "priority": 100, "non_recursive": True}
+    folders = list(scan_local_freckle(repo_desc, "content"))
+
+    assert [f["full_path"] for f in folders] == [str(root)]
+    assert "content" not in folders[0]
+    assert "files" not in folders[0]
+
+
+def test_scan_local_freckle_ignores_folders_and_templates(tmpdir):
+    root = tmpdir.mkdir("repo")
+    one = root.mkdir("one")
+    one.join(".freckle").write("- python-dev:\n    name: {{ name }}\n")
+    one.join(".python-dev.freckle").write("python_version: 3.6\n")
+    one.join(".dotfiles.freckle").write("name: {{ name }}\n")
+    ignored = root.mkdir("ignored")
+    ignored.join(".freckle").write("- python-dev\n")
+    ignored.join(".ignore.freckle").write("")
+    ignored.mkdir("child").join(".freckle").write("- python-dev\n")
+
+    repo_desc = {"remote_url": str(root), "id": "repo", "priority": 100}
+    folders = list(scan_local_freckle(repo_desc, "content"))
+
+    assert [f["full_path"] for f in folders] == [str(one)]
+    assert "content" not in folders[0]
+    assert folders[0]["extra_vars"] == {".python-dev.freckle": "python_version: 3.6\n"}
+
+
+@pytest.mark.skipif(not hasattr(os, "geteuid") or os.geteuid() == 0, reason="permissions are not enforced for root")
+def test_scan_local_freckle_unreadable_folder(tmpdir):
+    root = tmpdir.mkdir("repo")
+    root.join(".freckle").write("- python-dev\n")
+    secret = root.mkdir("secret")
+    secret.chmod(0)
+    try:
+        with pytest.raises(OSError):
+            scan_local_freckle({"remote_url": str(root), "id": "repo", "priority": 100}, "content")
+    finally:
+        secret.chmod(0o755)
+
+
+@pytest.mark.parametrize("as_list", [True, False])
+def test_iter_metadata_file(tmpdir, as_list):
+    records = [{"full_path": "/tmp/{}".format(i), "files": ["file_{}".format(j) for j in range(i * 10)]} for i in range(20)]
+    path = tmpdir.join("repo_metadata")
+    if as_list:
+        path.write(json.dumps(records, indent=2))
+    else:
+        path.write("\n".join(json.dumps(r) for r in records) + "\n")
+
+    assert list(iter_metadata_file(str(path), chunk_size=16)) == records
+
+
+def test_list_freckle_files_like_checkout_play(tmpdir):
+    root = tmpdir.mkdir("repo")
+    root.join(".freckle").write("")
+    root.mkdir("docs").join("index.rst").write("")
+    root.mkdir("child").join(".freckle").write("")
+    root.join("{{ name }}.txt").write("")
+    root.mkdir(".git").join("HEAD").write("")
+
+    assert sorted(list_freckle_files(str(root), exclude_dirs=[".git"])) == sorted([
+        str(root.join(".freckle")), str(root.join("docs", "index.rst")), str(root.join("child", ".freckle")),
+        os.path.join(str(root), "\\{\\{ name \\}\\}.txt")])
+
+
+def git(*args, **kwargs):
+    subprocess.check_call(["git", "-c", "user.name=test", "-c", "user.email=test@example.com"] + list(args), **kwargs)
+
+
+@pytest.fixture
+def git_repo(tmpdir):
+    """A freckle git repository, only reachable via its url."""
+    work = tmpdir.mkdir("work")
+    git("init", "--quiet", str(work))
+    work.join(".freckle").write("- python-dev\n")
+    git("add", ".freckle", cwd=str(work))
+    git("commit", "--quiet", "-m", "first", cwd=str(work))
+    url = str(tmpdir.join("remote.git"))
+    git("clone", "--quiet", "--bare", str(work), url)
+    return work, url
+
+
+def test_prefetch_git_repo(tmpdir, git_repo):
+    work, url = git_repo
+    staging = tmpdir.mkdir("staging")
+    repo_desc = {"type": "git", "remote_url": url, "checkout_skip": False, "source_delete": False,
+                 "local_parent": "~/freckles", "local_name": "remote", "id": "remote", "priority": 100}
+
+    local_desc = prefetch_repo(repo_desc, str(staging))
+    assert local_desc == dict(repo_desc, type="local_folder", remote_url=str(staging.join("remote")))
+    assert staging.join("remote", ".freckle").read() == "- python-dev\n"
+
+    # later runs update the existing clone
+    work.join(".freckle").write("- python-dev\n- ansible-tasks\n")
+    git("commit", "--quiet", "-am", "second", cwd=str(work))
+    git("push", "--quiet", url, "HEAD", cwd=str(work))
+    assert prefetch_repo(repo_desc, str(staging)) == local_desc
+    assert staging.join("remote", ".freckle").read() == "- python-dev\n- ansible-tasks\n"
+
+
+def test_prefetch_repo_failures(tmpdir):
+    staging = tmpdir.mkdir("staging")
+    missing_git = {"type": "git", "remote_url": str(tmpdir.join("missing.git")), "checkout_skip": False, "id": "git", "priority": 100}
+    missing_archive = {"type": "remote_archive", "remote_url": "file://{}".format(tmpdir.join("missing.tar.gz")), "checkout_skip": False, "id": "archive", "priority": 100}
+    local_folder = {"type": "local_folder", "remote_url": str(tmpdir), "checkout_skip": False, "id": "local", "priority": 100}
+
+    assert prefetch_repo(missing_git, str(staging)) is None
+    assert prefetch_repo(missing_archive, str(staging)) is None
+    assert prefetch_repo(local_folder, str(staging)) is None
+    assert staging.join("archive").listdir() == []
+
+
+def test_prefetch_remote_archive(tmpdir):
+    archive = tmpdir.join("freckle.tar.gz")
+    archive.write("not really an archive")
+    staging = tmpdir.mkdir("staging")
+    repo_desc = {"type": "remote_archive", "remote_url": "file://{}".format(archive), "checkout_skip": False, "source_delete": False,
+                 "local_parent": "~/freckles", "local_name": "freckle", "id": "archive", "priority": 100}
+
+    local_desc = prefetch_repo(repo_desc, str(staging))
+    assert local_desc == dict(repo_desc, type="local_archive", remote_url=str(staging.join("archive", "freckle.tar.gz")))
+    assert staging.join("archive", "freckle.tar.gz").read() == "not really an archive"
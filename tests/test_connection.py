@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the shared connection settings in `freckelize.connection`."""
+
+import os
+
+from freckelize.connection import ansible_environment, get_shared_connection_env, shared_connection
+
+
+def test_shared_connection_env():
+
+    env = get_shared_connection_env("/tmp/cp", "/tmp/facts", control_persist=60, base_env={})
+    # Ansible's default ssh args already use a master connection
+    assert "ANSIBLE_SSH_ARGS" not in env
+    assert env["ANSIBLE_SSH_CONTROL_PATH_DIR"] == "/tmp/cp"
+    assert env["ANSIBLE_GATHERING"] == "smart"
+    assert env["ANSIBLE_CACHE_PLUGIN"] == "jsonfile"
+    assert env["ANSIBLE_CACHE_PLUGIN_CONNECTION"] == "/tmp/facts"
+
+
+def test_shared_connection_env_keeps_user_settings():
+
+    base_env = {"ANSIBLE_SSH_ARGS": "-C -o ForwardAgent=yes", "ANSIBLE_GATHERING": "explicit"}
+    env = get_shared_connection_env("/tmp/cp", "/tmp/facts", base_env=base_env)
+    assert env["ANSIBLE_SSH_ARGS"].startswith("-C -o ForwardAgent=yes -o ControlMaster=auto")
+    assert "ANSIBLE_GATHERING" not in env
+
+    base_env = {"ANSIBLE_SSH_ARGS": "-o ControlMaster=no"}
+    env = get_shared_connection_env("/tmp/cp", "/tmp/facts", base_env=base_env)
+    assert "ANSIBLE_SSH_ARGS" not in env
+
+
+def test_shared_connection_restores_environment(tmpdir, monkeypatch):
+
+    monkeypatch.setenv("FRECKELIZE_CACHE_DIR", str(tmpdir))
+    monkeypatch.delenv("ANSIBLE_GATHERING", raising=False)
+    monkeypatch.delenv("ANSIBLE_CACHE_PLUGIN_CONNECTION", raising=False)
+    monkeypatch.setenv("ANSIBLE_SSH_ARGS", "-o ForwardAgent=yes")
+
+    with shared_connection() as env:
+        assert os.environ["ANSIBLE_GATHERING"] == "smart"
+        fact_cache_dir = env["ANSIBLE_CACHE_PLUGIN_CONNECTION"]
+        assert os.path.isdir(fact_cache_dir)
+        assert not fact_cache_dir.startswith(str(tmpdir))
+
+    # facts are only shared within one run
+    assert not os.path.exists(fact_cache_dir)
+    assert "ANSIBLE_GATHERING" not in os.environ
+    assert os.environ["ANSIBLE_SSH_ARGS"] == "-o ForwardAgent=yes"
+
+
+def test_ansible_environment(monkeypatch):
+
+    monkeypatch.setenv("ANSIBLE_FORKS", "2")
+    monkeypatch.delenv("ANSIBLE_GATHERING", raising=False)
+
+    with ansible_environment({"ANSIBLE_FORKS": "10", "ANSIBLE_GATHERING": "smart"}):
+        assert os.environ["ANSIBLE_FORKS"] == "10"
+        assert os.environ["ANSIBLE_GATHERING"] == "smart"
+
+    assert os.environ["ANSIBLE_FORKS"] == "2"
+    assert "ANSIBLE_GATHERING" not in os.environ
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the freckelize daemon in `freckelize.daemon`."""
+
+import os
+import subprocess
+import sys
+import textwrap
+import time
+
+import pytest
+
+from freckelize.daemon import daemon_supported, run_in_daemon
+
+SERVER_SCRIPT = textwrap.dedent("""
+    import os, sys
+    from freckelize.daemon import FreckelizeDaemon
+
+    class EchoDaemon(FreckelizeDaemon):
+
+        def reload_config(self):
+            pass
+
+        def refresh(self, force_poll=False):
+            pass
+
+        def run(self, request):
+            os.chdir(request["cwd"])
+            sys.stdout.write("args: {}\\n".format(" ".join(request["args"])))
+            sys.stdout.write("cwd: {}\\n".format(os.getcwd()))
+            sys.stdout.write("env: {}\\n".format(request["env"].get("FRECKELIZE_TEST_VAR")))
+            return 3
+
+    EchoDaemon(sys.argv[1]).serve()
+""")
+
+
+@pytest.mark.skipif(not daemon_supported(), reason="daemon not supported on this platform")
+def test_daemon_runs_requests_in_client_environment(tmpdir):
+    socket_path = str(tmpdir.join("freckelize.sock"))
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=project_dir, FRECKELIZE_DAEMON_SOCKET=socket_path, FRECKELIZE_USE_DAEMON="true",
+               FRECKELIZE_TEST_VAR="value")
+    server = subprocess.Popen([sys.executable, "-c", SERVER_SCRIPT, socket_path], stdout=subprocess.PIPE, env=env)
+    try:
+        for _ in range(100):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(0.05)
+
+        work_dir = tmpdir.mkdir("work")
+        client_script = "import sys; from freckelize.daemon import run_in_daemon; print(run_in_daemon(['one', 'two']))"
+        client = subprocess.Popen([sys.executable, "-c", client_script], stdout=subprocess.PIPE, env=env, cwd=str(work_dir))
+        output, _ = client.communicate()
+
+        assert output.decode("utf-8").splitlines() == ["args: one two", "cwd: {}".format(os.path.realpath(str(work_dir))), "env: value", "3"]
+
+        # runs are only forwarded if that is enabled
+        env["FRECKELIZE_USE_DAEMON"] = ""
+        client = subprocess.Popen([sys.executable, "-c", client_script], stdout=subprocess.PIPE, env=env, cwd=str(work_dir))
+        output, _ = client.communicate()
+
+        assert output.decode("utf-8").splitlines() == ["None"]
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def test_client_without_daemon(tmpdir, monkeypatch):
+    monkeypatch.setenv("FRECKELIZE_USE_DAEMON", "1")
+    monkeypatch.setenv("FRECKELIZE_DAEMON_SOCKET", str(tmpdir.join("missing.sock")))
+    assert run_in_daemon(["--help"]) is None
+
+    monkeypatch.setenv("FRECKELIZE_DAEMON_SOCKET", "")
+    assert run_in_daemon(["--help"]) is None
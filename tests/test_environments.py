@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the run environment book-keeping in `freckelize.environments`."""
+
+import os
+
+from freckelize.environments import RunEnvironmentRegistry
+
+
+def create_environment(tmpdir, name):
+    env = tmpdir.mkdir(name)
+    env.mkdir("plays")
+    env.mkdir("logs").join("repo_metadata").write("[]")
+    return {"playbook_dir": str(env.join("plays")), "return_code": 0}
+
+
+def test_registry_prunes_superseded_environments(cache_dir, tmpdir):
+    registry = RunEnvironmentRegistry()
+    key = registry.get_key("checkout", "localhost", ["repo"])
+    other_key = registry.get_key("checkout", "localhost", ["other_repo"])
+
+    first = create_environment(tmpdir, "run_1")
+    registry.record(key, first)
+    other = create_environment(tmpdir, "run_2")
+    registry.record(other_key, other)
+    registry.prune(keep=1)
+
+    # a new registry, as used by the next freckelize run
+    registry = RunEnvironmentRegistry()
+    second = create_environment(tmpdir, "run_3")
+    registry.record(key, second)
+    registry.record(key, {"return_code": 1})
+    registry.prune(keep=1)
+
+    assert not os.path.exists(str(tmpdir.join("run_1")))
+    assert os.path.exists(str(tmpdir.join("run_2")))
+    assert os.path.exists(str(tmpdir.join("run_3")))
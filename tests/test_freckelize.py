@@ -3,35 +3,50 @@
 
 """Tests for `freckelize` package."""
 
-import pytest
-
 from click.testing import CliRunner
 
 from freckelize import cli
-
-
-@pytest.fixture
-def response():
-    """Sample pytest fixture.
-
-    See more at: http://doc.pytest.org/en/latest/fixture.html
-    """
-    # import requests
-    # return requests.get('https://github.com/audreyr/cookiecutter-pypackage')
-
-
-def test_content(response):
-    """Sample pytest test function with the pytest fixture as an argument."""
-    # from bs4 import BeautifulSoup
-    # assert 'GitHub' in BeautifulSoup(response.content).title.string
+from freckelize.freckelize import FreckleDetails, FreckleRepo, Freckelize, get_repo_id
 
 
 def test_command_line_interface():
     """Test the CLI."""
     runner = CliRunner()
-    result = runner.invoke(cli.main)
-    assert result.exit_code == 0
-    assert 'freckelize.cli.main' in result.output
-    help_result = runner.invoke(cli.main, ['--help'])
+    help_result = runner.invoke(cli.cli, ['--help'])
     assert help_result.exit_code == 0
-    assert '--help  Show this message and exit.' in help_result.output
+    assert '--help' in help_result.output
+    assert '--profile-timings' in help_result.output
+
+
+def test_repo_ids_are_stable(tmpdir):
+    """Test that repo ids only depend on the (normalized) repo parameters."""
+    source = {"url": str(tmpdir)}
+    repo_id = get_repo_id(source, include=["one", "two"])
+    assert get_repo_id({"url": str(tmpdir) + "/"}, include=["two", "one"]) == repo_id
+    assert get_repo_id(source, include=["one"]) != repo_id
+    assert get_repo_id(dict(source, branch="develop"), include=["one", "two"]) != repo_id
+
+
+def test_two_adapters_on_one_freckle(tmpdir, monkeypatch):
+    """Test that adapters using the same freckle folder don't share their vars."""
+    path = str(tmpdir.mkdir("freckle"))
+    details = [FreckleDetails([FreckleRepo(path, default_vars={adapter: {"name": adapter}})], profiles_to_run=adapter)
+               for adapter in ["one", "two"]]
+    f = Freckelize(details)
+    assert len(f.all_repos) == 1
+    repo_id = list(f.all_repos.keys())[0]
+
+    freckle_folder = {"folder_metadata": {"full_path": path, "parent_repo_id": repo_id, "folder_name": "freckle"},
+                      "folder_vars": {}, "vars": {}}
+    repo_lookup = {repo_id: {path: True}}
+    repo_index = {repo_id: {"freckle": [freckle_folder]}}
+
+    profiles_map = f.calculate_profiles_to_run({"freckle": [freckle_folder]}, repo_lookup, repo_index)
+    f.process_profiles_vars(profiles_map, {path: freckle_folder})
+
+    assert profiles_map["one"][0]["vars"]["name"] == "one"
+    assert profiles_map["two"][0]["vars"]["name"] == "two"
+
+    # only the adapter of the second details asks for file lists
+    monkeypatch.setattr(f, "adapter_needs_file_list", lambda adapter: adapter == "two")
+    assert f.repo_needs_file_list(f.all_repos[repo_id])
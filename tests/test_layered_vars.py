@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the copy-on-write var views in `freckelize.layered_vars`."""
+
+from collections import OrderedDict
+
+from freckelize.layered_vars import LayeredVars, materialize_vars
+
+
+def test_layered_vars_merge_like_dict_merge():
+    default_vars = {"a": 1, "nested": {"x": 1, "y": 1}, "replaced": {"x": 1}}
+    folder_vars = OrderedDict([("b", 2), ("nested", {"y": 2, "z": 2})])
+    overlay_vars = {"a": 3, "replaced": "value"}
+
+    result = LayeredVars(default_vars, folder_vars, {}, overlay_vars)
+
+    assert result["a"] == 3
+    assert result["b"] == 2
+    assert result["replaced"] == "value"
+    assert result.to_dict() == {"a": 3, "nested": {"x": 1, "y": 2, "z": 2}, "replaced": "value", "b": 2}
+    assert list(result["nested"].keys()) == ["x", "y", "z"]
+
+
+def test_layered_vars_copy_on_write():
+    default_vars = {"nested": {"x": 1}, "a": 1}
+    folder_vars = {"nested": {"y": 2}}
+
+    result = LayeredVars(default_vars, folder_vars)
+    result["nested"]["x"] = 5
+    result["b"] = 2
+    del result["a"]
+
+    assert result.to_dict() == {"nested": {"x": 5, "y": 2}, "b": 2}
+    assert "a" not in result
+    assert default_vars == {"nested": {"x": 1}, "a": 1}
+    assert folder_vars == {"nested": {"y": 2}}
+
+    # views can be used as layers of other views, including their changes
+    profile_vars = LayeredVars({"c": 3}, {}, result)
+    assert profile_vars.to_dict() == {"c": 3, "nested": {"x": 5, "y": 2}, "b": 2}
+
+
+def test_materialize_vars():
+    folder_metadata = {"full_path": "/tmp"}
+    folders = {"python-dev": [{"folder_metadata": folder_metadata, "vars": LayeredVars({"a": {"b": 1}})}]}
+
+    result = materialize_vars(folders)
+
+    assert result == {"python-dev": [{"folder_metadata": {"full_path": "/tmp"}, "vars": {"a": {"b": 1}}}]}
+    assert type(result["python-dev"][0]["vars"]["a"]) is OrderedDict
+    # parts without views are not copied
+    assert result["python-dev"][0]["folder_metadata"] is folder_metadata
+    assert materialize_vars(folder_metadata) is folder_metadata
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the freckle metadata parser in `freckelize.metadata`."""
+
+import threading
+from collections import OrderedDict
+
+import pytest
+
+from freckelize.metadata import MetadataParser, ordered_yaml_load
+
+
+def test_ordered_yaml_load_keeps_key_order():
+    result = ordered_yaml_load("z: 1\na: 2\nm:\n  y: 3\n  b: 4\n")
+
+    assert isinstance(result, OrderedDict)
+    assert list(result.keys()) == ["z", "a", "m"]
+    assert list(result["m"].keys()) == ["y", "b"]
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_parser_parses_batches(processes):
+    parser = MetadataParser(processes=processes, pool_threshold=2)
+    contents = ["- python-dev:\n    a: 1\n", "", "  \n", "b: 2\n", "- python-dev:\n    a: 1\n"]
+
+    try:
+        result = parser.parse_all(contents)
+    finally:
+        parser.close()
+
+    assert result == [[{"python-dev": {"a": 1}}], None, None, {"b": 2}, [{"python-dev": {"a": 1}}]]
+    # identical contents are only parsed once
+    assert len(parser.memo) == 2
+    # but every result is a separate object
+    assert result[0] is not result[4]
+    result[0][0]["python-dev"]["a"] = 5
+    assert parser.parse("- python-dev:\n    a: 1\n") == [{"python-dev": {"a": 1}}]
+
+
+def test_parser_doesnt_fork_from_threads():
+    parser = MetadataParser(processes=2)
+    pools = []
+    thread = threading.Thread(target=lambda: pools.append(parser.get_pool()))
+    thread.start()
+    thread.join()
+
+    assert pools == [None]
+    assert parser.pool is None
+
+
+def test_parser_merges_in_order():
+    pytest.importorskip("frkl")
+    pytest.importorskip("freckles")
+
+    metadata_lists = [[[{"profile": {"name": "freckle"}, "vars": {"index": i}}]] for i in range(10)]
+
+    serial = MetadataParser(processes=1).merge_all(metadata_lists)
+    parser = MetadataParser(processes=2, merge_pool_threshold=2)
+    try:
+        parallel = parser.merge_all(metadata_lists)
+    finally:
+        parser.close()
+
+    assert all(success for success, _ in serial)
+    assert parallel == serial
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for which modules the `freckelize` command imports at startup."""
+
+import json
+import subprocess
+import sys
+
+import pytest
+
+HEAVY_MODULES = ["cookiecutter", "nsbl", "yaml", "luci", "frkl", "freckles", "click_completion", "freckelize.cli",
+                 "freckelize.command", "freckelize.freckelize"]
+
+
+def loaded_modules(code):
+    """Runs python code in a fresh interpreter, and returns which of the heavy modules got imported."""
+    script = "{}\nimport sys, json\nprint(json.dumps([m for m in {} if m in sys.modules]))".format(code, HEAVY_MODULES)
+    output = subprocess.check_output([sys.executable, "-c", script])
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def test_version_does_not_load_cli():
+    assert loaded_modules("from freckelize import main; main(['--version'])") == []
+
+
+def test_cli_import_defers_run_dependencies():
+    pytest.importorskip("freckles")
+    modules = loaded_modules("import freckelize.cli")
+    assert "cookiecutter" not in modules
+    assert "click_completion" not in modules
+    assert "nsbl" not in modules
+    assert "freckles" not in modules
+    assert "freckelize.command" not in modules
+    assert "freckelize.freckelize" not in modules
+
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the phase timing instrumentation in `freckelize.timings`."""
+
+import json
+
+from freckelize.timings import PhaseTimings, timed
+
+
+class Timed(object):
+
+    def __init__(self, timings):
+        self.timings = timings
+
+    @timed("outer")
+    def outer(self):
+        with self.timings.phase("inner", host="localhost"):
+            pass
+        return "result"
+
+
+def test_phase_timings_summary():
+
+    timings = PhaseTimings()
+    obj = Timed(timings)
+
+    assert obj.outer() == "result"
+    obj.outer()
+
+    summary = timings.summary()
+    assert list(summary.keys()) == ["outer", "inner"]
+    assert summary["outer"]["count"] == 2
+    assert summary["inner"]["count"] == 2
+    assert summary["outer"]["total"] >= summary["inner"]["total"]
+
+
+def test_phase_timings_disabled():
+
+    timings = PhaseTimings(enabled=False)
+    Timed(timings).outer()
+
+    assert timings.events == []
+    assert timings.summary() == {}
+
+
+def test_phase_timings_chrome_trace(tmpdir):
+
+    timings = PhaseTimings()
+    Timed(timings).outer()
+
+    path = str(tmpdir.join("trace.json"))
+    timings.write(path, output_format="chrome-trace")
+    with open(path) as f:
+        trace = json.load(f)
+
+    events = trace["traceEvents"]
+    assert sorted(e["name"] for e in events) == ["inner", "outer"]
+    assert all(e["ph"] == "X" for e in events)
+    assert [e["args"] for e in events if e["name"] == "inner"] == [{"host": "localhost"}]
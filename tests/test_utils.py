@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the adapter finder and reader in `freckelize.utils`."""
+
+import pytest
+
+pytest.importorskip("freckles")
+
+from freckelize import utils  # noqa: E402
+from freckelize.utils import FreckelizeAdapterFinder, FreckelizeAdapterReader, invalidate_repo_caches  # noqa: E402
+
+
+def test_adapter_finder_index(cache_dir, tmpdir):
+    bundled = tmpdir.mkdir("bundled")
+    bundled.join("python-dev.adapter.freckle").write("")
+    bundled.join("dotfiles.adapter.freckle").write("")
+    user = tmpdir.mkdir("user")
+    user.join("dotfiles.adapter.freckle").write("")
+
+    invalidate_repo_caches()
+    finder = FreckelizeAdapterFinder([str(bundled), str(user)])
+
+    first = finder.get_all_dictlets()
+    assert sorted(first.keys()) == ["dotfiles", "python-dev"]
+    # repeated calls return the same index
+    assert finder.get_all_dictlets() is first
+    # later paths win
+    assert finder.get_dictlet("dotfiles")["path"] == str(user.join("dotfiles.adapter.freckle").realpath())
+    assert finder.get_dictlet("missing") is None
+
+    user.join("new.adapter.freckle").write("")
+    invalidate_repo_caches(str(user))
+    assert sorted(finder.get_all_dictlet_names()) == ["dotfiles", "new", "python-dev"]
+
+
+def test_adapter_finder_invalidation_during_build(cache_dir, tmpdir, monkeypatch):
+    paths = [str(tmpdir.mkdir(name)) for name in ["one", "two"]]
+    finder = FreckelizeAdapterFinder(paths)
+    find_freckelize_adapters = utils.find_freckelize_adapters
+
+    def find(path):
+        # like a change detected by the cache watcher while the index is built (from a worker thread)
+        finder.invalidate_path(paths[0])
+        return find_freckelize_adapters(path)
+
+    monkeypatch.setattr(utils, "find_freckelize_adapters", find)
+    assert finder.get_all_dictlets() == {}
+
+
+def test_adapter_header(cache_dir, tmpdir):
+    adapter = tmpdir.mkdir("adapters").join("example.adapter.freckle")
+    adapter.write("__freckles__:\n  adapter_priority: 100\n  roles:\n    - makkus.example\n")
+    details = {"path": str(adapter), "type": "file"}
+
+    reader = FreckelizeAdapterReader()
+    header = reader.read_adapter_header(details)
+    assert header["adapter_priority"] == 100
+    assert header["roles"] == ["makkus.example"]
+    assert "add_file_list" not in header
+    assert reader.read_adapter_header(details) == header
+
+    # a changed adapter file is read again
+    adapter.write("__freckles__:\n  adapter_priority: 2000\n  add_file_list: true\n")
+    header = reader.read_adapter_header(details)
+    assert header["adapter_priority"] == 2000
+    assert header["add_file_list"] is True
+    assert "roles" not in header
+
+
+def test_blueprint_is_cacheable(tmpdir):
+    blueprint = tmpdir.mkdir("blueprint")
+    blueprint.join("cookiecutter.json").write('{"project_name": "example"}')
+    project = blueprint.mkdir("{{ cookiecutter.project_name }}")
+    project.join("README.md").write("# {{ cookiecutter.project_name }}\n")
+    assert utils.blueprint_is_cacheable(str(blueprint))
+
+    project.join("LICENSE").write("Copyright {% now 'utc', '%Y' %}\n")
+    assert not utils.blueprint_is_cacheable(str(blueprint))
+
+    project.join("LICENSE").remove()
+    blueprint.mkdir("hooks").join("post_gen_project.py").write("")
+    assert not utils.blueprint_is_cacheable(str(blueprint))
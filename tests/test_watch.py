@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the repo change detection in `freckelize.watch`."""
+
+import pytest
+
+from freckelize.watch import RepoWatcher
+
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_repo_watcher_detects_changes(tmpdir, use_inotify):
+    repo_one = tmpdir.mkdir("one")
+    repo_one.mkdir("sub")
+    repo_two = tmpdir.mkdir("two")
+
+    watcher = RepoWatcher(exclude_dirs=[".git"], poll_interval=0, use_inotify=use_inotify)
+    try:
+        watcher.watch(str(repo_one))
+        watcher.watch(str(repo_two))
+        assert watcher.changed_paths(force_poll=True) == set()
+
+        repo_one.join("sub").join("new.adapter.freckle").write("")
+        assert watcher.changed_paths(force_poll=True) == {str(repo_one)}
+        assert watcher.changed_paths(force_poll=True) == set()
+
+        # new folders are watched as well
+        new_folder = repo_two.mkdir("new")
+        assert watcher.changed_paths(force_poll=True) == {str(repo_two)}
+        new_folder.join("other.adapter.freckle").write("")
+        assert watcher.changed_paths(force_poll=True) == {str(repo_two)}
+
+        watcher.unwatch(str(repo_two))
+        repo_two.join("ignored.adapter.freckle").write("")
+        assert watcher.changed_paths(force_poll=True) == set()
+    finally:
+        watcher.close()